@@ -1,40 +1,76 @@
 #!/usr/bin/env python3
 # -*- coding: ISO-8859-1 -*-
 
-from flask import Flask, request, render_template, jsonify, redirect, url_for, session
+from flask import Flask, Blueprint, Response, request, render_template, jsonify, redirect, url_for, session, stream_with_context, send_file
 from dotenv import load_dotenv
-from openai import OpenAI
 from functools import wraps
 # Importa funcoes customizadas de acesso ao banco de dados.
-from db.models import buscar_jornada_por_id, filtrar_pacientes, buscar_convenios, buscar_profissionais, busca_conjunto
+from db.models import buscar_jornada_por_id, filtrar_pacientes, contar_pacientes, iterar_pacientes, versao_paciente
+# Avisos de alteracao dos eventos de cada paciente (ver db.ingestao).
+from db.ingestao import registrar_assinante, iniciar_ouvinte
+# Uso dos pools de conexao com o banco (ver db.conexao).
+from db.conexao import metricas_pools
+# Latencia por etapa, linhas lidas, tokens e acertos de cache de cada rota (ver nucleo.metricas).
+from nucleo.metricas import (medir, registrar_etapa, registrar_linhas, registrar_cache, registrar_tokens,
+                             iniciar_requisicao, finalizar_requisicao, exportar_prometheus)
+# Listas de convenios, profissionais e conjuntos sao servidas a partir de um cache em memoria.
+from db.cache_listas import obter_lista_com_etag, invalidar_listas
+# Sugestoes por prefixo (sem acentos, tolerando erros de digitacao) sobre as mesmas listas.
+from db.sugestoes import sugerir, SUGESTOES_LIMITE, SUGESTOES_LIMITE_MAX
+from db.busca_texto import MODOS_BUSCA
+# Exportacao dos resultados do filtro (CSV, JSON Lines e Parquet).
+from db.exportacao import gerar_exportacao, validar_exportacao, iniciar_exportacao, estado_exportacao, FORMATOS_EXPORTACAO
+# Estatisticas agregadas de uma coorte, calculadas no banco.
+from db.coorte import analisar_coorte, validar_coorte
+# Montagem do contexto do paciente enviado a IA.
+from ia.contexto import montar_contexto, COLUNAS_CONTEXTO, LIMITE_EVENTOS_CONTEXTO
+# Cliente da OpenAI, criado na primeira chamada a IA.
+from ia.cliente import obter_cliente
+# Resumos por paciente gerados em segundo plano (python -m ia.resumos).
+from ia.resumos import resumo_para_pergunta, registrar_demanda
+# Cache das respostas da IA, por pergunta e versao dos dados do paciente.
+from ia.cache_respostas import chave_resposta, obter_resposta, guardar_resposta, invalidar_paciente
+# Mesma pergunta para varios pacientes, com chamadas a IA em paralelo.
+from ia.lote import criar_lote, obter_lote, executar_lote, resumo_lote, lote_em_execucao, LoteEmExecucao, LOTE_MAX_PACIENTES
+# Perguntas identicas em andamento sao respondidas uma unica vez; as chamadas a IA tem limite de concorrencia.
+from nucleo.concorrencia import coalescer, entrar_voo, sair_voo, limitar, LimiteExcedido, medidores_concorrencia
+# Interpretacao de buscas em linguagem natural (cache + interpretador local + IA).
+from ia.parser_filtros import interpretar_filtro
+# Graficos sao gerados em processos separados, fora das threads do Flask.
+from graficos.sandbox import preparar_codigo, CodigoInvalido
+from graficos.dados import dados_paciente, descartar_pacientes, COLUNAS_GRAFICO
+from graficos.cache_imagens import chave_grafico, caminho_grafico, guardar_grafico, FORMATOS_GRAFICO, DPI_PADRAO, DPI_MINIMO, DPI_MAXIMO
+from graficos.pool import renderizar_grafico, iniciar_pool, FilaCheia, TempoEsgotado
 
-#Muitos desses import's sao necessarios para gerar os graficos. 
+# Matplotlib e pandas so sao carregados nos processos de graficos (graficos.pool); a
+# biblioteca openai, no primeiro uso da IA (ia.cliente); e o NumPy, na primeira pergunta
+# (ia.recuperacao). Os pools do banco sao abertos na primeira consulta (db.conexao).
 import os
 import traceback
 import json
-import io
-import base64
-import matplotlib
-# Configura o Matplotlib para um backend nao-interativo, essencial para apps web.
-matplotlib.use('Agg') 
-import matplotlib.pyplot as plt
-# Counter e pandas sao disponibilizados para a IA usar na geracao de graficos.
-from collections import Counter
-import pandas as pd
-from datetime import datetime
-import builtins
-import re
+import hashlib
+import time
+import threading
+from datetime import date
 
 
 load_dotenv()
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Modelo usado nas chamadas a IA e temperatura das respostas sobre pacientes.
+MODELO_IA = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+TEMPERATURA_RESPOSTA = 0.2 # Baixa temperatura para respostas mais deterministas.
 
-app = Flask(__name__)
-# Garante que a sessao nao seja permanente (dura apenas enquanto o navegador estiver aberto).
-app.config['SESSION_PERMANENT'] = False
-app.secret_key = os.getenv("SECRET_KEY", "uma-chave-secreta")
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Rotas da aplicacao, registradas em `criar_app`.
+principal = Blueprint("principal", __name__)
+
+# Tamanho padrao e maximo de uma pagina de resultados do filtro de pacientes.
+LIMITE_PAGINA_FILTRO = int(os.getenv("LIMITE_PAGINA_FILTRO", "200"))
+LIMITE_PAGINA_MAXIMO = int(os.getenv("LIMITE_PAGINA_MAXIMO", "2000"))
+# Tempo (em segundos) que o navegador pode guardar a imagem de um grafico (um ano).
+IMAGEM_GRAFICO_MAX_AGE = 365 * 24 * 3600
+# Token aceito em '/metrics' (cabecalho "Authorization: Bearer <token>"), para coletores
+# como o Prometheus. Sem ele, a rota exige login como as demais.
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN")
 
 # Carrega e valida credenciais de usuario a partir das variaveis de ambiente.
 admin_user = os.getenv("ADMIN_CRED")
@@ -61,13 +97,13 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user' not in session:
-            return redirect(url_for('login'))
+            return redirect(url_for('.login'))
         return f(*args, **kwargs)
     return decorated_function
 
 # --- ROTAS DE AUTENTICACAO E SESSAO ---
 
-@app.route('/login', methods=['GET', 'POST'])
+@principal.route('/login', methods=['GET', 'POST'])
 def login():
     """
     Renderiza a pagina de login e processa a tentativa de login.
@@ -77,21 +113,21 @@ def login():
         p = request.form['password']
         if USERS.get(u) == p:
             session['user'] = u # Armazena o usuario na sessao.
-            return redirect(url_for('index')) # Redireciona para a pagina principal.
+            return redirect(url_for('.index')) # Redireciona para a pagina principal.
         return render_template('login.html', erro="Usuario ou senha invalidos")
     return render_template('login.html')
 
-@app.route('/logout')
+@principal.route('/logout')
 def logout():
     """
     Limpa a sessao do usuario e redireciona para a pagina de login.
     """
     session.clear()
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
 # --- ROTAS PRINCIPAIS DA APLICACAO ---
 
-@app.route('/')
+@principal.route('/')
 @login_required # Protege esta rota, exigindo login.
 def index():
     """
@@ -99,17 +135,143 @@ def index():
     """
     return render_template('index.html')
 
-@app.after_request
+# Inicializacao feita uma vez por processo, na primeira requisicao (ver `inicializar_processo`).
+_processo_inicializado = False
+_lock_inicializacao = threading.Lock()
+
+@principal.before_app_request
+def inicializar_processo():
+    """
+    Na primeira requisicao de cada processo (cada worker do servidor WSGI), inicia o
+    ouvinte de alteracoes dos pacientes. Se falhar (ex.: banco fora do ar), tenta
+    de novo na proxima requisicao.
+    """
+    global _processo_inicializado
+    if _processo_inicializado:
+        return
+    with _lock_inicializacao:
+        if _processo_inicializado:
+            return
+        try:
+            iniciar_ouvinte()
+            _processo_inicializado = True
+        except Exception:
+            print("Erro ao inicializar o processo:", traceback.format_exc())
+
+@principal.before_app_request
+def inicio_requisicao():
+    """
+    Marca o inicio da requisicao para as metricas de latencia.
+    """
+    iniciar_requisicao()
+
+@principal.after_app_request
+def tempos_requisicao(response):
+    """
+    Registra a duracao da requisicao e envia as etapas medidas no cabecalho Server-Timing.
+    """
+    return finalizar_requisicao(response)
+
+@principal.after_app_request
 def no_cache(response):
     """
     Configura os cabecalhos da resposta para impedir o cache no navegador.
+    Respostas com ETag podem ser guardadas, mas precisam ser revalidadas a cada uso,
+    e respostas imutaveis (imagens de graficos) mantem o proprio cabecalho.
     """
+    if "immutable" in response.headers.get("Cache-Control", ""):
+        return response
+    if response.headers.get("ETag"):
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, private"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
     return response
 
-@app.route('/prompt', methods=['POST'])
+def montar_mensagens(patient_id, user_prompt, contexto):
+    """
+    Monta as mensagens enviadas a IA para responder uma pergunta sobre o paciente.
+
+    Args:
+        patient_id (str): ID do paciente.
+        user_prompt (str): Pergunta do usuario.
+        contexto (str): Dados do paciente ja formatados (ver ia.contexto).
+
+    Returns:
+        list: Mensagens de sistema e de usuario no formato da API da OpenAI.
+    """
+    # Monta o prompt completo para a IA, incluindo o contexto e as regras. IMPORTANTE FAZER MAIS TESTES PARA FINE TUNNING DOS RESULTADOS ESPERADOS
+    prompt_completo = f"""
+        Voce e um assistente de saude analisando dados clinicos. Com base nas observacoes abaixo do paciente de ID {patient_id}, responda a pergunta do usuario, NAO ESCREVA O NOME DO PACIENTE NUNCA. Escreva o texto com formatacao markdown.
+        Apenas quando o usuario explicitamente solicitar um grafico, gere um codigo em Python para plota-lo.
+
+        Quando (e somente quando) o usuario pedir um grafico, responda **apenas** com UM bloco de codigo Python entre crases triplas, no formato:
+        - Gere APENAS o corpo do codigo em Python que prepara o grafico.
+        - NUNCA inclua "import" statements.
+        - NUNCA chame `plt.show()` ou `plt.savefig()`. O sistema se encarregara de exibir a imagem.
+        - As seguintes variaveis ja estao disponiveis: `plt` (para graficos), `pd` (pandas), `Counter` (para contagens), e `datetime` (a classe para manipular datas).
+        - Os eventos deste paciente ja estao carregados no DataFrame `df`, com as colunas {', '.join(COLUNAS_GRAFICO)} (a coluna `data` ja e datetime). Use `df` e NUNCA copie os dados do paciente para dentro do codigo.
+
+        DADOS DO PACIENTE:
+        {contexto}
+
+        PERGUNTA: {user_prompt}
+        """
+    return [
+        {"role": "system", "content": "Voce e um assistente medico que analisa prontuarios clinicos e responde perguntas com base em observacaes do paciente."},
+        {"role": "user", "content": prompt_completo}
+    ]
+
+def responder_pergunta(patient_id, user_prompt, versao, chave):
+    """
+    Responde a pergunta sobre o paciente quando ela nao esta no cache: usa o resumo
+    pronto, se servir, ou chama a IA com o contexto do paciente.
+
+    Returns:
+        dict: O corpo da resposta de '/prompt' ({"resposta", e "cache" quando veio do resumo}).
+    """
+    # Pedidos de resumo sao atendidos pelo resumo ja gerado; nas demais perguntas
+    # ele acompanha os eventos como contexto compacto.
+    with medir("resumo"):
+        resumo_pronto, resumo_contexto = resumo_para_pergunta(patient_id, user_prompt, versao)
+    registrar_cache("resumos", resumo_pronto is not None)
+    if resumo_pronto is not None:
+        guardar_resposta(chave, patient_id, versao, resumo_pronto)
+        return {"resposta": resumo_pronto, "cache": True}
+
+    # Busca no banco apenas as colunas e os eventos mais recentes usados no contexto.
+    with medir("db_jornada"):
+        registros = buscar_jornada_por_id(patient_id, colunas=COLUNAS_CONTEXTO, limite=LIMITE_EVENTOS_CONTEXTO)
+    registrar_linhas("db_jornada", len(registros))
+    if not registros:
+        return {"resposta": "Nenhum dado encontrado para o paciente informado."}
+
+    # Mantem os eventos mais recentes e os mais relacionados a pergunta.
+    from ia.recuperacao import selecionar_eventos
+    with medir("recuperacao"):
+        selecionados = selecionar_eventos(patient_id, user_prompt, registros)
+    registrar_linhas("recuperacao", len(selecionados))
+
+    # Monta o contexto ordenado por data, com os dados constantes do paciente em um
+    # cabecalho e limitado ao orcamento de tokens (eventos antigos sao resumidos).
+    with medir("contexto"):
+        contexto = montar_contexto(selecionados, total_eventos=len(registros), resumo=resumo_contexto)
+
+    # Envia a requisicao para a API da OpenAI (esperando uma vaga se houver muitas em andamento).
+    with limitar("ia"), medir("ia"):
+        response = obter_cliente().chat.completions.create(
+            model=MODELO_IA,
+            messages=montar_mensagens(patient_id, user_prompt, contexto),
+            temperature=TEMPERATURA_RESPOSTA
+        )
+    registrar_tokens(getattr(response, "usage", None), MODELO_IA)
+
+    resposta = response.choices[0].message.content.strip()
+    guardar_resposta(chave, patient_id, versao, resposta)
+    return {"resposta": resposta}
+
+@principal.route('/prompt', methods=['POST'])
 @login_required
 def handle_prompt():
     """
@@ -123,62 +285,230 @@ def handle_prompt():
         return jsonify({"error": "Campos 'prompt' e 'patient_id' sao obrigatorios."}), 400
 
     try:
-        # Busca a jornada do paciente no banco de dados.
-        registros = buscar_jornada_por_id(patient_id)
-        if not registros:
-            return jsonify({"resposta": "Nenhum dado encontrado para o paciente informado."})
-
-        # Limita o contexto para os ultimos 1000 registros para nao exceder o limite de tokens.
-        registros = registros[-1000:]
-        contexto = "\n\n".join([
-            f"[{r['data']}] {r['descricao']} "
-            f"(CPF: {r['cpf']}"
-            f"Conjunto: {r['conjunto']}, Profissional: {r['nome_profissional']}, "
-            f"Convenio: {r['nome_convenio']}, Fonte: {r['fonte']})"
-            f"Data de Nascimento: {r['data_nascimento']}"
-            for r in registros if r.get("descricao")
-        ])
-
-        # Monta o prompt completo para a IA, incluindo o contexto e as regras. IMPORTANTE FAZER MAIS TESTES PARA FINE TUNNING DOS RESULTADOS ESPERADOS
-        prompt_completo = f"""
-            Voce e um assistente de saude analisando dados clinicos. Com base nas observacoes abaixo do paciente de ID {patient_id}, responda a pergunta do usuario, NAO ESCREVA O NOME DO PACIENTE NUNCA. Escreva o texto com formatacao markdown.
-            Apenas quando o usuario explicitamente solicitar um grafico, gere um codigo em Python para plota-lo.
-
-            Quando (e somente quando) o usuario pedir um grafico, responda **apenas** com UM bloco de codigo Python entre crases triplas, no formato:
-            - Gere APENAS o corpo do codigo em Python que prepara o grafico.
-            - NUNCA inclua "import" statements.
-            - NUNCA chame `plt.show()` ou `plt.savefig()`. O sistema se encarregara de exibir a imagem.
-            - As seguintes variaveis ja estao disponiveis: `plt` (para graficos), `Counter` (para contagens), e `datetime` (a classe para manipular datas).
-            - Para converter uma string de data, use `datetime.fromisoformat(...)` diretamente.
-
-            DADOS DO PACIENTE:
-            {contexto}
-
-            PERGUNTA: {user_prompt}
-            """
-
-        # Envia a requisicao para a API da OpenAI.
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": "Voce e um assistente medico que analisa prontuarios clinicos e responde perguntas com base em observacaes do paciente."},
-                {"role": "user", "content": prompt_completo}
-            ],
-            temperature=0.2 # Baixa temperatura para respostas mais deterministas.
-        )
+        # Perguntas repetidas sobre o mesmo paciente, sem eventos novos, sao respondidas pelo cache.
+        with medir("db_versao"):
+            versao = versao_paciente(patient_id)
+        with medir("cache"):
+            chave = chave_resposta(user_prompt, patient_id, versao, MODELO_IA, TEMPERATURA_RESPOSTA)
+            resposta_cache = obter_resposta(chave)
+        registrar_cache("respostas", resposta_cache is not None)
+        registrar_demanda([patient_id])
+        if resposta_cache is not None:
+            return jsonify({"resposta": resposta_cache, "cache": True})
 
-        resposta = response.choices[0].message.content.strip()
-        return jsonify({"resposta": resposta})
+        # A mesma pergunta, enviada de novo enquanto a primeira ainda esta sendo
+        # respondida (ex.: cliques repetidos), aguarda essa resposta em vez de chamar a IA.
+        resultado = coalescer("prompt", chave, responder_pergunta, patient_id, user_prompt, versao, chave)
+        return jsonify(resultado)
 
+    except LimiteExcedido as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print("Erro completo:", traceback.format_exc())
         return jsonify({"error": f"Erro interno: {str(e)}"}), 500
 
-@app.route('/parse-filter', methods=['POST'])
+@principal.route('/prompt/lote', methods=['POST'])
+@login_required
+def handle_prompt_batch():
+    """
+    Faz a mesma pergunta para varios pacientes. Os pacientes vem de "patient_ids"
+    ou dos mesmos criterios de '/filter'. A resposta e NDJSON: a primeira linha traz
+    {"id_trabalho", "total"}, depois uma linha por paciente a medida que as respostas
+    ficam prontas e, no fim, {"fim": true, "concluidos", "erros", "pendentes"}.
+
+    Enviando apenas {"id_trabalho": ...}, um lote interrompido e retomado: os
+    resultados ja obtidos sao reenviados e so os pacientes restantes sao processados.
+    Um lote que ainda esta em execucao nao pode ser retomado (409).
+    """
+    data = request.get_json(force=True)
+    id_trabalho = data.get("id_trabalho")
+
+    if id_trabalho:
+        if obter_lote(id_trabalho) is None:
+            return jsonify({"error": "Lote nao encontrado ou expirado."}), 404
+        if lote_em_execucao(id_trabalho):
+            return jsonify({"error": "Este lote ja esta em execucao; tente retoma-lo quando ela terminar."}), 409
+    else:
+        user_prompt = (data.get("prompt") or "").strip()
+        if not user_prompt:
+            return jsonify({"error": "O campo 'prompt' e obrigatorio."}), 400
+
+        if data.get("patient_ids"):
+            ids = [str(pid).strip() for pid in data["patient_ids"] if str(pid).strip()]
+        else:
+            filtros, erro = extrair_filtros(data)
+            if erro:
+                return jsonify({"error": "Informe 'patient_ids' ou criterios de filtro. " + erro}), 400
+            ids = []
+            # Le um paciente a mais que o maximo apenas para saber se o lote passou do limite.
+            for paciente in iterar_pacientes(**filtros):
+                ids.append(str(paciente['id_paciente']))
+                if len(ids) > LOTE_MAX_PACIENTES:
+                    break
+        if not ids:
+            return jsonify({"error": "Nenhum paciente para processar."}), 400
+        if len(ids) > LOTE_MAX_PACIENTES:
+            return jsonify({"error": f"O lote pode ter no maximo {LOTE_MAX_PACIENTES} pacientes."}), 400
+        id_trabalho = criar_lote(user_prompt, ids)
+
+    def gerar():
+        try:
+            yield json.dumps({"id_trabalho": id_trabalho, "total": len(obter_lote(id_trabalho)["ids"])}) + "\n"
+            for resultado in executar_lote(id_trabalho, obter_cliente(), MODELO_IA, TEMPERATURA_RESPOSTA, montar_mensagens):
+                yield json.dumps(resultado, ensure_ascii=False) + "\n"
+            yield json.dumps({"fim": True, **resumo_lote(id_trabalho)}) + "\n"
+        except LoteEmExecucao as e:
+            # Outra requisicao retomou o lote entre a verificacao acima e o inicio da execucao.
+            yield json.dumps({"error": str(e), "id_trabalho": id_trabalho}) + "\n"
+        except Exception as e:
+            print("Erro completo no lote:", traceback.format_exc())
+            yield json.dumps({"error": f"Erro interno: {str(e)}", "id_trabalho": id_trabalho}) + "\n"
+
+    return Response(stream_with_context(gerar()), mimetype="application/x-ndjson")
+
+def evento_sse(evento, dados):
+    """
+    Formata um evento no padrao Server-Sent Events.
+    """
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+def responder_pergunta_stream(patient_id, user_prompt, versao, chave):
+    """
+    Igual a `responder_pergunta`, mas envia os eventos "parcial" e "fim" de
+    '/prompt/stream' enquanto a resposta e gerada.
+
+    Returns:
+        dict: O mesmo corpo de `responder_pergunta` (retornado pelo gerador, ver `yield from`).
+    """
+    with medir("resumo"):
+        resumo_pronto, resumo_contexto = resumo_para_pergunta(patient_id, user_prompt, versao)
+    registrar_cache("resumos", resumo_pronto is not None)
+    if resumo_pronto is not None:
+        guardar_resposta(chave, patient_id, versao, resumo_pronto)
+        yield evento_sse("parcial", {"texto": resumo_pronto})
+        yield evento_sse("fim", {"cache": True})
+        return {"resposta": resumo_pronto, "cache": True}
+
+    with medir("db_jornada"):
+        registros = buscar_jornada_por_id(patient_id, colunas=COLUNAS_CONTEXTO, limite=LIMITE_EVENTOS_CONTEXTO)
+    registrar_linhas("db_jornada", len(registros))
+    if not registros:
+        resposta = "Nenhum dado encontrado para o paciente informado."
+        yield evento_sse("parcial", {"texto": resposta})
+        yield evento_sse("fim", {"cache": False})
+        return {"resposta": resposta}
+
+    from ia.recuperacao import selecionar_eventos
+    with medir("recuperacao"):
+        selecionados = selecionar_eventos(patient_id, user_prompt, registros)
+    registrar_linhas("recuperacao", len(selecionados))
+    with medir("contexto"):
+        contexto = montar_contexto(selecionados, total_eventos=len(registros), resumo=resumo_contexto)
+
+    # A vaga do limitador fica ocupada ate o fim da geracao (ou ate o navegador desconectar).
+    with limitar("ia"):
+        # Com stream=True a OpenAI devolve os tokens conforme sao gerados; cada trecho
+        # e repassado ao navegador imediatamente. O ultimo trecho traz o uso de tokens.
+        inicio_ia = time.perf_counter()
+        stream = obter_cliente().chat.completions.create(
+            model=MODELO_IA,
+            messages=montar_mensagens(patient_id, user_prompt, contexto),
+            temperature=TEMPERATURA_RESPOSTA,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        partes = []
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    registrar_tokens(chunk.usage, MODELO_IA)
+                if not chunk.choices:
+                    continue
+                texto = chunk.choices[0].delta.content
+                if texto:
+                    if not partes:
+                        registrar_etapa("ia_primeiro_trecho", time.perf_counter() - inicio_ia)
+                    partes.append(texto)
+                    yield evento_sse("parcial", {"texto": texto})
+        finally:
+            # Se o navegador desconectar, encerra a chamada a OpenAI em vez de consumi-la ate o fim.
+            stream.close()
+            registrar_etapa("ia", time.perf_counter() - inicio_ia)
+
+    # Somente respostas completas vao para o cache.
+    resposta = "".join(partes).strip()
+    guardar_resposta(chave, patient_id, versao, resposta)
+    yield evento_sse("fim", {"cache": False})
+    return {"resposta": resposta}
+
+@principal.route('/prompt/stream', methods=['POST'])
+@login_required
+def handle_prompt_stream():
+    """
+    Igual a '/prompt', mas envia a resposta da IA em partes (Server-Sent Events)
+    a medida que ela e gerada, em vez de esperar a resposta completa.
+
+    Eventos enviados:
+        - "parcial": {"texto": "..."} com cada trecho novo da resposta.
+        - "fim": {"cache": bool} quando a resposta termina.
+        - "erro": {"error": "..."} se algo falhar no meio da geracao.
+    """
+    data = request.get_json(force=True)
+    user_prompt = data.get("prompt", "").strip()
+    patient_id = data.get("patient_id", "").strip()
+
+    if not user_prompt or not patient_id:
+        return jsonify({"error": "Campos 'prompt' e 'patient_id' sao obrigatorios."}), 400
+
+    def gerar():
+        try:
+            with medir("db_versao"):
+                versao = versao_paciente(patient_id)
+            with medir("cache"):
+                chave = chave_resposta(user_prompt, patient_id, versao, MODELO_IA, TEMPERATURA_RESPOSTA)
+                resposta_cache = obter_resposta(chave)
+            registrar_cache("respostas", resposta_cache is not None)
+            registrar_demanda([patient_id])
+            if resposta_cache is not None:
+                yield evento_sse("parcial", {"texto": resposta_cache})
+                yield evento_sse("fim", {"cache": True})
+                return
+
+            # Divide as respostas em andamento com '/prompt': quem chega depois recebe a
+            # resposta inteira quando a primeira geracao termina.
+            voo, lider = entrar_voo("prompt", chave)
+            if not lider:
+                resultado = voo.aguardar()
+                yield evento_sse("parcial", {"texto": resultado["resposta"]})
+                yield evento_sse("fim", {"cache": resultado.get("cache", False)})
+                return
+
+            resultado, erro = None, None
+            try:
+                resultado = yield from responder_pergunta_stream(patient_id, user_prompt, versao, chave)
+            except Exception as e:
+                erro = e
+                raise
+            finally:
+                # Sempre libera quem esta aguardando, inclusive se o navegador desconectar.
+                if resultado is None and erro is None:
+                    erro = RuntimeError("A geracao da resposta foi interrompida.")
+                sair_voo("prompt", chave, voo, resultado, erro)
+
+        except Exception as e:
+            print("Erro completo no prompt em streaming:", traceback.format_exc())
+            yield evento_sse("erro", {"error": f"Erro interno: {str(e)}"})
+
+    # X-Accel-Buffering desativa o buffer de proxies (ex.: nginx), para os trechos chegarem na hora.
+    return Response(stream_with_context(gerar()), mimetype="text/event-stream", headers={"X-Accel-Buffering": "no"})
+
+@principal.route('/parse-filter', methods=['POST'])
 @login_required
 def parse_natural_language_filter():
     """
-    Recebe uma busca em linguagem natural e usa a IA para converte-la em um JSON de filtros.
+    Recebe uma busca em linguagem natural e a converte em um JSON de filtros
+    (ver ia.parser_filtros para o cache e o interpretador local). Nomes que
+    correspondem a varios cadastros voltam em "ambiguos" para o usuario escolher.
     """
     data = request.get_json()
     query = data.get('query')
@@ -186,187 +516,324 @@ def parse_natural_language_filter():
     if not query:
         return jsonify({"error": "Nenhuma query fornecida."}), 400
 
-    # Busca listas de entidades validas para ajudar a IA a identificar os filtros corretos.
-    lista_convenios = ", ".join(buscar_convenios())
-    lista_profissionais = ", ".join(buscar_profissionais())
-    lista_conjuntos = ", ".join(busca_conjunto())
-    
-    # Prompt de sistema que instrui a IA a extrair informacoes e retornar um JSON.
-    prompt_sistema = f"""
-        Voce e um assistente especialista em extrair criterios de busca de um texto em linguagem natural.
-        Sua unica tarefa e converter o texto do usuario em um objeto JSON.
-        O JSON de saida deve conter apenas as seguintes chaves: "idade_min", "idade_max", "convenios", "profissionais", "conjuntos", e "termos_busca".
-
-        REGRAS IMPORTANTES:
-        - Retorne APENAS o objeto JSON, sem nenhum texto adicional.
-        - A chave "termos_busca" deve ser uma LISTA de strings contendo os termos clinicos. Se apenas um termo for encontrado, coloque-o dentro de uma lista.
-        - As chaves "convenios", "profissionais" e "conjuntos" tambem devem ser listas de strings.
-        - Se uma informacao nao for mencionada, omita a chave do JSON.
-        - Para te ajudar, aqui estao nomes validos que podem aparecer:
-        - Convenios: {lista_convenios}
-        - Profissionais: {lista_profissionais}
-        - Conjuntos: {lista_conjuntos}
-
-        Exemplo 1:
-        Texto: "liste os pacientes com diabetes e hipertensao"
-        JSON: {{"termos_busca": ["diabetes", "hipertensao"]}}
-
-        Exemplo 2:
-        Texto: "pacientes do Dr. Carlos com mais de 50 anos e diagnstico de pneumonia"
-        JSON: {{"profissionais": ["Dr. Carlos"], "idade_min": 50, "termos_busca": ["pneumonia"]}}
-        """
     try:
-        # Envia a requisicao para a IA com o modo de resposta JSON ativado.
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": prompt_sistema},
-                {"role": "user", "content": query}
-            ],
-            temperature=0, # Temperatura 0 para a maxima consistencia.
-            response_format={"type": "json_object"}
-        )
-
-        resposta_json_str = response.choices[0].message.content
-        parsed_json = json.loads(resposta_json_str)
+        # Consultas repetidas vem do cache e as mais simples sao interpretadas localmente;
+        # a IA so e chamada quando o interpretador local nao entende a consulta.
+        with medir("interpretar"):
+            parsed_json, origem = interpretar_filtro(query, obter_cliente(), MODELO_IA)
+        registrar_cache("parser_filtros", origem == "cache")
         
-        print(f"DEBUG: JSON retornado pela IA -> {parsed_json}")
+        print(f"DEBUG: JSON interpretado ({origem}) -> {parsed_json}")
         return jsonify(parsed_json)
 
+    except LimiteExcedido as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"Erro ao parsear filtro com IA: {traceback.format_exc()}")
         return jsonify({"error": f"Nao foi possivel interpretar a busca: {str(e)}"}), 500
 
-@app.route('/plot', methods=['POST'])
+@principal.route('/plot', methods=['POST'])
 @login_required
 def plot_graph():
     """
     Recebe um codigo Python gerado pela IA, o executa em um ambiente seguro
-    e retorna a imagem de um grafico em formato base64. Importante nao mexer por agora, pois esta funcionando para tudo que foi testado
+    (um processo separado do pool de graficos) e retorna a URL da imagem do grafico.
+    Aceita "formato" ("png", "webp" ou "svg") e "dpi". Com "coorte" (o mesmo JSON de
+    '/cohort'), o agregado da coorte e entregue ao codigo como o DataFrame `df`. Importante nao mexer por agora, pois esta funcionando para tudo que foi testado
     """
     data = request.get_json(force=True)
     raw = (data.get('code') or '').strip()
+    patient_id = str(data.get('patient_id') or '').strip()
+    formato = str(data.get('formato') or 'png').lower()
 
     if not raw:
         return jsonify({"error": "Nenhum codigo fornecido."}), 400
+    if formato not in FORMATOS_GRAFICO:
+        return jsonify({"error": f"Formato invalido. Use um de: {', '.join(FORMATOS_GRAFICO)}."}), 400
+    try:
+        dpi = min(max(int(data.get('dpi') or DPI_PADRAO), DPI_MINIMO), DPI_MAXIMO)
+    except (TypeError, ValueError):
+        return jsonify({"error": "O campo 'dpi' deve ser um numero inteiro."}), 400
+
+    dados_coorte = None
+    if data.get('coorte') is not None:
+        if not isinstance(data['coorte'], dict):
+            return jsonify({"error": "O campo 'coorte' deve ser um objeto."}), 400
+        parametros, erro = extrair_parametros_coorte(data['coorte'])
+        if erro:
+            return jsonify({"error": erro}), 400
 
     try:
-        # Extrai o codigo de dentro de um bloco de markdown (```python ... ```).
-        m = re.search(r"```(?:python)?\s*(.+?)```", raw, flags=re.S|re.I)
-        code = m.group(1).strip() if m else raw
-
-        # --- SANITIZACAO E SEGURANCA DO CODIGO ---
-        # Remove linhas potencialmente perigosas como 'import', 'plt.show()' e 'plt.savefig()'.
-        lines = code.splitlines()
-        safe_code_lines = []
-        for line in lines:
-            s = line.strip()
-            if s.startswith("import ") or s.startswith("from "):
-                continue
-            if "plt.show(" in s.replace(" ", "") or "plt.savefig(" in s.replace(" ", ""):
-                continue
-            safe_code_lines.append(line)
-        safe_code = "\n".join(safe_code_lines).strip()
-
-        # Faz pequenas correcoes de formatacao no codigo da IA.
-        safe_code = re.sub(r"\)\s*plt\.", r")\nplt.", safe_code)
-        safe_code = re.sub(r"\]\s*plt\.", r"]\nplt.", safe_code)
-        safe_code = re.sub(r"\}\s*plt\.", r"}\nplt.", safe_code)
-        if "; " in safe_code:
-            safe_code = safe_code.replace("; ", ";\n")
-
-        # --- AMBIENTE DE EXECUCAO SEGURO (SANDBOX) ---
-        original_import = builtins.__import__
-        blacklist = ['os', 'sys', 'subprocess', 'shutil', 'requests', 'socket', 'http']
-
-        # Sobrescreve a funcao de importacao para bloquear modulos perigosos.
-        def safe_importer(name, globals=None, locals=None, fromlist=(), level=0):
-            if any(name.startswith(b) for b in blacklist):
-                raise ImportError(f"A importacao do modulo '{name}' nao e permitida.")
-            return original_import(name, globals, locals, fromlist, level)
-
-        # Define quais funcoes built-in estarao disponiveis.
-        safe_builtins_dict = {
-            "print": print, "len": len, "range": range, "min": min, "max": max,
-            "sum": sum, "abs": abs, "round": round, "sorted": sorted, "list": list,
-            "dict": dict, "set": set, "tuple": tuple, "str": str, "int": int,
-            "float": float, "bool": bool, "enumerate": enumerate, "zip": zip,
-            "__import__": safe_importer,
-        }
-        
-        # Define as variaveis globais que o codigo podera acessar.
-        safe_globals = {
-            "__builtins__": safe_builtins_dict,
-            "plt": plt,
-            "pd": pd,
-            "Counter": Counter,
-            "datetime": datetime,
-        }
+        # Valida e limpa o codigo em uma passada pela AST (ver graficos.sandbox) e o executa
+        # em um dos processos de graficos (ver graficos.pool): cada processo tem sua propria
+        # Figure, limites de tempo, CPU e memoria e um cache do codigo ja compilado.
+        with medir("preparar"):
+            safe_code = preparar_codigo(raw)
 
-        # Limpa qualquer grafico anterior e executa o codigo seguro.
-        plt.clf()
-        exec(safe_code, safe_globals)
+        # O agregado de uma coorte e pequeno: e calculado antes, e seu hash faz o papel
+        # da versao dos dados na chave do grafico.
+        if data.get('coorte') is not None:
+            with medir("db_coorte"):
+                dados_coorte = analisar_coorte(**parametros)["dados"]
+            versao = "coorte:" + hashlib.sha1(json.dumps(dados_coorte, sort_keys=True).encode("utf-8")).hexdigest()
+            patient_id = ""
+        elif patient_id:
+            with medir("db_versao"):
+                versao = versao_paciente(patient_id)
+        else:
+            versao = None
 
-        # Salva o grafico gerado em um buffer de memoria.
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight')
-        buf.seek(0)
-        # Codifica a imagem em base64 para ser enviada como JSON.
-        image_base64 = base64.b64encode(buf.read()).decode('utf-8')
-        buf.close()
+        # O mesmo codigo sobre a mesma versao dos dados gera sempre a mesma imagem,
+        # entao um grafico ja renderizado nao e executado de novo.
+        nome = chave_grafico(safe_code, patient_id, versao, formato, dpi)
+        em_cache = caminho_grafico(nome) is not None
+        registrar_cache("graficos", em_cache)
+        if not em_cache:
+            # Com um paciente informado, a jornada dele e carregada no servidor e entregue
+            # ao codigo como o DataFrame `df`, em vez de vir escrita no proprio codigo.
+            if dados_coorte is not None:
+                dados = dados_coorte
+            elif patient_id:
+                with medir("db_jornada"):
+                    dados = dados_paciente(patient_id, versao)
+            else:
+                dados = None
+            tempos = {}
+            with medir("grafico"):
+                imagem = renderizar_grafico(safe_code, dados, formato, dpi, tempos)
+            # Espera por um processo livre, execucao do codigo e geracao da imagem.
+            for etapa, segundos in tempos.items():
+                registrar_etapa(f"grafico_{etapa}", segundos)
+            with medir("guardar"):
+                guardar_grafico(nome, imagem)
 
-        return jsonify({"image_base64": image_base64})
+        return jsonify({"url": url_for('.imagem_grafico', nome=nome)})
 
+    except CodigoInvalido as e:
+        return jsonify({"error": f"Erro ao gerar o grafico: {str(e)}"}), 400
+    except FilaCheia as e:
+        response = jsonify({"error": str(e)})
+        response.headers["Retry-After"] = "2"
+        return response, 503
+    except TempoEsgotado as e:
+        return jsonify({"error": f"Erro ao gerar o grafico: {str(e)}"}), 504
     except Exception as e:
         print("Erro ao executar codigo do grafico:", traceback.format_exc())
         return jsonify({"error": f"Erro ao gerar o grafico: {str(e)}"}), 500
 
+@principal.route('/plot/img/<nome>', methods=['GET'])
+@login_required
+def imagem_grafico(nome):
+    """
+    Serve a imagem de um grafico ja renderizado. O nome e o hash do codigo e dos
+    dados usados, entao o conteudo de uma URL nunca muda e pode ficar no cache do navegador.
+    """
+    caminho = caminho_grafico(nome)
+    if caminho is None:
+        return jsonify({"error": "Grafico nao encontrado."}), 404
+    formato = nome.rsplit('.', 1)[1]
+    response = send_file(caminho, mimetype=FORMATOS_GRAFICO[formato], max_age=IMAGEM_GRAFICO_MAX_AGE)
+    response.headers["Cache-Control"] = f"private, max-age={IMAGEM_GRAFICO_MAX_AGE}, immutable"
+    return response
+
+@principal.route('/db/pools', methods=['GET'])
+@login_required
+def db_pools():
+    """
+    Retorna o uso de cada pool de conexoes: retiradas, tempo esperando uma conexao
+    livre e conexoes em uso.
+    """
+    return jsonify(metricas_pools())
+
+@principal.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Expoe as metricas no formato do Prometheus: latencia de cada rota e de cada
+    etapa (banco, contexto, IA, grafico), linhas lidas, tokens, acertos de cache e
+    uso dos pools de conexao e dos limitadores de concorrencia. Aceita o
+    METRICAS_TOKEN ou um usuario logado.
+    """
+    autorizacao = request.headers.get("Authorization", "")
+    if not (METRICAS_TOKEN and autorizacao == f"Bearer {METRICAS_TOKEN}") and 'user' not in session:
+        return jsonify({"error": "Nao autorizado."}), 401
+
+    pools = metricas_pools()
+    medidores = {
+        "db_pool_checkouts": ("Conexoes retiradas de cada pool desde o inicio.",
+                              [({"pool": nome}, m["checkouts"]) for nome, m in pools.items()]),
+        "db_pool_espera_segundos": ("Tempo total esperando uma conexao livre em cada pool.",
+                                    [({"pool": nome}, m["espera_total_s"]) for nome, m in pools.items()]),
+        "db_pool_esgotados": ("Retiradas que desistiram apos DB_POOL_ESPERA_S.",
+                              [({"pool": nome}, m["esgotados"]) for nome, m in pools.items()]),
+        "db_pool_em_uso": ("Conexoes em uso em cada pool.",
+                           [({"pool": nome}, m.get("em_uso", 0)) for nome, m in pools.items()]),
+        **medidores_concorrencia(),
+    }
+    return Response(exportar_prometheus(medidores), mimetype="text/plain; version=0.0.4")
+
 # --- ROTAS DE API PARA DADOS DE FILTROS ---
 
-@app.route('/convenios', methods=['GET'])
+def responder_lista(nome):
+    """
+    Monta a resposta JSON de uma lista em cache com ETag.
+    Se o navegador ja tiver a versao atual (If-None-Match), retorna 304 sem corpo.
+    """
+    valores, etag = obter_lista_com_etag(nome)
+    resposta = jsonify(valores)
+    resposta.set_etag(etag)
+    return resposta.make_conditional(request)
+
+@principal.route('/convenios', methods=['GET'])
 @login_required
 def get_convenios():
     """
     Endpoint para fornecer a lista de convenios para o frontend.
     """
     try:
-        convenios = buscar_convenios()
-        return jsonify(convenios)
+        return responder_lista("convenios")
     except Exception as e:
         print("Erro ao buscar convenios:", traceback.format_exc())
         return jsonify({"error": f"Erro interno: {str(e)}"}), 500
 
-@app.route('/profissionais', methods=['GET'])
+@principal.route('/profissionais', methods=['GET'])
 @login_required
 def get_profissionais():
     """
     Endpoint para fornecer a lista de profissionais para o frontend.
     """
     try:
-        profissionais = buscar_profissionais()
-        return jsonify(profissionais)
+        return responder_lista("profissionais")
     except Exception as e:
         print("Erro ao buscar profissionais:", traceback.format_exc())
         return jsonify({"error": f"Erro interno: {str(e)}"}), 500
 
-@app.route('/conjuntos', methods=['GET'])
+@principal.route('/conjuntos', methods=['GET'])
 @login_required
 def get_conjuntos():
     """
     Endpoint para fornecer a lista de conjuntos para o frontend.
     """
     try:
-        conjuntos = busca_conjunto()
-        return jsonify(conjuntos)
+        return responder_lista("conjuntos")
     except Exception as e:
         print("Erro ao buscar conjuntos:", traceback.format_exc())
         return jsonify({"error": f"Erro interno: {str(e)}"}), 500
 
-@app.route('/filter', methods=['POST'])
+@principal.route('/suggest', methods=['GET'])
+@login_required
+def suggest():
+    """
+    Sugere convenios, profissionais ou conjuntos enquanto o usuario digita, sem
+    enviar a lista inteira ao navegador.
+
+    Parametros (query string):
+        - lista: "convenios", "profissionais" ou "conjuntos".
+        - q: texto digitado (sem diferenciar acentos e caixa; vazio traz os primeiros nomes).
+        - limite: quantidade de sugestoes (padrao SUGESTOES_LIMITE, maximo SUGESTOES_LIMITE_MAX).
+    """
+    lista = request.args.get('lista', '')
+    consulta = request.args.get('q', '')
+    limite_val = request.args.get('limite')
+    if lista not in ("convenios", "profissionais", "conjuntos"):
+        return jsonify({"error": "O parametro 'lista' deve ser convenios, profissionais ou conjuntos."}), 400
+    if limite_val is not None and not limite_val.isdigit():
+        return jsonify({"error": "O parametro 'limite' deve ser um numero inteiro."}), 400
+    limite = max(1, min(int(limite_val), SUGESTOES_LIMITE_MAX)) if limite_val is not None else SUGESTOES_LIMITE
+
+    try:
+        with medir("sugestoes"):
+            sugestoes = sugerir(lista, consulta[:200], limite)
+        return jsonify(sugestoes)
+    except Exception as e:
+        print("Erro ao sugerir nomes:", traceback.format_exc())
+        return jsonify({"error": f"Erro interno: {str(e)}"}), 500
+
+def extrair_filtros(data, exigir_criterio=True):
+    """
+    Extrai e valida os criterios de filtro de um JSON recebido do frontend.
+
+    Args:
+        data (dict): JSON da requisicao.
+        exigir_criterio (bool, optional): Se False, aceita nenhum criterio (toda a populacao).
+
+    Returns:
+        tuple: Um dicionario com os argumentos de `filtrar_pacientes` e uma
+               mensagem de erro (None se os filtros forem validos).
+    """
+    idade_min, idade_max = None, None
+    
+    idade_min_val = data.get('idade_min')
+    if idade_min_val is not None and str(idade_min_val).isdigit():
+        idade_min = int(idade_min_val)
+
+    idade_max_val = data.get('idade_max')
+    if idade_max_val is not None and str(idade_max_val).isdigit():
+        idade_max = int(idade_max_val)
+
+    filtros = {
+        "idade_min": idade_min,
+        "idade_max": idade_max,
+        "convenios": data.get('convenios'),
+        "profissionais": data.get('profissionais'),
+        "conjuntos": data.get('conjuntos'),
+        "termos_busca": data.get('termos_busca'),
+        # Opcoes da busca por termos: modo ("trigrama", "texto" ou "ilike"), prefixo, stemming e ranking.
+        "modo_busca": data.get('modo_busca'),
+        "prefixo": bool(data.get('prefixo', True)),
+        "stemming": bool(data.get('stemming', False)),
+        "ranquear": bool(data.get('ranquear', False)),
+    }
+
+    if filtros["modo_busca"] is not None and filtros["modo_busca"] not in MODOS_BUSCA:
+        return filtros, f"Modo de busca invalido. Use um de: {', '.join(MODOS_BUSCA)}."
+
+    # Validacao para garantir que pelo menos um filtro foi fornecido.
+    if exigir_criterio and idade_min is None and idade_max is None and not filtros["convenios"] and not filtros["profissionais"] \
+            and not filtros["conjuntos"] and not filtros["termos_busca"]:
+        return filtros, "Por favor, fornea ao menos um critrio de busca vlido."
+
+    return filtros, None
+
+def descrever_filtros(filtros):
+    """
+    Cria um resumo legivel dos filtros utilizados, ex.: "(idade entre 10 e 45 anos, convenios: Agros)".
+    """
+    filtros_usados_list = []
+    if filtros["idade_min"] is not None and filtros["idade_max"] is not None:
+        filtros_usados_list.append(f"idade entre {filtros['idade_min']} e {filtros['idade_max']} anos")
+    if filtros["convenios"]:
+        filtros_usados_list.append(f"convenios: {', '.join(filtros['convenios'])}")
+    if filtros["profissionais"]:
+        filtros_usados_list.append(f"medicos: {', '.join(filtros['profissionais'])}")
+    if filtros["conjuntos"]:
+        filtros_usados_list.append(f"conjuntos: {', '.join(filtros['conjuntos'])}")
+    if filtros["termos_busca"]:
+         filtros_usados_list.append(f"termos: {', '.join(filtros['termos_busca'])}")
+    
+    return f"({', '.join(filtros_usados_list)})" if filtros_usados_list else ""
+
+def tabela_pacientes(pacientes):
+    """
+    Formata uma lista de pacientes como uma tabela Markdown.
+    """
+    response_parts = [
+        "| ID Paciente | Idade | N de Eventos |\n",
+        "|-------------|-------|---------------|\n"
+    ]
+    for paciente in pacientes:
+        patient_id = paciente['id_paciente']
+        # Cria um link clicavel no ID do paciente para facilitar a interacao no frontend.
+        linha = f"| <span class='patient-id-link' data-id='{patient_id}'>{patient_id}</span> | {int(paciente['idade_calculada'])} | {paciente['total_eventos']} |\n"
+        response_parts.append(linha)
+    return "".join(response_parts)
+
+@principal.route('/filter', methods=['POST'])
 @login_required
 def filter_patients():
     """
     Recebe um JSON com criterios de filtro, busca os pacientes e formata a resposta.
+    Os resultados sao paginados: `limite` define o tamanho da pagina e `cursor`
+    (o `proximo_cursor` devolvido pela pagina anterior) indica onde continuar.
     """
     data = request.get_json()
     if not data:
@@ -374,82 +841,283 @@ def filter_patients():
 
     try:
         # Extrai e valida os parametros de filtro do JSON recebido.
-        idade_min, idade_max = None, None
-        
-        idade_min_val = data.get('idade_min')
-        if idade_min_val is not None and str(idade_min_val).isdigit():
-            idade_min = int(idade_min_val)
-
-        idade_max_val = data.get('idade_max')
-        if idade_max_val is not None and str(idade_max_val).isdigit():
-            idade_max = int(idade_max_val)
-
-        convenios = data.get('convenios')
-        profissionais = data.get('profissionais')
-        conjuntos = data.get('conjuntos')
-        termos_busca = data.get('termos_busca') 
-
-        # Validacao para garantir que pelo menos um filtro foi fornecido.
-        if idade_min is None and idade_max is None and not convenios and not profissionais and not conjuntos and not termos_busca:
-            return jsonify({"error": "Por favor, fornea ao menos um critrio de busca vlido."}), 400
-        
-        # Chama a funcao do banco de dados para buscar os pacientes.
-        pacientes_encontrados = filtrar_pacientes(
-            idade_min=idade_min,
-            idade_max=idade_max,
-            convenios=convenios,
-            profissionais=profissionais,
-            conjuntos=conjuntos,
-            termos_busca=termos_busca
-        )
+        filtros, erro = extrair_filtros(data)
+        if erro:
+            return jsonify({"error": erro}), 400
+
+        limite_val = data.get('limite')
+        limite = int(limite_val) if limite_val is not None and str(limite_val).isdigit() else LIMITE_PAGINA_FILTRO
+        limite = max(1, min(limite, LIMITE_PAGINA_MAXIMO))
+        cursor = data.get('cursor')
+
+        # Busca um paciente a mais que o limite apenas para saber se existe uma proxima pagina.
+        with medir("db_filtro"):
+            pacientes_encontrados = filtrar_pacientes(**filtros, limite=limite + 1, apos_id=cursor)
+        registrar_linhas("db_filtro", len(pacientes_encontrados))
+        tem_mais = len(pacientes_encontrados) > limite
+        pacientes_encontrados = pacientes_encontrados[:limite]
+        # Pacientes que aparecem em filtros frequentes tem o resumo gerado primeiro.
+        registrar_demanda(p['id_paciente'] for p in pacientes_encontrados)
+        # Com ranking por relevancia a pagina e o "top N", sem continuacao.
+        proximo_cursor = pacientes_encontrados[-1]['id_paciente'] if tem_mais and not filtros["ranquear"] else None
+
+        # Os totais so sao calculados na primeira pagina. Se tudo coube na pagina,
+        # vem da propria lista; senao, de uma contagem separada e barata.
+        totais = {}
+        if cursor is None:
+            if tem_mais:
+                with medir("db_contagem"):
+                    totais = contar_pacientes(**filtros)
+            else:
+                totais = {
+                    "total_pacientes": len(pacientes_encontrados),
+                    "total_eventos": sum(p['total_eventos'] for p in pacientes_encontrados),
+                }
         
         # Formata a resposta para o frontend.
         if not pacientes_encontrados:
             resposta = "Nenhum paciente encontrado com os filtros aplicados."
+        elif cursor is not None:
+            resposta = f"### Mais pacientes {descrever_filtros(filtros)}:\n\n" + tabela_pacientes(pacientes_encontrados)
         else:
-            total_pacientes = len(pacientes_encontrados)
-            total_eventos_filtrados = sum(p['total_eventos'] for p in pacientes_encontrados)
-            
-            # Cria um resumo dos filtros utilizados.
-            filtros_usados_list = []
-            if idade_min is not None and idade_max is not None:
-                filtros_usados_list.append(f"idade entre {idade_min} e {idade_max} anos")
-            if convenios:
-                filtros_usados_list.append(f"convenios: {', '.join(convenios)}")
-            if profissionais:
-                filtros_usados_list.append(f"medicos: {', '.join(profissionais)}")
-            if conjuntos:
-                filtros_usados_list.append(f"conjuntos: {', '.join(conjuntos)}")
-            if termos_busca:
-                 filtros_usados_list.append(f"termos: {', '.join(termos_busca)}")
-            
-            filtros_usados = f"({', '.join(filtros_usados_list)})" if filtros_usados_list else ""
-
             # Monta a resposta em formato Markdown com uma tabela de resultados.
             response_parts = [
-                f"### Pacientes Encontrados {filtros_usados}:\n\n",
+                f"### Pacientes Encontrados {descrever_filtros(filtros)}:\n\n",
                 f"**Resumo da Busca:**\n",
-                f"* **Total de Pacientes Encontrados:** {total_pacientes}\n",
-                f"* **Total de Eventos (destes pacientes):** {total_eventos_filtrados}\n\n",
-                "| ID Paciente | Idade | N de Eventos |\n",
-                "|-------------|-------|---------------|\n"
+                f"* **Total de Pacientes Encontrados:** {totais['total_pacientes']}\n",
+                f"* **Total de Eventos (destes pacientes):** {totais['total_eventos']}\n",
             ]
-            
-            for paciente in pacientes_encontrados:
-                patient_id = paciente['id_paciente']
-                # Cria um link clicavel no ID do paciente para facilitar a interacao no frontend.
-                linha = f"| <span class='patient-id-link' data-id='{patient_id}'>{patient_id}</span> | {int(paciente['idade_calculada'])} | {paciente['total_eventos']} |\n"
-                response_parts.append(linha)
-            
+            if tem_mais:
+                response_parts.append(f"* **Exibindo:** os primeiros {len(pacientes_encontrados)} pacientes\n")
+            response_parts.append("\n")
+            response_parts.append(tabela_pacientes(pacientes_encontrados))
             resposta = "".join(response_parts)
 
-        return jsonify({"resposta": resposta})
+        return jsonify({"resposta": resposta, "proximo_cursor": proximo_cursor, **totais})
 
     except Exception as e:
         print("Erro completo no filtro:", traceback.format_exc())
         return jsonify({"error": f"Erro interno ao processar o filtro: {str(e)}"}), 500
 
+@principal.route('/filter/stream', methods=['POST'])
+@login_required
+def filter_patients_stream():
+    """
+    Versao em streaming do filtro: envia os pacientes em NDJSON (um JSON por linha)
+    a medida que sao lidos do banco por um cursor no servidor. A ultima linha traz
+    os totais: {"fim": true, "total_pacientes": ..., "total_eventos": ...}.
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "Requisio invlida."}), 400
+
+    filtros, erro = extrair_filtros(data)
+    if erro:
+        return jsonify({"error": erro}), 400
+
+    def gerar():
+        total_pacientes, total_eventos = 0, 0
+        try:
+            for paciente in iterar_pacientes(**filtros):
+                total_pacientes += 1
+                total_eventos += paciente['total_eventos']
+                linha = {
+                    "id_paciente": paciente['id_paciente'],
+                    "idade": int(paciente['idade_calculada']),
+                    "total_eventos": paciente['total_eventos'],
+                }
+                if 'relevancia' in paciente:
+                    linha["relevancia"] = float(paciente['relevancia'])
+                yield json.dumps(linha, default=str) + "\n"
+            yield json.dumps({"fim": True, "total_pacientes": total_pacientes, "total_eventos": total_eventos}) + "\n"
+        except Exception as e:
+            print("Erro completo no filtro em streaming:", traceback.format_exc())
+            yield json.dumps({"error": f"Erro interno ao processar o filtro: {str(e)}"}) + "\n"
+
+    return Response(stream_with_context(gerar()), mimetype="application/x-ndjson")
+
+
+def extrair_parametros_coorte(data):
+    """
+    Extrai e valida os parametros de '/cohort': os criterios de '/filter' (opcionais),
+    "metrica", "periodo", "tamanho_faixa", "limite", "data_inicio" e "data_fim".
+
+    Returns:
+        tuple: Os argumentos de `analisar_coorte` e uma mensagem de erro (None se validos).
+    """
+    filtros, erro = extrair_filtros(data, exigir_criterio=False)
+    if erro:
+        return None, erro
+
+    try:
+        parametros = {
+            "filtros": filtros,
+            "metrica": str(data.get('metrica') or 'eventos_por_periodo').lower(),
+            "periodo": str(data.get('periodo') or 'mes').lower(),
+            "tamanho_faixa": int(data.get('tamanho_faixa') or 10),
+            "limite": int(data.get('limite') or 20),
+        }
+    except (TypeError, ValueError):
+        return None, "Os campos 'tamanho_faixa' e 'limite' devem ser numeros inteiros."
+
+    for campo in ('data_inicio', 'data_fim'):
+        valor = data.get(campo)
+        if valor:
+            try:
+                parametros[campo] = date.fromisoformat(str(valor))
+            except ValueError:
+                return None, f"O campo '{campo}' deve ser uma data no formato AAAA-MM-DD."
+
+    erro = validar_coorte(parametros["metrica"], parametros["periodo"], parametros["tamanho_faixa"], parametros["limite"])
+    return parametros, erro
+
+@principal.route('/cohort', methods=['POST'])
+@login_required
+def cohort_analytics():
+    """
+    Calcula uma estatistica agregada (serie temporal, histograma de idade ou
+    distribuicao por convenio, profissional, conjunto ou fonte) sobre os pacientes
+    que correspondem aos criterios de '/filter'. Sem criterios, usa toda a populacao.
+
+    A agregacao e feita no banco e a resposta e colunar, pronta para virar o
+    DataFrame `df` de um grafico (campo "coorte" de '/plot').
+    """
+    data = request.get_json()
+    if data is None:
+        return jsonify({"error": "Requisio invlida."}), 400
+
+    parametros, erro = extrair_parametros_coorte(data)
+    if erro:
+        return jsonify({"error": erro}), 400
+
+    try:
+        return jsonify(analisar_coorte(**parametros))
+    except Exception as e:
+        print("Erro completo na analise de coorte:", traceback.format_exc())
+        return jsonify({"error": f"Erro interno ao calcular a coorte: {str(e)}"}), 500
+
+
+@principal.route('/export', methods=['POST'])
+@login_required
+def export_patients():
+    """
+    Exporta o resultado do filtro. Aceita os mesmos criterios de '/filter', mais:
+    "formato" ("csv", "jsonl" ou "parquet"), "conjunto" ("pacientes" ou "eventos"),
+    "colunas" (colunas dos eventos) e "segundo_plano".
+
+    Por padrao o arquivo e enviado em partes, a medida que e lido do banco. Com
+    "segundo_plano": true, o arquivo e gravado no servidor e a resposta traz o ID
+    do trabalho, acompanhado em '/export/<id>'.
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "Requisio invlida."}), 400
+
+    filtros, erro = extrair_filtros(data)
+    if erro:
+        return jsonify({"error": erro}), 400
+
+    formato = str(data.get('formato') or 'csv').lower()
+    conjunto = str(data.get('conjunto') or 'pacientes').lower()
+    colunas = data.get('colunas') or None
+    erro = validar_exportacao(formato, conjunto, colunas)
+    if erro:
+        return jsonify({"error": erro}), 400
+
+    if data.get('segundo_plano'):
+        id_trabalho = iniciar_exportacao(filtros, formato, conjunto, colunas)
+        return jsonify({"id": id_trabalho, "status": "executando", "url": url_for('.export_status', id_trabalho=id_trabalho)}), 202
+
+    def gerar():
+        try:
+            yield from gerar_exportacao(filtros, formato, conjunto, colunas)
+        except Exception:
+            # O download ja comecou; o erro so pode ser registrado e a conexao encerrada.
+            print("Erro completo na exportacao:", traceback.format_exc())
+            raise
+
+    return Response(
+        stream_with_context(gerar()),
+        mimetype=FORMATOS_EXPORTACAO[formato],
+        headers={"Content-Disposition": f'attachment; filename="{conjunto}.{formato}"'},
+    )
+
+@principal.route('/export/<id_trabalho>', methods=['GET'])
+@login_required
+def export_status(id_trabalho):
+    """
+    Retorna o estado de uma exportacao em segundo plano ("executando", "concluido" ou "erro").
+    """
+    estado = estado_exportacao(id_trabalho)
+    if estado is None:
+        return jsonify({"error": "Exportacao nao encontrada."}), 404
+    estado.pop("arquivo")
+    if estado["status"] == "concluido":
+        estado["download"] = url_for('.export_download', id_trabalho=id_trabalho)
+    return jsonify(estado)
+
+@principal.route('/export/<id_trabalho>/arquivo', methods=['GET'])
+@login_required
+def export_download(id_trabalho):
+    """
+    Baixa o arquivo de uma exportacao em segundo plano ja concluida.
+    """
+    estado = estado_exportacao(id_trabalho)
+    if estado is None or estado["status"] != "concluido":
+        return jsonify({"error": "Exportacao nao encontrada ou ainda em andamento."}), 404
+    return send_file(
+        estado["arquivo"],
+        mimetype=FORMATOS_EXPORTACAO[estado["formato"]],
+        as_attachment=True,
+        download_name=f"{estado['conjunto']}.{estado['formato']}",
+    )
+
+
+@registrar_assinante
+def descartar_caches_pacientes(ids: set):
+    """
+    Descarta os caches dos pacientes cujos eventos mudaram. As chaves ja incluem a
+    versao dos dados, entao isto apenas libera espaco das entradas que nao serao mais usadas.
+    """
+    descartar_pacientes(ids)
+    for pid in ids:
+        invalidar_paciente(pid)
+
+
+@registrar_assinante
+def descartar_listas(ids: set):
+    """
+    Descarta as listas de convenios, profissionais e conjuntos quando chegam eventos
+    novos, que podem trazer valores que ainda nao estao nelas. A proxima requisicao
+    recarrega as listas do banco.
+    """
+    invalidar_listas()
+
+
+def criar_app():
+    """
+    Cria e configura a aplicacao Flask. Nada pesado e feito aqui: o banco, a IA e os
+    processos de graficos sao iniciados no primeiro uso. Em producao, cada worker
+    do servidor WSGI chama esta funcao (ex.: gunicorn "app:criar_app()").
+
+    Returns:
+        Flask: A aplicacao com todas as rotas registradas.
+    """
+    app = Flask(__name__)
+    # Garante que a sessao nao seja permanente (dura apenas enquanto o navegador estiver aberto).
+    app.config['SESSION_PERMANENT'] = False
+    app.secret_key = os.getenv("SECRET_KEY", "uma-chave-secreta")
+    app.register_blueprint(principal)
+    return app
+
+# Aplicacao usada por "flask run", "python app.py" e servidores configurados com "app:app".
+app = criar_app()
+
 
 if __name__ == '__main__':
+    # Deixa os processos de graficos prontos antes da primeira requisicao. Com o
+    # reloader do modo debug, so o processo que atende as requisicoes os inicia.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        iniciar_pool()
     # Inicia o servidor de desenvolvimento do Flask.
-    app.run(debug=True, host="0.0.0.0", port=5000)
\ No newline at end of file
+    app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import tracemalloc
+
+
+SAMARA = "Samara da Silva de Souza Rodrigues"
+
+# Cenarios de testes.txt. Os filtros sao os mesmos usados em '/filter' e `filtrar_pacientes`.
+FILTROS_CENARIOS = {
+    "TESTE 3": {"idade_min": 16, "idade_max": 75},
+    "TESTE 4": {"convenios": ["Bradesco Saúde", "Agros"]},
+    "TESTE 5": {"profissionais": [SAMARA]},
+    "TESTE 6": {"convenios": ["Não Informado"], "profissionais": [SAMARA]},
+    "TESTE 7": {"idade_min": 10, "idade_max": 45, "convenios": ["Agros", "Bradesco Saúde", "Não Informado"],
+                "profissionais": [SAMARA]},
+}
+BUSCAS_CENARIOS = {
+    "TESTE 3": "Buscar filtro por idade do range [16 - 75]",
+    "TESTE 4": "Buscar por filtro Bradesco Saude + Agros",
+    "TESTE 5": f"Buscar por paciente atendido pela medica {SAMARA}",
+}
+PERGUNTAS_CENARIOS = {
+    "TESTE 1": ("918452", "Faca um resumo da ficha medica desse paciente"),
+    "TESTE 9": ("9866408", "Faca um resumo"),
+}
+GRAFICOS_CENARIOS = {
+    "TESTE 2": ("1007951", "Plote um grafico do numero de consultas de um paciente por mes"),
+    "TESTE 8": ("1007951", "plote um grafico avaliando a variacao do IMC desse paciente em cada data"),
+}
+
+
+def _preparar_ambiente(args, servidor):
+    """
+    Aponta a aplicacao para o servidor falso da OpenAI e para caches temporarios.
+    Precisa rodar antes de importar `app`.
+    """
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{servidor.server_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("ADMIN_CRED", "bench")
+    os.environ.setdefault("ADMIN_SENHA", "bench")
+    diretorio = tempfile.mkdtemp(prefix="bench-")
+    os.environ["CACHE_RESPOSTAS_DB"] = os.path.join(diretorio, "respostas.sqlite3")
+    os.environ["CACHE_GRAFICOS_DIR"] = os.path.join(diretorio, "graficos")
+    os.environ["EXPORTACOES_DIR"] = os.path.join(diretorio, "exportacoes")
+
+
+def _cliente(app_modulo):
+    cliente = app_modulo.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao["user"] = "bench"
+    return cliente
+
+
+def _verificar(resposta):
+    if resposta.status_code >= 400:
+        raise RuntimeError(f"HTTP {resposta.status_code}: {resposta.get_data(as_text=True)[:200]}")
+    return resposta
+
+
+def montar_cenarios(args):
+    """
+    Monta a lista de cenarios: (nome, funcao(cliente, repeticao)). Cada funcao executa
+    uma operacao completa; sem --com-cache, as perguntas e graficos variam a cada
+    repeticao para nao serem respondidos pelos caches.
+    """
+    import app as app_modulo
+    from db.models import filtrar_pacientes, buscar_jornada_por_id
+    from ia.contexto import COLUNAS_CONTEXTO, LIMITE_EVENTOS_CONTEXTO
+
+    def variar(texto, repeticao, cenario):
+        # O nome do cenario entra no texto para que um cenario nao aproveite o cache de outro.
+        return texto if args.com_cache else f"{texto} ({cenario} #{repeticao})"
+
+    cenarios = []
+    if "funcoes" in args.grupos:
+        for teste, (pid, _) in {**PERGUNTAS_CENARIOS, **GRAFICOS_CENARIOS}.items():
+            cenarios.append((f"buscar_jornada_por_id {teste} ({pid})", lambda c, r, pid=pid: buscar_jornada_por_id(
+                pid, colunas=COLUNAS_CONTEXTO, limite=LIMITE_EVENTOS_CONTEXTO)))
+        for teste, filtros in FILTROS_CENARIOS.items():
+            cenarios.append((f"filtrar_pacientes {teste}", lambda c, r, filtros=filtros: filtrar_pacientes(
+                **filtros, limite=app_modulo.LIMITE_PAGINA_FILTRO + 1)))
+
+    if "rotas" in args.grupos:
+        for teste, (pid, pergunta) in PERGUNTAS_CENARIOS.items():
+            cenarios.append((f"POST /prompt {teste}", lambda c, r, pid=pid, pergunta=pergunta, teste=teste: _verificar(
+                c.post("/prompt", json={"patient_id": pid, "prompt": variar(pergunta, r, f"prompt {teste}")}))))
+            cenarios.append((f"POST /prompt/stream {teste}", lambda c, r, pid=pid, pergunta=pergunta, teste=teste: _verificar(
+                c.post("/prompt/stream", json={"patient_id": pid, "prompt": variar(pergunta, r, f"stream {teste}")})).get_data()))
+
+        def grafico(c, r, teste, pid, pergunta):
+            codigo = _verificar(c.post("/prompt", json={"patient_id": pid, "prompt": variar(pergunta, r, teste)})).get_json()["resposta"]
+            if not args.com_cache:
+                # Uma linha a mais muda o hash do codigo, evitando o cache de imagens.
+                codigo = codigo.replace("```python", f"```python\n_repeticao = '{teste} #{r}'")
+            return _verificar(c.post("/plot", json={"patient_id": pid, "code": codigo, "formato": "png"}))
+
+        for teste, (pid, pergunta) in GRAFICOS_CENARIOS.items():
+            cenarios.append((f"/prompt + /plot {teste}", lambda c, r, teste=teste, pid=pid, pergunta=pergunta: grafico(
+                c, r, teste, pid, pergunta)))
+        for teste, filtros in FILTROS_CENARIOS.items():
+            cenarios.append((f"POST /filter {teste}", lambda c, r, filtros=filtros: _verificar(c.post("/filter", json=filtros))))
+        for teste, busca in BUSCAS_CENARIOS.items():
+            cenarios.append((f"POST /parse-filter {teste}", lambda c, r, busca=busca, teste=teste: _verificar(
+                c.post("/parse-filter", json={"query": variar(busca, r, teste)}))))
+
+    if args.cenario:
+        cenarios = [(nome, funcao) for nome, funcao in cenarios if args.cenario.lower() in nome.lower()]
+    return app_modulo, cenarios
+
+
+def _percentil(valores: list, p: float):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[indice]
+
+
+def medir_cenario(app_modulo, funcao, repeticoes: int, concorrencia: int, aquecimento: int, memoria: bool):
+    """
+    Executa um cenario `repeticoes` vezes, divididas entre `concorrencia` threads.
+
+    Returns:
+        dict: Latencias (ms), vazao (operacoes/s), erros e pico de memoria alocada (MB).
+    """
+    cliente = _cliente(app_modulo)
+    for i in range(aquecimento):
+        funcao(cliente, -1 - i)
+
+    latencias, erros = [], []
+    lock = threading.Lock()
+    proxima = iter(range(repeticoes))
+
+    def trabalhar():
+        cliente_thread = _cliente(app_modulo)
+        while True:
+            with lock:
+                repeticao = next(proxima, None)
+            if repeticao is None:
+                return
+            inicio = time.perf_counter()
+            try:
+                funcao(cliente_thread, repeticao)
+            except Exception as e:
+                with lock:
+                    erros.append(str(e))
+                continue
+            with lock:
+                latencias.append(time.perf_counter() - inicio)
+
+    if memoria:
+        tracemalloc.start()
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=trabalhar) for _ in range(concorrencia)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+    pico = None
+    if memoria:
+        pico = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    resultado = {"n": len(latencias), "erros": len(erros), "vazao": len(latencias) / duracao if duracao else 0.0,
+                 "pico_mb": pico}
+    if latencias:
+        resultado.update(
+            p50_ms=_percentil(latencias, 50) * 1000,
+            p95_ms=_percentil(latencias, 95) * 1000,
+            max_ms=max(latencias) * 1000,
+        )
+    if erros:
+        resultado["primeiro_erro"] = erros[0]
+    return resultado
+
+
+def _rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Windows: sem getrusage.
+        return float("nan")
+    # ru_maxrss e em KB no Linux e em bytes no macOS.
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+def imprimir(resultados: dict):
+    cabecalho = f"{'cenario':<48} {'n':>4} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'op/s':>8} {'pico MB':>8}"
+    print(cabecalho)
+    print("-" * len(cabecalho))
+    for nome, r in resultados.items():
+        pico = f"{r['pico_mb']:.1f}" if r.get("pico_mb") is not None else "-"
+        print(f"{nome[:48]:<48} {r['n']:>4} {r['erros']:>4} {r.get('p50_ms', 0):>9.1f} {r.get('p95_ms', 0):>9.1f} "
+              f"{r.get('max_ms', 0):>9.1f} {r['vazao']:>8.1f} {pico:>8}")
+
+
+def comparar(resultados: dict, base: dict, tolerancia: float):
+    """
+    Compara o p95 de cada cenario com uma execucao anterior.
+
+    Returns:
+        list: Descricao dos cenarios que ficaram mais lentos que a tolerancia.
+    """
+    regressoes = []
+    for nome, r in resultados.items():
+        anterior = base.get(nome)
+        if not anterior or "p95_ms" not in anterior or "p95_ms" not in r:
+            continue
+        if r["p95_ms"] > anterior["p95_ms"] * (1 + tolerancia):
+            regressoes.append(f"{nome}: p95 {anterior['p95_ms']:.1f} ms -> {r['p95_ms']:.1f} ms")
+    return regressoes
+
+
+def main():
+    # Executa os cenarios de testes.txt contra um banco local (ver bench.gerar_dados) e um
+    # servidor falso da OpenAI, e mede latencia, vazao e memoria:
+    #     python -m bench.executar --repeticoes 50 --concorrencia 4 --saida bench.json
+    #     python -m bench.executar --comparar bench.json
+    parser = argparse.ArgumentParser(description="Benchmark dos cenarios de testes.txt.")
+    parser.add_argument("--repeticoes", type=int, default=20)
+    parser.add_argument("--concorrencia", type=int, default=1)
+    parser.add_argument("--aquecimento", type=int, default=2)
+    parser.add_argument("--grupos", nargs="+", default=["funcoes", "rotas"], choices=["funcoes", "rotas"])
+    parser.add_argument("--cenario", help="Executa apenas os cenarios cujo nome contem este texto.")
+    parser.add_argument("--com-cache", action="store_true", help="Repete perguntas e graficos identicos (caches quentes).")
+    parser.add_argument("--memoria", action="store_true", help="Mede o pico de memoria alocada (tracemalloc, mais lento).")
+    parser.add_argument("--latencia-ia", type=float, default=0.05, help="Latencia simulada da OpenAI, em segundos.")
+    parser.add_argument("--saida", help="Grava os resultados em JSON.")
+    parser.add_argument("--comparar", help="JSON de uma execucao anterior; falha se algum p95 piorar alem da tolerancia.")
+    parser.add_argument("--tolerancia", type=float, default=0.2)
+    args = parser.parse_args()
+
+    from bench.openai_falso import iniciar_servidor
+    servidor = iniciar_servidor(latencia=args.latencia_ia)
+    _preparar_ambiente(args, servidor)
+    app_modulo, cenarios = montar_cenarios(args)
+
+    resultados = {}
+    for nome, funcao in cenarios:
+        resultados[nome] = medir_cenario(app_modulo, funcao, args.repeticoes, args.concorrencia,
+                                         args.aquecimento, args.memoria)
+        if resultados[nome].get("primeiro_erro"):
+            print(f"{nome}: {resultados[nome]['primeiro_erro']}", file=sys.stderr)
+
+    imprimir(resultados)
+    print(f"\nChamadas ao servidor falso da OpenAI: {servidor.chamadas}; pico de RSS do processo: {_rss_mb():.0f} MB")
+    servidor.shutdown()
+
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            regressoes = comparar(resultados, json.load(f), args.tolerancia)
+        if regressoes:
+            print("\nRegressoes:\n" + "\n".join(regressoes))
+            sys.exit(1)
+        print("\nNenhuma regressao acima da tolerancia.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import io
+import math
+import random
+import argparse
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+from db.conexao import transacao, obter_engine
+
+
+# Pacientes usados nos cenarios de testes.txt; sempre existem na base gerada.
+PACIENTES_CENARIOS = ("918452", "1007951", "9866408")
+# Profissional com a maior parte dos atendimentos (TESTE 5: ~28 mil atendimentos).
+PROFISSIONAL_DOMINANTE = "Samara da Silva de Souza Rodrigues"
+
+CONVENIOS = ("Agros", "Bradesco Saúde", "Não Informado", "Unimed", "Amil", "SulAmérica", "Particular")
+CONJUNTOS = ("Consulta", "Exame Laboratorial", "Exame de Imagem", "Prescrição", "Evolução", "Triagem", "Internação")
+FONTES = ("prontuario", "laboratorio", "faturamento")
+NOMES = ("Ana", "Carlos", "Beatriz", "João", "Mariana", "Pedro", "Fernanda", "Lucas", "Juliana", "Rafael")
+SOBRENOMES = ("Silva", "Souza", "Oliveira", "Santos", "Pereira", "Costa", "Almeida", "Rodrigues", "Lima", "Gomes")
+DESCRICOES = (
+    "Paciente com hipertensão arterial, PA {pa}/{pd} mmHg",
+    "IMC: {imc} kg/m2, peso {peso} kg",
+    "Glicemia de jejum {glicemia} mg/dL",
+    "Paciente relata dor lombar há {dias} dias",
+    "Retorno para avaliação de exames, sem queixas",
+    "Diabetes mellitus tipo 2 em acompanhamento, HbA1c {hba1c}%",
+    "Prescrito losartana 50mg 1x ao dia",
+    "Hemograma sem alterações significativas",
+    "Queixa de cefaleia e tontura, orientado repouso",
+    "Vacinação em dia, orientações gerais de saúde",
+)
+
+
+def _profissionais(quantidade: int):
+    """Lista de profissionais; o primeiro e o dominante."""
+    nomes = [PROFISSIONAL_DOMINANTE]
+    while len(nomes) < quantidade:
+        nomes.append(f"{random.choice(NOMES)} {random.choice(SOBRENOMES)} {len(nomes)}")
+    return nomes
+
+
+def _descricao():
+    return random.choice(DESCRICOES).format(
+        pa=random.randint(100, 180), pd=random.randint(60, 110), imc=round(random.uniform(17, 40), 1),
+        peso=random.randint(45, 130), glicemia=random.randint(70, 250), dias=random.randint(1, 30),
+        hba1c=round(random.uniform(5, 11), 1),
+    )
+
+
+def _limpar(valor: str):
+    """Escapa um texto para o formato texto do COPY."""
+    return valor.replace("\\", "\\\\").replace("\t", " ").replace("\n", " ")
+
+
+def gerar_linhas(pacientes: int, eventos_por_paciente: int, profissionais: int, fracao_dominante: float,
+                 inicio: date, fim: date):
+    """
+    Gera os eventos de todos os pacientes, no formato texto do COPY.
+
+    A quantidade de eventos por paciente segue uma distribuicao log-normal (poucos
+    pacientes com muitos eventos) e `fracao_dominante` dos eventos e atribuida ao
+    profissional dominante.
+
+    Yields:
+        str: Uma linha por evento.
+    """
+    nomes_profissionais = _profissionais(profissionais)
+    ids = list(PACIENTES_CENARIOS)
+    vistos = set(ids)
+    while len(ids) < pacientes:
+        candidato = str(random.randint(100000, 99999999))
+        if candidato not in vistos:
+            vistos.add(candidato)
+            ids.append(candidato)
+    dias_periodo = (fim - inicio).days
+
+    for pid in ids[:pacientes]:
+        nascimento = date.today() - timedelta(days=random.randint(0, 95 * 365))
+        cpf = f"{random.randint(0, 99999999999):011d}"
+        convenios = random.sample(CONVENIOS, k=random.randint(1, 2))
+        quantidade = max(1, int(random.lognormvariate(math.log(eventos_por_paciente), 0.8)))
+        for _ in range(quantidade):
+            data = datetime.combine(inicio, datetime.min.time()) + timedelta(
+                days=random.randint(0, dias_periodo), minutes=random.randint(7 * 60, 19 * 60)
+            )
+            if random.random() < fracao_dominante:
+                profissional = PROFISSIONAL_DOMINANTE
+            else:
+                profissional = random.choice(nomes_profissionais[1:] or nomes_profissionais)
+            yield "\t".join([
+                pid, cpf, data.isoformat(sep=" "), _limpar(_descricao()), random.choice(CONJUNTOS),
+                profissional, random.choice(convenios), random.choice(FONTES), nascimento.isoformat(),
+            ]) + "\n"
+
+
+def criar_tabela(substituir: bool):
+    """
+    Cria o schema e a tabela mpiv02.events. Recusa apagar uma tabela com dados
+    sem `substituir`, para evitar acidentes com um banco real.
+    """
+    with transacao() as conn:
+        conn.execute(text("CREATE SCHEMA IF NOT EXISTS mpiv02"))
+        existe = conn.execute(text("SELECT to_regclass('mpiv02.events') IS NOT NULL")).scalar()
+        if existe:
+            tem_dados = conn.execute(text("SELECT EXISTS (SELECT 1 FROM mpiv02.events)")).scalar()
+            if tem_dados and not substituir:
+                raise SystemExit("mpiv02.events ja tem dados. Use --substituir para recria-la (apenas em um banco de teste).")
+            # Tabelas derivadas dos eventos tambem sao refeitas.
+            for tabela in ("pacientes_resumo", "pacientes_resumo_controle", "eventos_rollup_mensal",
+                           "pacientes_versao", "eventos_alteracoes", "ingestao_consumidores"):
+                conn.execute(text(f"DROP TABLE IF EXISTS mpiv02.{tabela}"))
+            conn.execute(text("DROP TABLE mpiv02.events"))
+        conn.execute(text("""
+            CREATE TABLE mpiv02.events (
+                id_paciente varchar,
+                cpf varchar,
+                data timestamp,
+                descricao text,
+                conjunto varchar,
+                nome_profissional varchar,
+                nome_convenio varchar,
+                fonte varchar,
+                data_nascimento date
+            )
+        """))
+
+
+def carregar(linhas, tamanho_bloco: int = 50000):
+    """
+    Copia as linhas para mpiv02.events com COPY, em blocos.
+
+    Returns:
+        int: Quantidade de eventos inseridos.
+    """
+    total = 0
+    conexao = obter_engine("manutencao").raw_connection()
+    try:
+        cursor = conexao.cursor()
+        bloco = []
+        for linha in linhas:
+            bloco.append(linha)
+            if len(bloco) >= tamanho_bloco:
+                cursor.copy_expert("COPY mpiv02.events FROM STDIN", io.StringIO("".join(bloco)))
+                total += len(bloco)
+                bloco = []
+        if bloco:
+            cursor.copy_expert("COPY mpiv02.events FROM STDIN", io.StringIO("".join(bloco)))
+            total += len(bloco)
+        conexao.commit()
+    finally:
+        conexao.close()
+    return total
+
+
+def preparar_estruturas():
+    """
+    Cria os indices e as tabelas derivadas usados pela aplicacao, como em producao.
+    """
+    from db.models import criar_indices
+    from db import resumo_pacientes, coorte
+
+    criar_indices()
+    resumo_pacientes.criar_estruturas()
+    resumo_pacientes.reconstruir_resumo()
+    coorte.criar_rollup()
+    coorte.reconstruir_rollup()
+    with transacao() as conn:
+        conn.execute(text("ANALYZE mpiv02.events"))
+
+
+def main():
+    # Gera uma tabela mpiv02.events sintetica para os benchmarks (ver bench.executar), com
+    # DB_* apontando para um Postgres local, NUNCA para o banco de producao:
+    #     python -m bench.gerar_dados --pacientes 5000 --eventos-por-paciente 200 --substituir
+    parser = argparse.ArgumentParser(description="Gera uma tabela mpiv02.events sintetica.")
+    parser.add_argument("--pacientes", type=int, default=2000)
+    parser.add_argument("--eventos-por-paciente", type=int, default=100, help="Mediana de eventos por paciente.")
+    parser.add_argument("--profissionais", type=int, default=300)
+    parser.add_argument("--fracao-dominante", type=float, default=0.15,
+                        help=f"Fracao dos eventos atendidos por {PROFISSIONAL_DOMINANTE}.")
+    parser.add_argument("--inicio", type=date.fromisoformat, default=date(2015, 1, 1))
+    parser.add_argument("--fim", type=date.fromisoformat, default=date.today())
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--substituir", action="store_true", help="Recria a tabela se ela ja tiver dados.")
+    parser.add_argument("--sem-estruturas", action="store_true", help="Nao cria indices nem tabelas derivadas.")
+    args = parser.parse_args()
+
+    random.seed(args.semente)
+    criar_tabela(args.substituir)
+    total = carregar(gerar_linhas(args.pacientes, args.eventos_por_paciente, args.profissionais,
+                                  args.fracao_dominante, args.inicio, args.fim))
+    print(f"Eventos gerados: {total}")
+    if not args.sem_estruturas:
+        preparar_estruturas()
+        print("Indices e tabelas derivadas criados.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+# Modulos pesados que nao deveriam ser carregados so por importar a aplicacao.
+MODULOS_PESADOS = ("openai", "numpy", "pandas", "matplotlib", "pyarrow", "tiktoken")
+
+# Executado em um processo novo: importa a aplicacao e, opcionalmente, atende uma
+# primeira requisicao, medindo o tempo e a memoria residente (RSS) de cada etapa.
+_SCRIPT = """
+import json, resource, sys, time
+
+def rss_mb():
+    # ru_maxrss e o pico de RSS (em KB no Linux); /proc da o valor atual quando existe.
+    try:
+        with open("/proc/self/status") as f:
+            for linha in f:
+                if linha.startswith("VmRSS:"):
+                    return int(linha.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+resultado = {"rss_inicial_mb": rss_mb()}
+inicio = time.perf_counter()
+import app as modulo
+resultado["importacao_s"] = time.perf_counter() - inicio
+resultado["rss_importacao_mb"] = rss_mb()
+resultado["modulos_pesados"] = [m for m in MODULOS if m in sys.modules]
+
+if REQUISICAO:
+    cliente = modulo.app.test_client()
+    inicio = time.perf_counter()
+    resposta = cliente.get("/login")
+    resultado["primeira_requisicao_s"] = time.perf_counter() - inicio
+    resultado["status"] = resposta.status_code
+    resultado["rss_requisicao_mb"] = rss_mb()
+print("RESULTADO " + json.dumps(resultado))
+"""
+
+
+def medir_processo(requisicao: bool):
+    """
+    Importa app.py em um processo novo (com -X importtime) e retorna as medidas
+    e o tempo acumulado de cada modulo importado.
+
+    Returns:
+        tuple: (dict com as medidas, lista de (segundos acumulados, modulo)).
+    """
+    script = _SCRIPT.replace("MODULOS", repr(MODULOS_PESADOS)).replace("REQUISICAO", repr(requisicao))
+    processo = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    linha = next((l for l in processo.stdout.splitlines() if l.startswith("RESULTADO ")), None)
+    if processo.returncode != 0 or linha is None:
+        raise SystemExit(f"Falha ao importar a aplicacao:\n{processo.stdout}\n{processo.stderr[-4000:]}")
+
+    modulos = []
+    for l in processo.stderr.splitlines():
+        # Formato: "import time: <proprio us> | <acumulado us> | <modulo>"
+        partes = l.split("|")
+        if not l.startswith("import time:") or len(partes) != 3 or not partes[1].strip().isdigit():
+            continue
+        nome = partes[2].rstrip()
+        # Modulos de primeiro nivel e os importados diretamente por eles (ex.: os de app.py).
+        if len(nome) - len(nome.lstrip()) <= 3:
+            modulos.append((int(partes[1]) / 1e6, nome.strip()))
+    return json.loads(linha[len("RESULTADO "):]), sorted(modulos, reverse=True)
+
+
+def main():
+    # Relatorio do custo de iniciar um worker (importar app.py e a primeira requisicao):
+    #     python -m bench.inicializacao --repeticoes 5
+    parser = argparse.ArgumentParser(description="Mede o tempo de importacao e a memoria de um worker da aplicacao.")
+    parser.add_argument("--repeticoes", type=int, default=3, help="Processos medidos (usa a mediana).")
+    parser.add_argument("--top", type=int, default=15, help="Modulos mais lentos listados.")
+    parser.add_argument("--sem-requisicao", action="store_true", help="Nao mede a primeira requisicao.")
+    parser.add_argument("--saida", help="Arquivo JSON para guardar as medidas.")
+    args = parser.parse_args()
+
+    medidas, modulos = [], []
+    for _ in range(args.repeticoes):
+        resultado, modulos = medir_processo(not args.sem_requisicao)
+        medidas.append(resultado)
+
+    def mediana(chave):
+        valores = sorted(m[chave] for m in medidas if chave in m)
+        return valores[len(valores) // 2] if valores else None
+
+    resumo = {chave: mediana(chave) for chave in (
+        "importacao_s", "rss_inicial_mb", "rss_importacao_mb", "primeira_requisicao_s", "rss_requisicao_mb")}
+    resumo["modulos_pesados"] = medidas[-1]["modulos_pesados"]
+
+    print(f"Importacao de app.py: {resumo['importacao_s'] * 1000:.0f} ms (mediana de {len(medidas)} processos)")
+    print(f"RSS: {resumo['rss_inicial_mb']:.0f} MB no inicio, {resumo['rss_importacao_mb']:.0f} MB apos importar")
+    if resumo["primeira_requisicao_s"] is not None:
+        print(f"Primeira requisicao (GET /login): {resumo['primeira_requisicao_s'] * 1000:.0f} ms, "
+              f"RSS {resumo['rss_requisicao_mb']:.0f} MB")
+    print(f"Modulos pesados carregados: {', '.join(resumo['modulos_pesados']) or 'nenhum'}")
+    print("\nModulos mais lentos de importar (ultimo processo):")
+    for segundos, nome in modulos[:args.top]:
+        print(f"  {segundos * 1000:8.1f} ms  {nome}")
+
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump({"resumo": resumo, "medidas": medidas}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import json
+import time
+import socket
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Respostas fixas do servidor falso, escolhidas pelo conteudo da pergunta.
+CODIGO_GRAFICO = """```python
+contagem = df.groupby(df['data'].dt.to_period('M')).size()
+plt.bar([str(p) for p in contagem.index], contagem.values)
+plt.xticks(rotation=90)
+plt.title('Eventos por mes')
+```"""
+RESPOSTA_TEXTO = (
+    "## Resumo\n\nPaciente em acompanhamento ambulatorial, com consultas regulares, "
+    "exames laboratoriais dentro do esperado e sem intercorrencias registradas.\n"
+)
+FILTRO_JSON = {"idade_min": 16, "idade_max": 75, "convenios": [], "profissionais": [], "conjuntos": [], "termos_busca": []}
+
+
+def _estimar_tokens(texto: str):
+    return max(1, len(texto) // 4)
+
+
+class _Manipulador(BaseHTTPRequestHandler):
+    """
+    Atende POST /v1/chat/completions no formato da API da OpenAI (com e sem stream).
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Sem o algoritmo de Nagle: cabecalhos e corpo saem na hora, sem somar ~40 ms de ACK atrasado.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, formato, *args):
+        pass
+
+    def do_POST(self):
+        tamanho = int(self.headers.get("Content-Length") or 0)
+        corpo = json.loads(self.rfile.read(tamanho) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        servidor = self.server
+        with servidor.lock:
+            servidor.chamadas += 1
+        mensagens = corpo.get("messages", [])
+        entrada = "\n".join(str(m.get("content", "")) for m in mensagens)
+        if corpo.get("response_format", {}).get("type") == "json_object":
+            resposta = json.dumps(FILTRO_JSON)
+        elif "grafico" in entrada.lower().split("pergunta:")[-1]:
+            resposta = CODIGO_GRAFICO
+        else:
+            resposta = RESPOSTA_TEXTO
+        uso = {
+            "prompt_tokens": _estimar_tokens(entrada),
+            "completion_tokens": _estimar_tokens(resposta),
+            "total_tokens": _estimar_tokens(entrada) + _estimar_tokens(resposta),
+        }
+
+        # Latencia simulada ate o primeiro token (em stream, tambem entre os trechos).
+        time.sleep(servidor.latencia)
+        if corpo.get("stream"):
+            self._responder_stream(corpo, resposta, uso)
+        else:
+            self._responder_json({
+                "id": "chatcmpl-falso", "object": "chat.completion", "created": int(time.time()),
+                "model": corpo.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": resposta}}],
+                "usage": uso,
+            })
+
+    def _responder_json(self, dados: dict):
+        conteudo = json.dumps(dados).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(conteudo)))
+        self.end_headers()
+        self.wfile.write(conteudo)
+
+    def _responder_stream(self, corpo: dict, resposta: str, uso: dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        base = {"id": "chatcmpl-falso", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": corpo.get("model")}
+        palavras = resposta.split(" ")
+        for i, palavra in enumerate(palavras):
+            texto = palavra if i == 0 else " " + palavra
+            trecho = {**base, "choices": [{"index": 0, "delta": {"content": texto}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(trecho)}\n\n".encode("utf-8"))
+            time.sleep(self.server.latencia_token)
+        if (corpo.get("stream_options") or {}).get("include_usage"):
+            self.wfile.write(f"data: {json.dumps({**base, 'choices': [], 'usage': uso})}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+def iniciar_servidor(porta: int = 0, latencia: float = 0.05, latencia_token: float = 0.0):
+    """
+    Inicia um servidor local que imita a API de chat da OpenAI, em uma thread.
+
+    Args:
+        porta (int, optional): Porta local (0 escolhe uma livre).
+        latencia (float, optional): Segundos de espera antes de cada resposta.
+        latencia_token (float, optional): Segundos entre os trechos de uma resposta em stream.
+
+    Returns:
+        ThreadingHTTPServer: O servidor; a URL para OPENAI_BASE_URL e
+            f"http://127.0.0.1:{servidor.server_port}/v1" e `servidor.chamadas` conta as chamadas.
+    """
+    servidor = ThreadingHTTPServer(("127.0.0.1", porta), _Manipulador)
+    servidor.daemon_threads = True
+    servidor.latencia = latencia
+    servidor.latencia_token = latencia_token
+    servidor.chamadas = 0
+    servidor.lock = threading.Lock()
+    threading.Thread(target=servidor.serve_forever, name="openai-falso", daemon=True).start()
+    return servidor
@@ -0,0 +1,209 @@
+import re
+import unicodedata
+from sqlalchemy import text
+
+from db.conexao import conectar, transacao
+
+
+# Configuracoes de busca textual criadas por `criar_estruturas`. Ambas removem acentos;
+# a primeira tambem reduz as palavras ao radical (stemming em portugues).
+CONFIG_COM_STEMMING = "mpiv02.pt_unaccent"
+CONFIG_SEM_STEMMING = "mpiv02.simples_unaccent"
+
+# Expressao indexada para a busca por trigramas: descricao sem acentos e em minusculas.
+EXPRESSAO_TRIGRAMA = "mpiv02.f_unaccent(lower(descricao))"
+
+MODOS_BUSCA = ("trigrama", "texto", "ilike")
+
+# Modos de busca cujas estruturas (funcao, configuracoes e indices) ja foram encontradas no banco.
+_modos_encontrados = {"ilike"}
+
+
+def criar_estruturas(incluir_texto_completo: bool = True):
+    """
+    Cria as extensoes, a funcao de remocao de acentos e os indices usados pela busca
+    de termos clinicos. Pode ser executada varias vezes.
+
+    Args:
+        incluir_texto_completo (bool): Se True, tambem cria as configuracoes e os
+            indices tsvector usados pelo modo "texto".
+    """
+    with transacao() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS unaccent"))
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        # unaccent() nao e IMMUTABLE, entao nao pode ser usada diretamente em um indice.
+        conn.execute(text("""
+            CREATE OR REPLACE FUNCTION mpiv02.f_unaccent(text) RETURNS text
+            LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+            AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$
+        """))
+        conn.execute(text(f"""
+            CREATE INDEX IF NOT EXISTS events_descricao_trgm_idx
+            ON mpiv02.events USING GIN ({EXPRESSAO_TRIGRAMA} gin_trgm_ops)
+        """))
+
+        if not incluir_texto_completo:
+            return
+
+        for config, base in ((CONFIG_COM_STEMMING, "portuguese"), (CONFIG_SEM_STEMMING, "simple")):
+            nome = config.split(".")[1]
+            dicionario = "portuguese_stem" if base == "portuguese" else "simple"
+            conn.execute(text(f"""
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = '{nome}') THEN
+                        CREATE TEXT SEARCH CONFIGURATION {config} (COPY = {base});
+                        ALTER TEXT SEARCH CONFIGURATION {config}
+                            ALTER MAPPING FOR hword, hword_part, word WITH unaccent, {dicionario};
+                    END IF;
+                END $$
+            """))
+            conn.execute(text(f"""
+                CREATE INDEX IF NOT EXISTS events_descricao_{nome}_idx
+                ON mpiv02.events USING GIN (to_tsvector('{config}'::regconfig, descricao))
+            """))
+
+
+def estruturas_disponiveis(modo: str = "trigrama"):
+    """
+    Verifica se as estruturas de um modo de busca ja existem: a funcao
+    mpiv02.f_unaccent (e portanto o indice de trigramas) para "trigrama", e as duas
+    configuracoes de busca textual para "texto" (`criar_estruturas` pode ter sido
+    executada sem elas). "ilike" nao depende de nenhuma estrutura.
+    O resultado positivo fica guardado para nao repetir a consulta a cada filtro.
+
+    Returns:
+        bool: True se o modo puder ser usado.
+    """
+    if modo in _modos_encontrados:
+        return True
+    with conectar() as conn:
+        if modo == "trigrama":
+            existe = conn.execute(text("SELECT to_regprocedure('mpiv02.f_unaccent(text)') IS NOT NULL")).scalar()
+        elif modo == "texto":
+            nomes = [config.split(".")[1] for config in (CONFIG_COM_STEMMING, CONFIG_SEM_STEMMING)]
+            existe = conn.execute(text("""
+                SELECT COUNT(*) = :total
+                FROM pg_ts_config c JOIN pg_namespace n ON n.oid = c.cfgnamespace
+                WHERE n.nspname = 'mpiv02' AND c.cfgname = ANY(:nomes)
+            """), {"nomes": nomes, "total": len(nomes)}).scalar()
+        else:
+            existe = False
+    if existe:
+        _modos_encontrados.add(modo)
+    return bool(existe)
+
+
+def escolher_modo_busca(modo: str = None):
+    """
+    Retorna o modo de busca a usar: o pedido, se suas estruturas existirem; senao
+    (ou sem modo pedido), "trigrama" ou, sem o indice de trigramas, "ilike".
+    """
+    if modo is not None and modo not in MODOS_BUSCA:
+        raise ValueError(f"Modo de busca invalido: {modo}")
+    if modo is not None and estruturas_disponiveis(modo):
+        return modo
+    if modo is not None:
+        print(f"Modo de busca '{modo}' indisponivel no banco (execute python -m db.busca_texto); usando outro modo.")
+    return "trigrama" if estruturas_disponiveis("trigrama") else "ilike"
+
+
+def normalizar_texto(texto: str):
+    """
+    Remove acentos, converte para minusculas e colapsa espacos.
+    Ex.: "  Hipertensão  Arterial" -> "hipertensao arterial".
+    """
+    decomposto = unicodedata.normalize("NFKD", texto or "")
+    sem_acentos = "".join(c for c in decomposto if not unicodedata.combining(c))
+    return " ".join(sem_acentos.lower().split())
+
+
+def _escapar_like(termo: str):
+    """
+    Escapa os caracteres curinga do LIKE para que o termo seja buscado literalmente.
+    """
+    return termo.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _consulta_tsquery(termo: str, prefixo: bool):
+    """
+    Converte um termo (uma ou mais palavras) em uma expressao to_tsquery em que
+    todas as palavras precisam aparecer. Caracteres especiais sao descartados.
+    """
+    palavras = re.findall(r"\w+", normalizar_texto(termo))
+    sufixo = ":*" if prefixo else ""
+    return " & ".join(f"{p}{sufixo}" for p in palavras)
+
+
+def montar_busca_termos(termos_busca: list, modo: str = "trigrama", prefixo: bool = True, stemming: bool = False):
+    """
+    Monta uma subconsulta que resolve todos os termos em uma unica passada sobre
+    mpiv02.events, retornando os pacientes que possuem eventos com TODOS os termos
+    (cada termo pode aparecer em um evento diferente) e uma relevancia por paciente.
+
+    Modos:
+        - "trigrama": busca por substring sem acento/caixa, atendida pelo indice de trigramas.
+        - "texto": busca por palavras (tsvector), com stemming e prefixo opcionais.
+        - "ilike": busca por substring sem indice, usada quando as estruturas nao existem.
+
+    Args:
+        termos_busca (list): Termos clinicos informados pelo usuario.
+        modo (str): Um dos modos acima.
+        prefixo (bool): No modo "texto", aceita palavras que comecem com o termo.
+        stemming (bool): No modo "texto", compara pelo radical das palavras.
+
+    Returns:
+        tuple: O SQL da subconsulta (colunas id_paciente e relevancia) e seus parametros,
+               ou (None, {}) se nenhum termo valido for informado.
+    """
+    if modo not in MODOS_BUSCA:
+        raise ValueError(f"Modo de busca invalido: {modo}")
+
+    params = {}
+    condicoes = []
+
+    if modo == "texto":
+        config = CONFIG_COM_STEMMING if stemming else CONFIG_SEM_STEMMING
+        vetor = f"to_tsvector('{config}'::regconfig, descricao)"
+        for i, termo in enumerate(termos_busca or []):
+            consulta = _consulta_tsquery(termo, prefixo)
+            if not consulta:
+                continue
+            params[f"termo_{i}"] = consulta
+            condicoes.append(f"{vetor} @@ to_tsquery('{config}'::regconfig, :termo_{i})")
+        if not condicoes:
+            return None, {}
+        params["termos_todos"] = " | ".join(f"({params[f'termo_{i}']})" for i in range(len(termos_busca)) if f"termo_{i}" in params)
+        relevancia = f"SUM(ts_rank({vetor}, to_tsquery('{config}'::regconfig, :termos_todos)))"
+    else:
+        if modo == "trigrama":
+            expressao, operador = EXPRESSAO_TRIGRAMA, "LIKE"
+        else:
+            expressao, operador = "descricao", "ILIKE"
+        for i, termo in enumerate(termos_busca or []):
+            termo_normalizado = normalizar_texto(termo) if modo == "trigrama" else (termo or "").strip()
+            if not termo_normalizado:
+                continue
+            params[f"termo_{i}"] = f"%{_escapar_like(termo_normalizado)}%"
+            condicoes.append(f"{expressao} {operador} :termo_{i}")
+        if not condicoes:
+            return None, {}
+        # Relevancia: quantidade de eventos do paciente que mencionam algum dos termos.
+        relevancia = "COUNT(*)"
+
+    # O OR entre os termos permite que o indice seja usado (BitmapOr) em uma unica passada;
+    # o HAVING garante que cada termo apareca em pelo menos um evento do paciente.
+    sql = f"""
+        SELECT id_paciente, {relevancia} AS relevancia
+        FROM mpiv02.events
+        WHERE {' OR '.join(f'({c})' for c in condicoes)}
+        GROUP BY id_paciente
+        HAVING {' AND '.join(f'bool_or({c})' for c in condicoes)}
+    """
+    return sql, params
+
+
+if __name__ == '__main__':
+    # Cria as estruturas de busca: python -m db.busca_texto
+    criar_estruturas()
+    print("Estruturas de busca textual criadas.")
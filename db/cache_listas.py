@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from db.models import buscar_convenios, buscar_profissionais, busca_conjunto
+
+
+# Tempo (em segundos) que uma lista permanece valida antes de ser recarregada em segundo plano.
+CACHE_LISTAS_TTL = int(os.getenv("CACHE_LISTAS_TTL", "600"))
+
+# Funcoes que carregam cada lista de dimensao diretamente do banco.
+CARREGADORES = {
+    "convenios": buscar_convenios,
+    "profissionais": buscar_profissionais,
+    "conjuntos": busca_conjunto,
+}
+
+# Entradas do cache: nome -> {"valores": [...], "etag": str, "carregado_em": float}
+_entradas = {}
+_lock = threading.Lock()
+# Um lock por lista, para que apenas uma carga sincrona aconteca de cada vez.
+_locks_carga = {nome: threading.Lock() for nome in CARREGADORES}
+# Listas que estao sendo recarregadas em segundo plano neste momento.
+_atualizando = set()
+
+
+def _calcular_etag(valores):
+    """
+    Gera um identificador estavel para o conteudo de uma lista.
+    """
+    conteudo = json.dumps(valores, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha1(conteudo).hexdigest()
+
+
+def _carregar(nome: str):
+    """
+    Executa a consulta da lista no banco e grava o resultado no cache.
+    """
+    valores = CARREGADORES[nome]()
+    entrada = {
+        "valores": valores,
+        "etag": _calcular_etag(valores),
+        "carregado_em": time.monotonic(),
+    }
+    with _lock:
+        _entradas[nome] = entrada
+    return entrada
+
+
+def _atualizar_em_segundo_plano(nome: str):
+    """
+    Dispara a recarga de uma lista expirada sem bloquear quem fez a requisicao.
+    """
+    with _lock:
+        if nome in _atualizando:
+            return
+        _atualizando.add(nome)
+
+    def tarefa():
+        try:
+            _carregar(nome)
+        except Exception as e:
+            # Mantem o valor antigo no cache; a proxima requisicao tenta novamente.
+            print(f"Erro ao atualizar a lista '{nome}' em segundo plano: {e}")
+        finally:
+            with _lock:
+                _atualizando.discard(nome)
+
+    threading.Thread(target=tarefa, name=f"cache-listas-{nome}", daemon=True).start()
+
+
+def obter_lista_com_etag(nome: str):
+    """
+    Retorna uma lista de dimensao (convenios, profissionais ou conjuntos) a partir do cache.
+
+    Na primeira chamada a lista e carregada do banco. Depois disso, enquanto o TTL
+    nao expirar, o banco nao e consultado. Quando expira, o valor antigo continua
+    sendo servido e a recarga acontece em segundo plano.
+
+    Args:
+        nome (str): Nome da lista ("convenios", "profissionais" ou "conjuntos").
+
+    Returns:
+        tuple: A lista de valores e o ETag correspondente ao seu conteudo.
+    """
+    if nome not in CARREGADORES:
+        raise KeyError(f"Lista desconhecida: {nome}")
+
+    with _lock:
+        entrada = _entradas.get(nome)
+
+    if entrada is None:
+        # Primeira carga: apenas uma thread consulta o banco, as demais aguardam o resultado.
+        with _locks_carga[nome]:
+            with _lock:
+                entrada = _entradas.get(nome)
+            if entrada is None:
+                entrada = _carregar(nome)
+    elif time.monotonic() - entrada["carregado_em"] > CACHE_LISTAS_TTL:
+        _atualizar_em_segundo_plano(nome)
+
+    return entrada["valores"], entrada["etag"]
+
+
+def obter_lista(nome: str):
+    """
+    Retorna apenas os valores de uma lista de dimensao em cache.
+
+    Args:
+        nome (str): Nome da lista ("convenios", "profissionais" ou "conjuntos").
+
+    Returns:
+        list: Lista de strings com os valores da dimensao.
+    """
+    return obter_lista_com_etag(nome)[0]
+
+
+def versao_listas():
+    """
+    Retorna uma versao combinada das tres listas, que muda quando qualquer uma delas muda.
+
+    Returns:
+        str: Hash dos ETags das listas de convenios, profissionais e conjuntos.
+    """
+    etags = [obter_lista_com_etag(nome)[1] for nome in sorted(CARREGADORES)]
+    return hashlib.sha1("|".join(etags).encode("utf-8")).hexdigest()
+
+
+def invalidar_listas(*nomes: str):
+    """
+    Remove listas do cache, forcando uma nova consulta ao banco no proximo acesso.
+
+    Args:
+        *nomes (str): Listas a invalidar. Sem argumentos, invalida todas.
+    """
+    with _lock:
+        if not nomes:
+            _entradas.clear()
+        for nome in nomes:
+            _entradas.pop(nome, None)
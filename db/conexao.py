@@ -0,0 +1,219 @@
+import os
+import re
+import time
+import hashlib
+import threading
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as TempoPoolEsgotado
+from sqlalchemy.pool import QueuePool, NullPool
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+DB_URL = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+# Replica somente leitura (opcional). Quando definida, as consultas pesadas do pool
+# "analitico" (filtros, exportacoes, coortes, listas) sao feitas nela.
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+DB_REPLICA_URL = (
+    f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{DB_REPLICA_HOST}:{os.getenv('DB_REPLICA_PORT', os.getenv('DB_PORT'))}/{os.getenv('DB_NAME')}"
+    if DB_REPLICA_HOST else None
+)
+
+# Tempo maximo (em segundos) esperando uma conexao livre no pool.
+DB_POOL_ESPERA_S = int(os.getenv("DB_POOL_ESPERA_S", "30"))
+# Conexoes sao recriadas apos este tempo (em segundos), em vez de testadas a cada uso.
+DB_POOL_RECICLAR_S = int(os.getenv("DB_POOL_RECICLAR_S", "1800"))
+# Testa a conexao (SELECT 1) a cada uso; custa uma ida e volta ao banco por consulta.
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+# Usa PREPARE/EXECUTE nas consultas fixas (ver `executar_preparada`).
+DB_PREPARAR = os.getenv("DB_PREPARAR", "1") == "1"
+# Quantidade maxima de consultas preparadas por conexao.
+DB_PREPARADAS_MAX = 64
+
+# Configuracao de cada pool:
+#  - "interativo": consultas curtas por paciente (jornada, versao), no banco principal.
+#  - "analitico": varreduras pesadas (filtros, exportacoes, coortes), na replica se houver.
+#  - "manutencao": criacao e atualizacao de indices e tabelas derivadas, sem limite de tempo.
+POOLS = {
+    "interativo": {
+        "tamanho": int(os.getenv("DB_POOL_INTERATIVO", "5")),
+        "extra": int(os.getenv("DB_POOL_INTERATIVO_EXTRA", "5")),
+        "timeout_ms": int(os.getenv("DB_TIMEOUT_INTERATIVO_MS", "10000")),
+        "replica": False,
+    },
+    "analitico": {
+        "tamanho": int(os.getenv("DB_POOL_ANALITICO", "3")),
+        "extra": int(os.getenv("DB_POOL_ANALITICO_EXTRA", "2")),
+        "timeout_ms": int(os.getenv("DB_TIMEOUT_ANALITICO_MS", "120000")),
+        "replica": True,
+    },
+    "manutencao": {
+        "tamanho": None,
+        "extra": None,
+        "timeout_ms": 0,
+        "replica": False,
+    },
+}
+
+_engines = {}
+_lock = threading.Lock()
+# Nome do pool -> contadores de uso (ver `metricas_pools`).
+_metricas = {nome: {"checkouts": 0, "espera_total_s": 0.0, "espera_max_s": 0.0, "esgotados": 0} for nome in POOLS}
+
+# Parametros nomeados do SQLAlchemy (":nome"), ignorando conversoes de tipo ("::text").
+_PARAMETRO = re.compile(r"(?<![:\w]):(\w+)")
+
+
+class _PoolMedido(QueuePool):
+    """
+    QueuePool que registra quantas conexoes foram retiradas e quanto tempo cada
+    retirada esperou por uma conexao livre.
+    """
+
+    nome_pool = None
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TempoPoolEsgotado:
+            with _lock:
+                _metricas[self.nome_pool]["esgotados"] += 1
+            raise
+        finally:
+            espera = time.perf_counter() - inicio
+            with _lock:
+                metricas = _metricas[self.nome_pool]
+                metricas["checkouts"] += 1
+                metricas["espera_total_s"] += espera
+                metricas["espera_max_s"] = max(metricas["espera_max_s"], espera)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.nome_pool = self.nome_pool
+        return pool
+
+
+def _criar_engine(nome: str):
+    """
+    Cria o engine de um pool de acordo com POOLS.
+    """
+    config = POOLS[nome]
+    url = DB_REPLICA_URL if config["replica"] and DB_REPLICA_URL else DB_URL
+    # O limite de tempo vale para cada comando enviado pela conexao.
+    connect_args = {"options": f"-c statement_timeout={config['timeout_ms']}", "application_name": f"promptmedles-{nome}"}
+
+    if config["tamanho"] is None:
+        return create_engine(url, poolclass=NullPool, connect_args=connect_args)
+
+    classe = type(f"_PoolMedido_{nome}", (_PoolMedido,), {"nome_pool": nome})
+    return create_engine(
+        url,
+        poolclass=classe,
+        pool_size=config["tamanho"],
+        max_overflow=config["extra"],
+        pool_timeout=DB_POOL_ESPERA_S,
+        pool_recycle=DB_POOL_RECICLAR_S,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+
+
+def obter_engine(nome: str = "interativo"):
+    """
+    Retorna o engine de um pool, criado no primeiro uso.
+
+    Args:
+        nome (str): "interativo", "analitico" ou "manutencao".
+    """
+    engine = _engines.get(nome)
+    if engine is None:
+        with _lock:
+            engine = _engines.get(nome)
+            if engine is None:
+                engine = _engines[nome] = _criar_engine(nome)
+    return engine
+
+
+def conectar(nome: str = "interativo"):
+    """
+    Abre uma conexao do pool informado (usar com `with`).
+    """
+    return obter_engine(nome).connect()
+
+
+def transacao():
+    """
+    Abre uma transacao no banco principal, sem limite de tempo, para escritas e
+    tarefas de manutencao (usar com `with`; o commit e feito ao sair do bloco).
+    """
+    return obter_engine("manutencao").begin()
+
+
+def executar_preparada(conn, sql: str, params: dict = None, tipos: dict = None):
+    """
+    Executa uma consulta de formato fixo como um comando preparado no servidor
+    (PREPARE na primeira vez em cada conexao, EXECUTE nas seguintes), economizando
+    a analise e o planejamento da consulta a cada chamada.
+
+    Os tipos em `tipos` sao declarados no PREPARE; os demais parametros tem o tipo
+    deduzido pelo servidor a partir da consulta. Listas (enviadas como arrays) sempre
+    precisam do tipo declarado, ex.: {"ids": "TEXT[]"}.
+
+    Args:
+        conn: Conexao do SQLAlchemy.
+        sql (str): Consulta com parametros nomeados (":nome"), como em `text()`.
+        params (dict, optional): Valores dos parametros.
+        tipos (dict, optional): Nome do parametro -> tipo no Postgres (ex.: "TEXT", "BIGINT").
+
+    Returns:
+        Result: O resultado da consulta, como em `conn.execute`.
+
+    Raises:
+        ValueError: Se um parametro do tipo lista nao tiver o tipo declarado.
+    """
+    params = params or {}
+    tipos = tipos or {}
+    nomes = list(dict.fromkeys(_PARAMETRO.findall(sql)))
+    sem_tipo = [nome for nome in nomes if isinstance(params.get(nome), (list, tuple)) and nome not in tipos]
+    if sem_tipo:
+        raise ValueError(f"Declare o tipo dos parametros do tipo lista: {', '.join(sem_tipo)}")
+    if not DB_PREPARAR:
+        return conn.execute(text(sql), params)
+
+    declarados = [tipos.get(nome, "UNKNOWN") for nome in nomes]
+    preparadas = conn.connection.info.setdefault("preparadas", set())
+    comando = "consulta_" + hashlib.sha1(f"{sql}\x1f{declarados}".encode("utf-8")).hexdigest()[:16]
+
+    if comando not in preparadas:
+        if len(preparadas) >= DB_PREPARADAS_MAX:
+            return conn.execute(text(sql), params)
+        posicoes = {nome: f"${i}" for i, nome in enumerate(nomes, start=1)}
+        assinatura = f" ({', '.join(declarados)})" if nomes else ""
+        conn.exec_driver_sql(f"PREPARE {comando}{assinatura} AS " + _PARAMETRO.sub(lambda m: posicoes[m.group(1)], sql))
+        preparadas.add(comando)
+
+    argumentos = f"({', '.join(['%s'] * len(nomes))})" if nomes else ""
+    return conn.exec_driver_sql(f"EXECUTE {comando}{argumentos}", tuple(params[nome] for nome in nomes))
+
+
+def metricas_pools():
+    """
+    Retorna o uso de cada pool ja criado: retiradas de conexao, tempo de espera
+    por uma conexao livre e ocupacao atual.
+
+    Returns:
+        dict: Nome do pool -> {"checkouts", "espera_total_s", "espera_max_s",
+              "esgotados", "tamanho", "em_uso", "extra_em_uso"}.
+    """
+    resultado = {}
+    for nome, engine in list(_engines.items()):
+        with _lock:
+            metricas = dict(_metricas[nome])
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            metricas.update(tamanho=pool.size(), em_uso=pool.checkedout(), extra_em_uso=max(pool.overflow(), 0))
+        resultado[nome] = metricas
+    return resultado
@@ -0,0 +1,251 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import text
+
+from db.conexao import conectar, transacao
+from db.models import _montar_consulta_pacientes
+
+
+# Metricas disponiveis para uma coorte (populacao filtrada).
+#  - "eventos_por_periodo": serie temporal de eventos e pacientes por dia/semana/mes/ano.
+#  - "idade": histograma de idade dos pacientes, em faixas de `tamanho_faixa` anos.
+#  - "convenio", "profissional", "conjunto", "fonte": distribuicao de eventos e pacientes por valor.
+METRICAS_COORTE = ("eventos_por_periodo", "idade", "convenio", "profissional", "conjunto", "fonte")
+PERIODOS_COORTE = ("dia", "semana", "mes", "ano")
+
+# Coluna de mpiv02.events usada em cada metrica de distribuicao.
+COLUNAS_DISTRIBUICAO = {
+    "convenio": "nome_convenio",
+    "profissional": "nome_profissional",
+    "conjunto": "conjunto",
+    "fonte": "fonte",
+}
+# Nome de cada periodo no date_trunc do Postgres.
+TRUNCAMENTO_PERIODO = {"dia": "day", "semana": "week", "mes": "month", "ano": "year"}
+# Limite superior usado para montar a coorte quando nenhum filtro e informado.
+IDADE_MAXIMA_COORTE = 150
+
+# Indica se a tabela de agregados mensais ja foi encontrada no banco.
+_rollup_disponivel = False
+
+
+def criar_rollup():
+    """
+    Cria a tabela de eventos pre-agregados por paciente, mes, convenio, profissional
+    e conjunto. Pode ser executada varias vezes.
+    """
+    with transacao() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS mpiv02.eventos_rollup_mensal AS
+            SELECT
+                e.id_paciente,
+                date_trunc('month', e.data) AS mes,
+                e.nome_convenio,
+                e.nome_profissional,
+                e.conjunto,
+                COUNT(*) AS total
+            FROM mpiv02.events e
+            GROUP BY 1, 2, 3, 4, 5
+            WITH NO DATA
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS eventos_rollup_mensal_paciente_idx ON mpiv02.eventos_rollup_mensal (id_paciente)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS eventos_rollup_mensal_mes_idx ON mpiv02.eventos_rollup_mensal (mes)"))
+
+
+_INSERIR_ROLLUP = """
+    INSERT INTO mpiv02.eventos_rollup_mensal
+    SELECT
+        e.id_paciente,
+        date_trunc('month', e.data) AS mes,
+        e.nome_convenio,
+        e.nome_profissional,
+        e.conjunto,
+        COUNT(*) AS total
+    FROM mpiv02.events e
+    {filtro}
+    GROUP BY 1, 2, 3, 4, 5
+"""
+
+
+def reconstruir_rollup():
+    """
+    Recalcula a tabela de agregados mensais inteira.
+
+    Returns:
+        int: Quantidade de linhas na tabela apos a reconstrucao.
+    """
+    with transacao() as conn:
+        conn.execute(text("TRUNCATE mpiv02.eventos_rollup_mensal"))
+        return conn.execute(text(_INSERIR_ROLLUP.format(filtro=""))).rowcount
+
+
+def atualizar_rollup_pacientes(ids_pacientes: list):
+    """
+    Recalcula os agregados mensais dos pacientes informados.
+
+    Args:
+        ids_pacientes (list): IDs dos pacientes que tiveram eventos alterados.
+
+    Returns:
+        int: Quantidade de linhas gravadas.
+    """
+    if not ids_pacientes:
+        return 0
+    params = {"ids": list(ids_pacientes)}
+    with transacao() as conn:
+        conn.execute(text("DELETE FROM mpiv02.eventos_rollup_mensal WHERE id_paciente = ANY(:ids)"), params)
+        return conn.execute(text(_INSERIR_ROLLUP.format(filtro="WHERE e.id_paciente = ANY(:ids)")), params).rowcount
+
+
+def rollup_disponivel():
+    """
+    Verifica se a tabela de agregados mensais ja foi criada e carregada.
+    O resultado positivo fica guardado para nao repetir a consulta.
+
+    Returns:
+        bool: True se a tabela existir e tiver dados.
+    """
+    global _rollup_disponivel
+    if _rollup_disponivel:
+        return True
+    with conectar() as conn:
+        existe = conn.execute(text("SELECT to_regclass('mpiv02.eventos_rollup_mensal') IS NOT NULL")).scalar()
+        if existe:
+            existe = conn.execute(text("SELECT EXISTS (SELECT 1 FROM mpiv02.eventos_rollup_mensal)")).scalar()
+    _rollup_disponivel = bool(existe)
+    return _rollup_disponivel
+
+
+def _valor_json(valor):
+    """
+    Converte datas e decimais do banco em valores aceitos pelo JSON.
+    """
+    if isinstance(valor, datetime):
+        return valor.date().isoformat() if valor.hour == valor.minute == valor.second == 0 else valor.isoformat()
+    if isinstance(valor, date):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return int(valor) if valor == valor.to_integral_value() else float(valor)
+    return valor
+
+
+def _consulta_coorte(filtros: dict):
+    """
+    Monta a subconsulta com os pacientes da coorte (id_paciente, idade_calculada).
+    Sem filtros, a coorte e toda a populacao com data de nascimento conhecida.
+    """
+    criterios = {k: v for k, v in filtros.items() if k not in ("ranquear",)}
+    consulta = _montar_consulta_pacientes(**criterios)
+    if consulta is None:
+        consulta = _montar_consulta_pacientes(idade_min=0, idade_max=IDADE_MAXIMA_COORTE)
+    sql, params, _ = consulta
+    return sql, params
+
+
+def validar_coorte(metrica: str, periodo: str = "mes", tamanho_faixa: int = 10, limite: int = 20):
+    """
+    Valida os parametros de uma analise de coorte.
+
+    Returns:
+        str | None: Mensagem de erro, ou None se os parametros forem validos.
+    """
+    if metrica not in METRICAS_COORTE:
+        return f"Metrica invalida. Use uma de: {', '.join(METRICAS_COORTE)}."
+    if periodo not in PERIODOS_COORTE:
+        return f"Periodo invalido. Use um de: {', '.join(PERIODOS_COORTE)}."
+    if tamanho_faixa < 1:
+        return "O tamanho da faixa de idade deve ser maior que zero."
+    if limite < 1:
+        return "O limite deve ser maior que zero."
+    return None
+
+
+def analisar_coorte(filtros: dict, metrica: str, periodo: str = "mes", tamanho_faixa: int = 10, limite: int = 20,
+                    data_inicio=None, data_fim=None, usar_rollup: bool = True):
+    """
+    Calcula uma estatistica agregada sobre os pacientes que correspondem aos filtros,
+    inteiramente no banco (nenhum evento individual e lido pela aplicacao).
+
+    Args:
+        filtros (dict): Os mesmos criterios aceitos por `filtrar_pacientes`.
+        metrica (str): Uma de METRICAS_COORTE.
+        periodo (str, optional): Agrupamento da serie temporal ("dia", "semana", "mes" ou "ano").
+        tamanho_faixa (int, optional): Largura (em anos) das faixas do histograma de idade.
+        limite (int, optional): Quantidade maxima de valores nas distribuicoes (os mais frequentes).
+        data_inicio, data_fim (optional): Restringem os eventos considerados.
+        usar_rollup (bool, optional): Usa a tabela de agregados mensais quando possivel.
+
+    Returns:
+        dict: {"metrica", "fonte", "colunas", "dados"}, onde `dados` e colunar
+              (coluna -> lista de valores) e pode ser usado direto como `df` em '/plot'.
+    """
+    sql_coorte, params = _consulta_coorte(filtros)
+    params = dict(params)
+
+    if metrica == "idade":
+        params["faixa"] = int(tamanho_faixa)
+        sql = f"""
+            SELECT (FLOOR(c.idade_calculada / :faixa) * :faixa)::int AS faixa_inicio, COUNT(*) AS pacientes
+            FROM ({sql_coorte}) c
+            GROUP BY 1
+            ORDER BY 1
+        """
+        fonte = "pacientes"
+    else:
+        # Sem intervalo de datas, series mensais/anuais e distribuicoes (exceto fonte)
+        # podem ser lidas da tabela de agregados mensais em vez de mpiv02.events.
+        rollup = (usar_rollup and data_inicio is None and data_fim is None and metrica != "fonte"
+                  and (metrica != "eventos_por_periodo" or periodo in ("mes", "ano"))
+                  and rollup_disponivel())
+        tabela, coluna_data, contagem = (
+            ("mpiv02.eventos_rollup_mensal", "mes", "SUM(e.total)") if rollup
+            else ("mpiv02.events", "data", "COUNT(*)")
+        )
+
+        condicoes = [f"e.id_paciente IN (SELECT c.id_paciente FROM ({sql_coorte}) c)"]
+        if data_inicio is not None:
+            condicoes.append("e.data >= :data_inicio")
+            params["data_inicio"] = data_inicio
+        if data_fim is not None:
+            condicoes.append("e.data <= :data_fim")
+            params["data_fim"] = data_fim
+
+        if metrica == "eventos_por_periodo":
+            params["truncamento"] = TRUNCAMENTO_PERIODO[periodo]
+            selecao = f"date_trunc(:truncamento, e.{coluna_data}) AS periodo"
+            condicoes.append(f"e.{coluna_data} IS NOT NULL")
+            ordenacao, limite_sql = "1", ""
+        else:
+            selecao = f"e.{COLUNAS_DISTRIBUICAO[metrica]} AS {metrica}"
+            condicoes.append(f"e.{COLUNAS_DISTRIBUICAO[metrica]} IS NOT NULL")
+            ordenacao, limite_sql = "eventos DESC, 1", "LIMIT :limite"
+            params["limite"] = int(limite)
+
+        sql = f"""
+            SELECT {selecao}, {contagem} AS eventos, COUNT(DISTINCT e.id_paciente) AS pacientes
+            FROM {tabela} e
+            WHERE {' AND '.join(condicoes)}
+            GROUP BY 1
+            ORDER BY {ordenacao}
+            {limite_sql}
+        """
+        fonte = "rollup" if rollup else "eventos"
+
+    with conectar("analitico") as conn:
+        result = conn.execute(text(sql), params)
+        colunas = list(result.keys())
+        linhas = result.fetchall()
+
+    return {
+        "metrica": metrica,
+        "fonte": fonte,
+        "colunas": colunas,
+        "dados": {nome: [_valor_json(row[i]) for row in linhas] for i, nome in enumerate(colunas)},
+    }
+
+
+if __name__ == '__main__':
+    # Recalcula os agregados mensais (ex.: agendado uma vez por noite): python -m db.coorte
+    criar_rollup()
+    print(f"Linhas nos agregados mensais: {reconstruir_rollup()}")
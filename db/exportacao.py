@@ -0,0 +1,425 @@
+import io
+import os
+import re
+import csv
+import json
+import time
+import uuid
+import threading
+from functools import lru_cache
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import text
+
+from db.conexao import conectar
+from db.models import iterar_pacientes, _montar_consulta_pacientes, COLUNAS_JORNADA
+
+
+# Diretorio onde as exportacoes em segundo plano sao gravadas.
+EXPORTACOES_DIR = os.getenv("EXPORTACOES_DIR", os.path.join("cache", "exportacoes"))
+# Quantidade de linhas lidas do banco (e escritas no arquivo) por vez.
+EXPORTACAO_TAMANHO_LOTE = int(os.getenv("EXPORTACAO_TAMANHO_LOTE", "5000"))
+# Tempo (em horas) que uma exportacao em segundo plano e seu arquivo ficam disponiveis.
+EXPORTACOES_RETENCAO_HORAS = float(os.getenv("EXPORTACOES_RETENCAO_HORAS", "24"))
+
+FORMATOS_EXPORTACAO = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+# "pacientes": uma linha por paciente do filtro; "eventos": a jornada completa de cada um.
+CONJUNTOS_EXPORTACAO = ("pacientes", "eventos")
+COLUNAS_PACIENTES = ["id_paciente", "idade", "total_eventos"]
+# Tipos das colunas do conjunto "pacientes", no formato de information_schema.columns
+# (data_type, precisao, escala).
+TIPOS_PACIENTES = {
+    "id_paciente": ("text", None, None),
+    "idade": ("integer", None, None),
+    "total_eventos": ("bigint", None, None),
+    "relevancia": ("double precision", None, None),
+}
+
+# O estado de cada exportacao em segundo plano fica em EXPORTACOES_DIR/<id>.json,
+# ao lado do arquivo, para que qualquer worker da aplicacao possa consulta-lo.
+_ID_TRABALHO = re.compile(r"[0-9a-f]{32}")
+# Intervalo minimo (em segundos) entre gravacoes do progresso de uma exportacao.
+_INTERVALO_PROGRESSO = 1.0
+
+
+class FormatoIndisponivel(Exception):
+    """O formato pedido depende de uma biblioteca que nao esta instalada."""
+
+
+def _valor_simples(valor):
+    """
+    Converte valores do banco em tipos que CSV e JSON sabem escrever.
+    """
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return int(valor) if valor == valor.to_integral_value() else float(valor)
+    return valor
+
+
+def _linhas_pacientes(filtros: dict, tamanho_lote: int, incluir_relevancia: bool):
+    """
+    Percorre os pacientes do filtro (cursor no servidor) como tuplas.
+    """
+    for paciente in iterar_pacientes(tamanho_lote=tamanho_lote, **filtros):
+        linha = (paciente['id_paciente'], int(paciente['idade_calculada']), paciente['total_eventos'])
+        if incluir_relevancia:
+            relevancia = paciente.get('relevancia')
+            linha += (float(relevancia) if relevancia is not None else None,)
+        yield linha
+
+
+def _consulta_eventos(filtros: dict, colunas: list):
+    """
+    Monta a consulta dos eventos de todos os pacientes que correspondem ao filtro.
+
+    Returns:
+        tuple: (SQL, parametros), ou None se nenhum filtro for informado.
+    """
+    consulta = _montar_consulta_pacientes(**filtros)
+    if consulta is None:
+        return None
+    sql_pacientes, params, _ = consulta
+    sql = f"""
+        SELECT {', '.join(f'e.{c}' for c in colunas)}
+        FROM mpiv02.events e
+        WHERE e.id_paciente IN (SELECT f.id_paciente FROM ({sql_pacientes}) f)
+        ORDER BY e.id_paciente, e.data
+    """
+    return sql, params
+
+
+@lru_cache(maxsize=1)
+def _tipos_eventos():
+    """
+    Tipos das colunas de mpiv02.events (data_type, precisao, escala), lidos uma vez.
+    """
+    with conectar() as conn:
+        result = conn.execute(text("""
+            SELECT column_name, data_type, numeric_precision, numeric_scale
+            FROM information_schema.columns
+            WHERE table_schema = 'mpiv02' AND table_name = 'events'
+        """)).fetchall()
+    return {row.column_name: (row.data_type, row.numeric_precision, row.numeric_scale) for row in result}
+
+
+def _linhas_eventos(filtros: dict, colunas: list, tamanho_lote: int):
+    """
+    Percorre os eventos dos pacientes do filtro como tuplas, usando um cursor no
+    servidor para nunca ter mais de um lote na memoria.
+    """
+    consulta = _consulta_eventos(filtros, colunas)
+    if consulta is None:
+        return
+    sql, params = consulta
+    with conectar("analitico") as conn:
+        result = conn.execution_options(stream_results=True, yield_per=tamanho_lote).execute(text(sql), params)
+        for row in result:
+            yield tuple(row)
+
+
+def _lotes(linhas, tamanho_lote: int):
+    """
+    Agrupa as linhas em listas de ate `tamanho_lote` itens.
+    """
+    lote = []
+    for linha in linhas:
+        lote.append(linha)
+        if len(lote) >= tamanho_lote:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def _escrever_csv(linhas, colunas: list, tamanho_lote: int, tipos: dict = None):
+    """
+    Escreve as linhas em CSV (com cabecalho), uma parte por lote.
+    """
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(colunas)
+    for lote in _lotes(linhas, tamanho_lote):
+        escritor.writerows([_valor_simples(v) for v in linha] for linha in lote)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _escrever_jsonl(linhas, colunas: list, tamanho_lote: int, tipos: dict = None):
+    """
+    Escreve as linhas em JSON Lines (um objeto por linha), uma parte por lote.
+    """
+    for lote in _lotes(linhas, tamanho_lote):
+        yield "".join(
+            json.dumps(dict(zip(colunas, linha)), ensure_ascii=False, default=_valor_simples) + "\n"
+            for linha in lote
+        ).encode("utf-8")
+
+
+class _Coletor:
+    """
+    Arquivo "somente escrita" que acumula os bytes gravados pelo pyarrow, para que
+    cada row group seja enviado assim que estiver pronto.
+    """
+
+    def __init__(self):
+        self.partes, self.posicao, self.closed = [], 0, False
+
+    def write(self, dados):
+        dados = bytes(dados)
+        self.partes.append(dados)
+        self.posicao += len(dados)
+        return len(dados)
+
+    def tell(self):
+        return self.posicao
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def esvaziar(self):
+        dados = b"".join(self.partes)
+        self.partes = []
+        return dados
+
+
+def _tipo_parquet(pa, tipo: tuple):
+    """
+    Converte o tipo de uma coluna do Postgres no tipo do Parquet (texto, se desconhecido).
+    """
+    nome, precisao, escala = tipo or ("text", None, None)
+    if nome in ("smallint", "integer", "bigint"):
+        return pa.int64()
+    if nome in ("real", "double precision"):
+        return pa.float64()
+    if nome == "numeric":
+        # Sem precisao declarada, cada valor pode ter uma escala diferente.
+        return pa.decimal128(precisao, escala or 0) if precisao else pa.float64()
+    if nome == "boolean":
+        return pa.bool_()
+    if nome == "date":
+        return pa.date32()
+    if nome.startswith("timestamp"):
+        return pa.timestamp("us", tz="UTC" if "with time zone" in nome else None)
+    return pa.string()
+
+
+def _escrever_parquet(linhas, colunas: list, tamanho_lote: int, tipos: dict = None):
+    """
+    Escreve as linhas em Parquet (compressao zstd), um row group por lote. O esquema
+    vem dos tipos das colunas, e nao dos valores do primeiro lote, para ser o mesmo
+    em todos os row groups (ex.: uma coluna vazia no inicio ou um decimal com outra escala).
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise FormatoIndisponivel("A exportacao em Parquet requer o pacote 'pyarrow'.")
+
+    tipos = tipos or {}
+    esquema = pa.schema([(c, _tipo_parquet(pa, tipos.get(c))) for c in colunas])
+    coletor = _Coletor()
+    escritor = pq.ParquetWriter(coletor, esquema, compression="zstd")
+    # Cada lote vira um row group; o arquivo so e finalizado (rodape) no fim.
+    for lote in _lotes(linhas, tamanho_lote):
+        valores = []
+        for campo, coluna in zip(esquema, zip(*lote)):
+            if pa.types.is_floating(campo.type):
+                coluna = [None if v is None else float(v) for v in coluna]
+            elif pa.types.is_string(campo.type):
+                coluna = [v if v is None or isinstance(v, str) else str(v) for v in coluna]
+            valores.append(pa.array(coluna, type=campo.type))
+        escritor.write_table(pa.Table.from_arrays(valores, schema=esquema))
+        yield coletor.esvaziar()
+    escritor.close()
+    yield coletor.esvaziar()
+
+
+ESCRITORES = {
+    "csv": _escrever_csv,
+    "jsonl": _escrever_jsonl,
+    "parquet": _escrever_parquet,
+}
+
+
+def validar_exportacao(formato: str, conjunto: str, colunas: list = None):
+    """
+    Valida os parametros de uma exportacao.
+
+    Returns:
+        str | None: Mensagem de erro, ou None se os parametros forem validos.
+    """
+    if formato not in FORMATOS_EXPORTACAO:
+        return f"Formato invalido. Use um de: {', '.join(FORMATOS_EXPORTACAO)}."
+    if conjunto not in CONJUNTOS_EXPORTACAO:
+        return f"Conjunto invalido. Use um de: {', '.join(CONJUNTOS_EXPORTACAO)}."
+    if colunas:
+        invalidas = [c for c in colunas if c not in COLUNAS_JORNADA]
+        if invalidas:
+            return f"Colunas invalidas: {', '.join(invalidas)}."
+    if formato == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return "A exportacao em Parquet requer o pacote 'pyarrow'."
+    return None
+
+
+def gerar_exportacao(filtros: dict, formato: str = "csv", conjunto: str = "pacientes", colunas: list = None,
+                     tamanho_lote: int = None):
+    """
+    Gera o arquivo de exportacao em partes, lendo o banco por um cursor no servidor,
+    de modo que o uso de memoria nao depende do tamanho do resultado.
+
+    Args:
+        filtros (dict): Os mesmos criterios aceitos por `filtrar_pacientes`.
+        formato (str): "csv", "jsonl" ou "parquet" (requer pyarrow).
+        conjunto (str): "pacientes" (uma linha por paciente) ou "eventos" (jornadas completas).
+        colunas (list, optional): Colunas de mpiv02.events exportadas no conjunto "eventos".
+        tamanho_lote (int, optional): Linhas lidas e escritas por vez.
+
+    Yields:
+        bytes: Partes consecutivas do arquivo.
+    """
+    tamanho_lote = tamanho_lote or EXPORTACAO_TAMANHO_LOTE
+    if conjunto == "eventos":
+        colunas = list(colunas or COLUNAS_JORNADA)
+        linhas = _linhas_eventos(filtros, colunas, tamanho_lote)
+        tipos = _tipos_eventos() if formato == "parquet" else None
+    else:
+        incluir_relevancia = bool(filtros.get("ranquear") and filtros.get("termos_busca"))
+        colunas = COLUNAS_PACIENTES + (["relevancia"] if incluir_relevancia else [])
+        linhas = _linhas_pacientes(filtros, tamanho_lote, incluir_relevancia)
+        tipos = TIPOS_PACIENTES
+    yield from ESCRITORES[formato](linhas, colunas, tamanho_lote, tipos)
+
+
+def _caminho_estado(id_trabalho: str):
+    return os.path.join(EXPORTACOES_DIR, f"{id_trabalho}.json")
+
+
+def _gravar_estado(estado: dict):
+    """
+    Grava o estado de uma exportacao (troca atomica, para nunca ser lido pela metade).
+    """
+    caminho = _caminho_estado(estado["id"])
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporario, "w", encoding="utf-8") as arquivo:
+        json.dump(estado, arquivo)
+    os.replace(temporario, caminho)
+
+
+def _limpar_expirados():
+    """
+    Apaga as exportacoes (estado, arquivo e temporarios) sem atividade ha mais de
+    EXPORTACOES_RETENCAO_HORAS. Os arquivos de um trabalho comecam com o ID dele.
+    """
+    limite = time.time() - EXPORTACOES_RETENCAO_HORAS * 3600
+    try:
+        nomes = os.listdir(EXPORTACOES_DIR)
+    except FileNotFoundError:
+        return
+    por_trabalho = {}
+    for nome in nomes:
+        caminho = os.path.join(EXPORTACOES_DIR, nome)
+        try:
+            modificado = os.path.getmtime(caminho)
+        except FileNotFoundError:
+            continue
+        arquivos, ultimo = por_trabalho.get(nome.split(".")[0], ([], 0))
+        por_trabalho[nome.split(".")[0]] = (arquivos + [caminho], max(ultimo, modificado))
+    for arquivos, ultimo in por_trabalho.values():
+        if ultimo < limite:
+            for caminho in arquivos:
+                try:
+                    os.remove(caminho)
+                except FileNotFoundError:
+                    pass
+
+
+def _executar_trabalho(estado: dict, filtros: dict, colunas: list):
+    """
+    Grava uma exportacao em arquivo, atualizando o estado do trabalho.
+    """
+    caminho = os.path.join(EXPORTACOES_DIR, f"{estado['id']}.{estado['formato']}")
+    temporario = caminho + ".tmp"
+    try:
+        gravado_em = time.monotonic()
+        with open(temporario, "wb") as arquivo:
+            for parte in gerar_exportacao(filtros, estado["formato"], estado["conjunto"], colunas):
+                arquivo.write(parte)
+                estado["bytes"] += len(parte)
+                if time.monotonic() - gravado_em >= _INTERVALO_PROGRESSO:
+                    _gravar_estado(estado)
+                    gravado_em = time.monotonic()
+        os.replace(temporario, caminho)
+        estado.update(status="concluido", arquivo=os.path.abspath(caminho))
+    except Exception as e:
+        print(f"Erro na exportacao {estado['id']}: {e}")
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        estado.update(status="erro", erro=str(e))
+    _gravar_estado(estado)
+
+
+def iniciar_exportacao(filtros: dict, formato: str = "csv", conjunto: str = "pacientes", colunas: list = None):
+    """
+    Inicia uma exportacao em segundo plano, gravada em EXPORTACOES_DIR. Exportacoes
+    expiradas sao apagadas antes.
+
+    Returns:
+        str: O ID do trabalho, usado em `estado_exportacao`.
+    """
+    os.makedirs(EXPORTACOES_DIR, exist_ok=True)
+    _limpar_expirados()
+    id_trabalho = uuid.uuid4().hex
+    estado = {
+        "id": id_trabalho, "status": "executando", "formato": formato,
+        "conjunto": conjunto, "bytes": 0, "arquivo": None, "erro": None,
+    }
+    _gravar_estado(estado)
+    threading.Thread(
+        target=_executar_trabalho,
+        args=(dict(estado), filtros, colunas),
+        name=f"exportacao-{id_trabalho[:8]}",
+        daemon=True,
+    ).start()
+    return id_trabalho
+
+
+def estado_exportacao(id_trabalho: str):
+    """
+    Retorna o estado de uma exportacao em segundo plano, iniciada por qualquer worker.
+
+    Returns:
+        dict | None: O estado do trabalho, ou None se o ID nao existir (ou tiver expirado).
+    """
+    if not _ID_TRABALHO.fullmatch(id_trabalho or ""):
+        return None
+    caminho = _caminho_estado(id_trabalho)
+    try:
+        if os.path.getmtime(caminho) < time.time() - EXPORTACOES_RETENCAO_HORAS * 3600:
+            _limpar_expirados()
+            return None
+        with open(caminho, encoding="utf-8") as arquivo:
+            estado = json.load(arquivo)
+    except FileNotFoundError:
+        return None
+    # O arquivo pode ter sido apagado por outro worker depois da leitura do estado.
+    if estado["status"] == "concluido" and not os.path.exists(estado["arquivo"]):
+        return None
+    return estado
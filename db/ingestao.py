@@ -0,0 +1,542 @@
+import os
+import time
+import select
+import threading
+import traceback
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from db.conexao import conectar, transacao, obter_engine, executar_preparada
+
+
+# Canal do LISTEN/NOTIFY avisado pelo gatilho de mpiv02.events a cada alteracao.
+CANAL_ALTERACOES = "eventos_alterados"
+# Intervalo (em segundos) entre leituras do registro de alteracoes mesmo sem aviso,
+# para nao depender so do NOTIFY (ex.: aviso perdido durante uma reconexao).
+INGESTAO_INTERVALO_S = int(os.getenv("INGESTAO_INTERVALO_S", "30"))
+# Alteracoes lidas por vez do registro.
+INGESTAO_LOTE = int(os.getenv("INGESTAO_LOTE", "5000"))
+# Dias que as alteracoes ja consumidas ficam no registro antes de serem apagadas.
+INGESTAO_RETENCAO_DIAS = int(os.getenv("INGESTAO_RETENCAO_DIAS", "7"))
+# Versoes de pacientes guardadas em memoria enquanto o ouvinte estiver ativo.
+INGESTAO_CACHE_VERSOES = int(os.getenv("INGESTAO_CACHE_VERSOES", "10000"))
+
+# Transacao mais antiga ainda em andamento. Alteracoes de transacoes anteriores a ela
+# ja estao todas confirmadas (ou desfeitas), entao podem ser lidas sem pular nenhuma:
+# `seq` e atribuido no INSERT, e uma transacao lenta pode confirmar um `seq` menor
+# depois que outro maior ja foi lido.
+_XMIN_ATUAL = "pg_snapshot_xmin(pg_current_snapshot())::text::bigint"
+
+# Trecho do gatilho que registra as alteracoes dos pacientes em `ids` e publica a
+# nova versao de cada um. A versao e o numero sequencial da alteracao, entao muda
+# a cada INSERT, UPDATE ou DELETE (inclusive em eventos antigos).
+_REGISTRAR_ALTERACOES = """
+            WITH ids AS ({ids}),
+            registro AS (
+                INSERT INTO mpiv02.eventos_alteracoes (id_paciente)
+                SELECT id_paciente FROM ids WHERE id_paciente IS NOT NULL
+                RETURNING seq, id_paciente
+            )
+            INSERT INTO mpiv02.pacientes_versao (id_paciente, versao, ultima_data, total_eventos, atualizado_em)
+            SELECT r.id_paciente, r.seq, c.ultima_data, c.total_eventos, NOW()
+            FROM registro r
+            CROSS JOIN LATERAL (
+                SELECT MAX(e.data) AS ultima_data, COUNT(*) AS total_eventos
+                FROM mpiv02.events e
+                WHERE e.id_paciente = r.id_paciente
+            ) c
+            ON CONFLICT (id_paciente) DO UPDATE
+            SET versao = EXCLUDED.versao, ultima_data = EXCLUDED.ultima_data,
+                total_eventos = EXCLUDED.total_eventos, atualizado_em = EXCLUDED.atualizado_em;"""
+
+_ingestao_disponivel = False
+_ingestao_verificada_em = None
+# Funcoes chamadas pelo ouvinte com o conjunto de pacientes alterados.
+_assinantes = []
+# ID do paciente -> versao, valido apenas enquanto o ouvinte estiver conectado.
+_versoes = OrderedDict()
+_ouvinte = None
+_ouvinte_ativo = False
+# Muda a cada invalidacao; versoes lidas antes de uma invalidacao nao entram na memoria.
+_geracao = 0
+_lock = threading.Lock()
+
+
+def criar_estruturas():
+    """
+    Cria o registro de alteracoes, a tabela de versoes por paciente e o gatilho de
+    mpiv02.events que as mantem (e avisa pelo canal CANAL_ALTERACOES). Pacientes
+    que ja tinham eventos recebem a versao 0. Pode ser executada varias vezes.
+    """
+    with transacao() as conn:
+        # As tabelas sao criadas a partir de mpiv02.events, assim id_paciente tem o mesmo tipo.
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS mpiv02.eventos_alteracoes AS
+            SELECT id_paciente FROM mpiv02.events
+            WITH NO DATA
+        """))
+        conn.execute(text("ALTER TABLE mpiv02.eventos_alteracoes ADD COLUMN IF NOT EXISTS seq BIGSERIAL PRIMARY KEY"))
+        conn.execute(text("ALTER TABLE mpiv02.eventos_alteracoes ADD COLUMN IF NOT EXISTS alterado_em TIMESTAMPTZ NOT NULL DEFAULT NOW()"))
+        # Transacao (xid8) que registrou a alteracao; a leitura segue (transacao, seq).
+        conn.execute(text("""
+            ALTER TABLE mpiv02.eventos_alteracoes ADD COLUMN IF NOT EXISTS transacao BIGINT NOT NULL
+            DEFAULT (pg_current_xact_id()::text::bigint)
+        """))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_eventos_alteracoes_transacao
+            ON mpiv02.eventos_alteracoes (transacao, seq)
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS mpiv02.pacientes_versao AS
+            SELECT id_paciente, 0::BIGINT AS versao, MAX(data) AS ultima_data,
+                   COUNT(*) AS total_eventos, NOW() AS atualizado_em
+            FROM mpiv02.events
+            GROUP BY id_paciente
+            WITH NO DATA
+        """))
+        conn.execute(text("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint WHERE conname = 'pacientes_versao_pkey'
+                ) THEN
+                    ALTER TABLE mpiv02.pacientes_versao ADD CONSTRAINT pacientes_versao_pkey PRIMARY KEY (id_paciente);
+                END IF;
+            END $$
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS mpiv02.ingestao_consumidores (
+                nome TEXT PRIMARY KEY,
+                seq BIGINT NOT NULL,
+                atualizado_em TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """))
+        # Consumidores de antes desta coluna recebem de novo as alteracoes guardadas
+        # (reprocessar um paciente nao muda o resultado).
+        conn.execute(text("ALTER TABLE mpiv02.ingestao_consumidores ADD COLUMN IF NOT EXISTS transacao BIGINT NOT NULL DEFAULT 0"))
+
+        # Gatilho por comando (e nao por linha): uma carga com COPY de milhares de
+        # eventos gera uma alteracao por paciente e um unico aviso.
+        novos = "SELECT DISTINCT id_paciente FROM novos"
+        antigos = "SELECT DISTINCT id_paciente FROM antigos"
+        conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION mpiv02.registrar_alteracoes_eventos() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            DECLARE
+                alterados BIGINT;
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    {_REGISTRAR_ALTERACOES.format(ids=novos)}
+                ELSIF TG_OP = 'DELETE' THEN
+                    {_REGISTRAR_ALTERACOES.format(ids=antigos)}
+                ELSE
+                    {_REGISTRAR_ALTERACOES.format(ids=novos + " UNION " + antigos)}
+                END IF;
+                GET DIAGNOSTICS alterados = ROW_COUNT;
+                IF alterados > 0 THEN
+                    PERFORM pg_notify('{CANAL_ALTERACOES}', '');
+                END IF;
+                RETURN NULL;
+            END $$
+        """))
+        for operacao, referencias in (
+            ("INSERT", "NEW TABLE AS novos"),
+            ("UPDATE", "OLD TABLE AS antigos NEW TABLE AS novos"),
+            ("DELETE", "OLD TABLE AS antigos"),
+        ):
+            gatilho = f"events_alteracoes_{operacao.lower()}"
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {gatilho} ON mpiv02.events"))
+            conn.execute(text(f"""
+                CREATE TRIGGER {gatilho}
+                AFTER {operacao} ON mpiv02.events
+                REFERENCING {referencias}
+                FOR EACH STATEMENT EXECUTE FUNCTION mpiv02.registrar_alteracoes_eventos()
+            """))
+
+        conn.execute(text("""
+            INSERT INTO mpiv02.pacientes_versao (id_paciente, versao, ultima_data, total_eventos, atualizado_em)
+            SELECT id_paciente, 0, MAX(data), COUNT(*), NOW()
+            FROM mpiv02.events
+            WHERE id_paciente IS NOT NULL
+            GROUP BY id_paciente
+            ON CONFLICT (id_paciente) DO NOTHING
+        """))
+
+
+def ingestao_disponivel():
+    """
+    Verifica se o registro de alteracoes ja foi criado (ver `criar_estruturas`).
+    O resultado positivo fica guardado; o negativo e verificado de novo a cada
+    INGESTAO_INTERVALO_S, para nao somar uma consulta a cada chamada.
+
+    Returns:
+        bool: True se a tabela de versoes por paciente existir.
+    """
+    global _ingestao_disponivel, _ingestao_verificada_em
+    if _ingestao_disponivel:
+        return True
+    agora = time.monotonic()
+    if _ingestao_verificada_em is not None and agora - _ingestao_verificada_em < INGESTAO_INTERVALO_S:
+        return False
+    with conectar() as conn:
+        existe = conn.execute(text("SELECT to_regclass('mpiv02.pacientes_versao') IS NOT NULL")).scalar()
+    _ingestao_disponivel = bool(existe)
+    _ingestao_verificada_em = agora
+    return _ingestao_disponivel
+
+
+def _formatar_versao(versao, ultima_data, total):
+    return f"{ultima_data}|{total}|{versao}"
+
+
+def versoes_registradas(ids: list):
+    """
+    Le a versao publicada de cada paciente em mpiv02.pacientes_versao. Enquanto o
+    ouvinte estiver ativo, as versoes lidas ficam em memoria ate o paciente mudar.
+
+    Args:
+        ids (list): IDs dos pacientes.
+
+    Returns:
+        dict: ID do paciente -> versao, ex.: "2024-05-01 10:00:00|532|81234".
+              Pacientes sem eventos ficam com a versao "None|0".
+    """
+    versoes, faltantes = {}, []
+    with _lock:
+        geracao = _geracao
+        for pid in map(str, ids):
+            if pid in _versoes:
+                _versoes.move_to_end(pid)
+                versoes[pid] = _versoes[pid]
+            else:
+                faltantes.append(pid)
+    if not faltantes:
+        return versoes
+
+    lidas = {pid: "None|0" for pid in faltantes}
+    with conectar() as conn:
+        result = executar_preparada(conn, """
+            SELECT id_paciente, versao, ultima_data, total_eventos
+            FROM mpiv02.pacientes_versao
+            WHERE id_paciente = ANY(:ids)
+        """, {"ids": faltantes}, tipos={"ids": "TEXT[]"})
+        for row in result:
+            lidas[str(row.id_paciente)] = _formatar_versao(row.versao, row.ultima_data, row.total_eventos)
+
+    with _lock:
+        if _ouvinte_ativo and geracao == _geracao:
+            _versoes.update(lidas)
+            while len(_versoes) > INGESTAO_CACHE_VERSOES:
+                _versoes.popitem(last=False)
+    versoes.update(lidas)
+    return versoes
+
+
+def ingerir_eventos(eventos: list):
+    """
+    Insere novos eventos em mpiv02.events em um unico comando. O gatilho registra
+    a alteracao e publica a nova versao de cada paciente envolvido.
+
+    Args:
+        eventos (list): Dicionarios com as colunas de mpiv02.events (id_paciente,
+            cpf, data, descricao, conjunto, nome_profissional, nome_convenio, fonte,
+            data_nascimento); colunas ausentes ficam nulas.
+
+    Returns:
+        int: Quantidade de eventos inseridos.
+    """
+    if not eventos:
+        return 0
+    colunas = ["id_paciente", "cpf", "data", "descricao", "conjunto",
+               "nome_profissional", "nome_convenio", "fonte", "data_nascimento"]
+    valores = ", ".join(
+        "(" + ", ".join(f":{coluna}_{i}" for coluna in colunas) + ")" for i in range(len(eventos))
+    )
+    params = {f"{coluna}_{i}": evento.get(coluna) for i, evento in enumerate(eventos) for coluna in colunas}
+    with transacao() as conn:
+        result = conn.execute(text(f"INSERT INTO mpiv02.events ({', '.join(colunas)}) VALUES {valores}"), params)
+        return result.rowcount
+
+
+def ultima_alteracao(conn=None):
+    """
+    Retorna a marca a partir da qual ficam as alteracoes que ainda podem aparecer:
+    tudo antes dela ja esta confirmado no registro.
+
+    Returns:
+        tuple: (transacao, seq), para usar em `ler_alteracoes`.
+    """
+    if conn is None:
+        with conectar() as conn:
+            return ultima_alteracao(conn)
+    return (conn.execute(text(f"SELECT {_XMIN_ATUAL}")).scalar(), 0)
+
+
+def ler_alteracoes(desde: tuple, conn=None, limite: int = None):
+    """
+    Le os pacientes alterados depois de uma marca ja processada. So entram alteracoes
+    de transacoes anteriores a mais antiga ainda em andamento, em ordem de
+    (transacao, seq); assim uma transacao lenta nunca confirma algo antes da marca.
+
+    Args:
+        desde (tuple): Marca (transacao, seq) da ultima alteracao ja processada.
+        conn (optional): Conexao a usar; sem ela, uma conexao do pool e aberta.
+        limite (int, optional): Maximo de alteracoes lidas (padrao INGESTAO_LOTE).
+
+    Returns:
+        tuple: (marca da ultima alteracao lida, conjunto de IDs de pacientes alterados).
+               Sem alteracoes novas, retorna (desde, conjunto vazio).
+    """
+    if conn is None:
+        with conectar() as conn:
+            return ler_alteracoes(desde, conn, limite)
+    result = conn.execute(text(f"""
+        SELECT transacao, seq, id_paciente
+        FROM mpiv02.eventos_alteracoes
+        WHERE (transacao, seq) > (:transacao, :seq)
+          AND transacao < {_XMIN_ATUAL}
+        ORDER BY transacao, seq
+        LIMIT :limite
+    """), {"transacao": desde[0], "seq": desde[1], "limite": limite or INGESTAO_LOTE}).fetchall()
+    if not result:
+        return desde, set()
+    return (result[-1].transacao, result[-1].seq), {str(row.id_paciente) for row in result}
+
+
+def registrar_assinante(funcao):
+    """
+    Registra uma funcao chamada pelo ouvinte (ver `iniciar_ouvinte`) a cada lote de
+    alteracoes, com o conjunto de IDs dos pacientes alterados. Erros da funcao sao
+    registrados e nao interrompem o ouvinte.
+
+    Returns:
+        A propria funcao, para poder ser usada como decorador.
+    """
+    with _lock:
+        if funcao not in _assinantes:
+            _assinantes.append(funcao)
+    return funcao
+
+
+def _avisar_assinantes(ids: set):
+    global _geracao
+    with _lock:
+        _geracao += 1
+        for pid in ids:
+            _versoes.pop(pid, None)
+        assinantes = list(_assinantes)
+    for funcao in assinantes:
+        try:
+            funcao(ids)
+        except Exception:
+            print("Erro ao avisar alteracao de pacientes:", traceback.format_exc())
+
+
+def _desativar_cache_versoes():
+    global _ouvinte_ativo, _geracao
+    with _lock:
+        _geracao += 1
+        _ouvinte_ativo = False
+        _versoes.clear()
+
+
+def _escutar():
+    """
+    Laco do ouvinte: espera avisos do canal CANAL_ALTERACOES (ou INGESTAO_INTERVALO_S),
+    le as alteracoes novas e avisa os assinantes. Reconecta apos erros.
+    """
+    global _ouvinte_ativo, _geracao
+    espera_erro = 1
+    while True:
+        conexao = None
+        try:
+            conexao = obter_engine("manutencao").raw_connection()
+            driver = conexao.driver_connection
+            driver.autocommit = True
+            cursor = driver.cursor()
+            cursor.execute(f"LISTEN {CANAL_ALTERACOES}")
+            # Comeca pelas transacoes ainda em andamento (ver `ultima_alteracao`).
+            cursor.execute(f"SELECT {_XMIN_ATUAL}")
+            marca = (cursor.fetchone()[0], 0)
+            # Avisos podem ter sido perdidos enquanto o ouvinte estava desconectado.
+            with _lock:
+                _geracao += 1
+                _versoes.clear()
+                _ouvinte_ativo = True
+            espera_erro = 1
+
+            while True:
+                if select.select([driver], [], [], INGESTAO_INTERVALO_S)[0]:
+                    driver.poll()
+                    driver.notifies.clear()
+                while True:
+                    cursor.execute(f"""
+                        SELECT transacao, seq, id_paciente FROM mpiv02.eventos_alteracoes
+                        WHERE (transacao, seq) > (%s, %s) AND transacao < {_XMIN_ATUAL}
+                        ORDER BY transacao, seq LIMIT %s
+                    """, (*marca, INGESTAO_LOTE))
+                    linhas = cursor.fetchall()
+                    if not linhas:
+                        break
+                    marca = linhas[-1][:2]
+                    _avisar_assinantes({str(pid) for _, _, pid in linhas})
+        except Exception:
+            print("Erro no ouvinte de alteracoes de eventos:", traceback.format_exc())
+            _desativar_cache_versoes()
+            time.sleep(espera_erro)
+            espera_erro = min(espera_erro * 2, 60)
+        finally:
+            if conexao is not None:
+                try:
+                    conexao.close()
+                except Exception:
+                    pass
+
+
+def iniciar_ouvinte():
+    """
+    Inicia (uma vez por processo) a thread que escuta as alteracoes de mpiv02.events
+    e avisa os assinantes. Enquanto estiver conectada, as versoes dos pacientes
+    ficam em memoria. Nao faz nada se o registro de alteracoes nao existir.
+
+    Returns:
+        bool: True se o ouvinte estiver rodando.
+    """
+    global _ouvinte
+    with _lock:
+        if _ouvinte is not None:
+            return True
+    if not ingestao_disponivel():
+        return False
+    with _lock:
+        if _ouvinte is None:
+            _ouvinte = threading.Thread(target=_escutar, name="ouvinte-eventos", daemon=True)
+            _ouvinte.start()
+    return True
+
+
+def ouvinte_ativo():
+    """
+    Indica se o ouvinte esta conectado e recebendo avisos.
+    """
+    return _ouvinte_ativo
+
+
+def _marca_consumidor(conn, nome: str):
+    linha = conn.execute(text("SELECT transacao, seq FROM mpiv02.ingestao_consumidores WHERE nome = :nome"),
+                         {"nome": nome}).first()
+    if linha is not None:
+        return tuple(linha)
+    # Consumidor novo: comeca do ponto atual (as tabelas derivadas sao carregadas por inteiro antes).
+    transacao, seq = ultima_alteracao(conn)
+    conn.execute(text("INSERT INTO mpiv02.ingestao_consumidores (nome, transacao, seq) VALUES (:nome, :transacao, :seq)"),
+                 {"nome": nome, "transacao": transacao, "seq": seq})
+    return transacao, seq
+
+
+def processar_alteracoes(nome: str, funcao):
+    """
+    Entrega a `funcao` todas as alteracoes ainda nao processadas pelo consumidor
+    `nome`, em lotes, gravando o progresso no banco apos cada lote. Se `funcao`
+    falhar, o lote e entregue de novo na proxima execucao.
+
+    Args:
+        nome (str): Nome do consumidor (ex.: "pacientes_resumo").
+        funcao: Recebe a lista de IDs dos pacientes alterados.
+
+    Returns:
+        int: Quantidade de pacientes entregues.
+    """
+    total = 0
+    with transacao() as conn:
+        marca = _marca_consumidor(conn, nome)
+    while True:
+        nova_marca, ids = ler_alteracoes(marca)
+        if not ids:
+            return total
+        funcao(sorted(ids))
+        with transacao() as conn:
+            conn.execute(text("""
+                UPDATE mpiv02.ingestao_consumidores
+                SET transacao = :transacao, seq = :seq, atualizado_em = NOW()
+                WHERE nome = :nome
+            """), {"nome": nome, "transacao": nova_marca[0], "seq": nova_marca[1]})
+        marca = nova_marca
+        total += len(ids)
+
+
+def limpar_alteracoes(dias: int = None):
+    """
+    Apaga do registro as alteracoes ja processadas por todos os consumidores (ou
+    todas, se nao houver consumidores) e mais antigas que `dias` (padrao INGESTAO_RETENCAO_DIAS).
+
+    Returns:
+        int: Quantidade de alteracoes apagadas.
+    """
+    with transacao() as conn:
+        result = conn.execute(text(f"""
+            DELETE FROM mpiv02.eventos_alteracoes a
+            WHERE a.alterado_em < NOW() - make_interval(days => :dias)
+              AND a.transacao < {_XMIN_ATUAL}
+              AND NOT EXISTS (
+                  SELECT 1 FROM mpiv02.ingestao_consumidores c
+                  WHERE (c.transacao, c.seq) < (a.transacao, a.seq)
+              )
+        """), {"dias": INGESTAO_RETENCAO_DIAS if dias is None else dias})
+        return result.rowcount
+
+
+def atualizar_tabelas_derivadas():
+    """
+    Atualiza o resumo por paciente e os agregados mensais apenas dos pacientes
+    alterados desde a ultima execucao (cada tabela tem sua propria marca).
+
+    Returns:
+        dict: Nome do consumidor -> quantidade de pacientes atualizados.
+    """
+    from db.models import resumo_pacientes_disponivel
+    from db.resumo_pacientes import atualizar_resumo_pacientes
+    from db.coorte import rollup_disponivel, atualizar_rollup_pacientes
+
+    resultado = {}
+    if resumo_pacientes_disponivel():
+        resultado["pacientes_resumo"] = processar_alteracoes("pacientes_resumo", atualizar_resumo_pacientes)
+    if rollup_disponivel():
+        resultado["eventos_rollup_mensal"] = processar_alteracoes("eventos_rollup_mensal", atualizar_rollup_pacientes)
+    return resultado
+
+
+def main():
+    # Mantem as tabelas derivadas em dia a cada alteracao (um unico processo):
+    #     python -m db.ingestao
+    # Ou, agendado (cron), processando o que estiver pendente e saindo:
+    #     python -m db.ingestao --uma-vez
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Atualiza as tabelas derivadas a partir do registro de alteracoes.")
+    parser.add_argument("--uma-vez", action="store_true", help="Processa as alteracoes pendentes e sai.")
+    args = parser.parse_args()
+
+    criar_estruturas()
+    evento = threading.Event()
+    registrar_assinante(lambda ids: evento.set())
+    if not args.uma_vez:
+        iniciar_ouvinte()
+
+    ultima_limpeza = 0
+    while True:
+        evento.clear()
+        resultado = atualizar_tabelas_derivadas()
+        if any(resultado.values()):
+            print(f"Pacientes atualizados: {resultado}")
+        if time.monotonic() - ultima_limpeza > 3600:
+            limpar_alteracoes()
+            ultima_limpeza = time.monotonic()
+        if args.uma_vez:
+            break
+        evento.wait(INGESTAO_INTERVALO_S)
+
+
+if __name__ == '__main__':
+    main()
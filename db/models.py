@@ -1,46 +1,217 @@
-import os
 import json
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from sqlalchemy.exc import OperationalError
-from dotenv import load_dotenv
 from collections import defaultdict
 
+# Conexoes separadas para consultas curtas ("interativo"), varreduras pesadas
+# ("analitico", na replica se configurada) e manutencao (ver db.conexao).
+from db.conexao import conectar, transacao, executar_preparada
+from db.ingestao import ingestao_disponivel, versoes_registradas
+# Leituras identicas simultaneas compartilham uma unica consulta (os resultados nao devem ser alterados).
+from nucleo.concorrencia import coalescido
 
-load_dotenv()
 
-DB_URL = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+# Colunas de mpiv02.events que podem ser pedidas em `buscar_jornada_por_id`.
+COLUNAS_JORNADA = (
+    "id_paciente", "cpf", "data", "descricao", "conjunto",
+    "nome_profissional", "nome_convenio", "fonte", "data_nascimento",
+)
 
-engine = create_engine(DB_URL, pool_pre_ping=True)
+FORMATOS_JORNADA = ("dict", "tupla", "colunar")
+# Tipos dos parametros das consultas de jornada (declarados no PREPARE).
+_TIPOS_JORNADA = {"pid": "TEXT", "data_inicio": "TIMESTAMP", "data_fim": "TIMESTAMP", "limite": "BIGINT"}
 
 
-def buscar_jornada_por_id(patient_id: str):
+@coalescido("db")
+def buscar_jornada_por_id(patient_id: str, colunas: list = None, data_inicio=None, data_fim=None,
+                          limite: int = None, ordem: str = "asc", formato: str = "dict"):
     """
-    Busca todos os eventos (jornada) de um paciente especifico pelo seu ID.
+    Busca os eventos (jornada) de um paciente especifico pelo seu ID, ordenados por data.
     
     Args:
         patient_id (str): O ID unico do paciente.
+        colunas (list, optional): Colunas a retornar (ver COLUNAS_JORNADA). Padrao: todas.
+        data_inicio (optional): Retorna apenas eventos com data maior ou igual a esta.
+        data_fim (optional): Retorna apenas eventos com data menor ou igual a esta.
+        limite (int, optional): Retorna apenas os N eventos mais recentes.
+        ordem (str, optional): "asc" (mais antigo primeiro) ou "desc".
+        formato (str, optional): "dict" (lista de dicionarios), "tupla" (lista de
+            tuplas na ordem de `colunas`) ou "colunar" (dicionario coluna -> lista de valores).
         
     Returns:
-        list: Uma lista de dicionarios, onde cada dicionario representa um evento.
+        list | dict: Os eventos do paciente no formato pedido.
     """
-    # Abre uma conexao com o banco de dados.
-    with engine.connect() as conn:
-        # Define a consulta SQL para buscar eventos de um paciente.
-        query = text("""
-            SELECT 
-                *
-            FROM 
-                mpiv02.events  
-            WHERE 
-                id_paciente = :pid
-            ORDER BY 
-                id_paciente ASC
-        """)
-        # Executa a consulta, passando o ID do paciente como parametro para evitar SQL Injection.
-        result = conn.execute(query, {"pid": patient_id}).fetchall()
-        
-        # Converte o resultado (lista de tuplas) em uma lista de dicionarios.
-        return [dict(row._mapping) for row in result]
+    if colunas is not None:
+        invalidas = [c for c in colunas if c not in COLUNAS_JORNADA]
+        if invalidas:
+            raise ValueError(f"Colunas invalidas: {', '.join(invalidas)}")
+    if ordem not in ("asc", "desc"):
+        raise ValueError(f"Ordem invalida: {ordem}")
+    if formato not in FORMATOS_JORNADA:
+        raise ValueError(f"Formato invalido: {formato}")
+
+    params = {"pid": patient_id}
+    conditions = ["id_paciente = :pid"]
+    if data_inicio is not None:
+        conditions.append("data >= :data_inicio")
+        params["data_inicio"] = data_inicio
+    if data_fim is not None:
+        conditions.append("data <= :data_fim")
+        params["data_fim"] = data_fim
+
+    # Com limite, busca os N mais recentes (ORDER BY data DESC LIMIT N) e, se a ordem
+    # pedida for crescente, inverte a lista ja em memoria. Eventos sem data ficam por
+    # ultimo na ordem decrescente, para nao ocuparem o lugar dos mais recentes.
+    direcao = "DESC NULLS LAST" if limite or ordem == "desc" else "ASC"
+    query_sql = f"""
+        SELECT 
+            {', '.join(colunas) if colunas else '*'}
+        FROM 
+            mpiv02.events  
+        WHERE 
+            {' AND '.join(conditions)}
+        ORDER BY 
+            data {direcao}
+    """
+    if limite:
+        query_sql += " LIMIT :limite"
+        params["limite"] = int(limite)
+
+    # Abre uma conexao com o banco de dados. O ID e passado como parametro para evitar SQL Injection.
+    # A consulta e atendida pelo indice (id_paciente, data) criado em `criar_indices`.
+    # Para cada combinacao de colunas e filtros o SQL e sempre o mesmo, entao e preparado no servidor.
+    with conectar() as conn:
+        result = executar_preparada(conn, query_sql, params, tipos=_TIPOS_JORNADA)
+        nomes = list(result.keys())
+        linhas = result.fetchall()
+
+    if direcao != "ASC" and ordem == "asc":
+        linhas.reverse()
+
+    if formato == "tupla":
+        return [tuple(row) for row in linhas]
+    if formato == "colunar":
+        return {nome: [row[i] for row in linhas] for i, nome in enumerate(nomes)}
+    # Converte o resultado (lista de tuplas) em uma lista de dicionarios.
+    return [dict(row._mapping) for row in linhas]
+
+
+@coalescido("db")
+def versao_paciente(patient_id: str):
+    """
+    Retorna uma versao dos dados de um paciente, que muda sempre que ele recebe
+    novos eventos. Usada como parte da chave de caches derivados da jornada.
+
+    Args:
+        patient_id (str): O ID unico do paciente.
+
+    Returns:
+        str: Data do ultimo evento e quantidade de eventos, ex.: "2024-05-01 10:00:00|532".
+             Com o registro de alteracoes (db.ingestao), inclui tambem o numero da
+             ultima alteracao, que muda ate quando eventos antigos sao editados.
+    """
+    if ingestao_disponivel():
+        return versoes_registradas([patient_id])[str(patient_id)]
+    with conectar() as conn:
+        row = executar_preparada(conn, """
+            SELECT MAX(data) AS ultima_data, COUNT(*) AS total
+            FROM mpiv02.events
+            WHERE id_paciente = :pid
+        """, {"pid": patient_id}, tipos={"pid": "TEXT"}).one()
+        return f"{row.ultima_data}|{row.total}"
+
+
+def versoes_pacientes(ids: list):
+    """
+    Versao de `versao_paciente` para varios pacientes em uma unica consulta.
+
+    Args:
+        ids (list): IDs dos pacientes.
+
+    Returns:
+        dict: ID do paciente -> versao (no mesmo formato de `versao_paciente`).
+              Pacientes sem eventos ficam com a versao "None|0".
+    """
+    versoes = {str(pid): "None|0" for pid in ids}
+    if not versoes:
+        return versoes
+    if ingestao_disponivel():
+        return versoes_registradas(list(versoes))
+    with conectar() as conn:
+        result = executar_preparada(conn, """
+            SELECT id_paciente, MAX(data) AS ultima_data, COUNT(*) AS total
+            FROM mpiv02.events
+            WHERE id_paciente = ANY(:ids)
+            GROUP BY id_paciente
+        """, {"ids": list(versoes)}, tipos={"ids": "TEXT[]"})
+        for row in result:
+            versoes[str(row.id_paciente)] = f"{row.ultima_data}|{row.total}"
+    return versoes
+
+
+def buscar_jornadas_por_ids(ids: list, colunas: list = None, limite_por_paciente: int = None):
+    """
+    Busca a jornada de varios pacientes em uma unica consulta, em vez de uma
+    consulta por paciente.
+
+    Args:
+        ids (list): IDs dos pacientes.
+        colunas (list, optional): Colunas retornadas (subconjunto de COLUNAS_JORNADA).
+        limite_por_paciente (int, optional): Quantidade maxima de eventos mais recentes
+            de cada paciente (ROW_NUMBER por paciente).
+
+    Returns:
+        dict: ID do paciente -> lista de dicionarios em ordem crescente de data.
+              Pacientes sem eventos ficam com a lista vazia.
+    """
+    colunas = list(colunas or COLUNAS_JORNADA)
+    invalidas = [c for c in colunas if c not in COLUNAS_JORNADA]
+    if invalidas:
+        raise ValueError(f"Colunas invalidas: {', '.join(invalidas)}")
+
+    jornadas = {str(pid): [] for pid in ids}
+    if not jornadas:
+        return jornadas
+
+    params = {"ids": list(jornadas)}
+    selecionadas = ", ".join(c for c in colunas if c != "id_paciente")
+    filtro_limite = ""
+    if limite_por_paciente:
+        filtro_limite = "WHERE t.posicao <= :limite"
+        params["limite"] = int(limite_por_paciente)
+
+    with conectar() as conn:
+        result = executar_preparada(conn, f"""
+            SELECT t.*
+            FROM (
+                SELECT
+                    id_paciente, {selecionadas},
+                    ROW_NUMBER() OVER (PARTITION BY id_paciente ORDER BY data DESC NULLS LAST) AS posicao
+                FROM mpiv02.events
+                WHERE id_paciente = ANY(:ids)
+            ) t
+            {filtro_limite}
+            ORDER BY t.id_paciente, t.data
+        """, params, tipos={"ids": "TEXT[]", "limite": "BIGINT"})
+        for row in result:
+            registro = {c: getattr(row, c) for c in colunas}
+            jornadas[str(row.id_paciente)].append(registro)
+    return jornadas
+
+
+def criar_indices():
+    """
+    Cria os indices compostos (id_paciente, data) usados na busca da jornada de um
+    paciente, que atendem o filtro por paciente, o intervalo de datas e a ordenacao.
+    A leitura de tras para frente do indice crescente devolve os nulos primeiro, por
+    isso a ordem decrescente com NULLS LAST tem um indice proprio.
+    """
+    with transacao() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS events_paciente_data_idx ON mpiv02.events (id_paciente, data)"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS events_paciente_data_desc_idx "
+            "ON mpiv02.events (id_paciente, data DESC NULLS LAST)"
+        ))
 
 
 def buscar_convenios():
@@ -50,7 +221,7 @@ def buscar_convenios():
     Returns:
         list: Uma lista de strings com os nomes dos convenios.
     """
-    with engine.connect() as conn:
+    with conectar("analitico") as conn:
         query = text("""
             SELECT DISTINCT 
                 nome_convenio
@@ -73,7 +244,7 @@ def buscar_profissionais():
     Returns:
         list: Uma lista de strings com os nomes dos profissionais.
     """
-    with engine.connect() as conn:
+    with conectar("analitico") as conn:
         query = text("""
             SELECT DISTINCT 
                 nome_profissional
@@ -96,7 +267,7 @@ def busca_conjunto():
     Returns:
         list: Uma lista de strings com os nomes dos conjuntos.
     """
-    with engine.connect() as conn:
+    with conectar("analitico") as conn:
         query = text("""
             SELECT DISTINCT 
                 conjunto
@@ -113,9 +284,43 @@ def busca_conjunto():
         return [row[0] for row in result]
 
 
-def filtrar_pacientes(idade_min: int = None, idade_max: int = None, convenios: list = None, profissionais: list = None, conjuntos: list = None, termos_busca: list = None):
+# Indica se a tabela de resumo por paciente ja foi encontrada carregada no banco.
+_resumo_disponivel = False
+
+
+def resumo_pacientes_disponivel():
+    """
+    Verifica se a tabela de resumo por paciente (mpiv02.pacientes_resumo) ja foi criada
+    e carregada. Ela e criada vazia; so vale consulta-la depois da primeira carga,
+    que registra a marca d'agua em mpiv02.pacientes_resumo_controle.
+    O resultado positivo fica guardado para nao repetir a consulta a cada filtro.
+
+    Returns:
+        bool: True se a tabela existir e ja tiver sido carregada.
+    """
+    global _resumo_disponivel
+    if _resumo_disponivel:
+        return True
+    with conectar() as conn:
+        existe = conn.execute(text("SELECT to_regclass('mpiv02.pacientes_resumo_controle') IS NOT NULL")).scalar()
+        if existe:
+            existe = conn.execute(text("""
+                SELECT EXISTS (SELECT 1 FROM mpiv02.pacientes_resumo_controle WHERE marca_dagua IS NOT NULL)
+            """)).scalar()
+    _resumo_disponivel = bool(existe)
+    return _resumo_disponivel
+
+
+@coalescido("db")
+def filtrar_pacientes(idade_min: int = None, idade_max: int = None, convenios: list = None, profissionais: list = None, conjuntos: list = None, termos_busca: list = None,
+                      modo_busca: str = None, prefixo: bool = True, stemming: bool = False, ranquear: bool = False,
+                      limite: int = None, apos_id=None):
     """
     Filtra pacientes com base em uma combinacao de criterios.
+
+    Quando a tabela de resumo por paciente existe, a consulta e feita sobre ela
+    (uma linha por paciente, com indices para idade e listas). Caso contrario,
+    a agregacao e feita diretamente sobre mpiv02.events.
     
     Args:
         idade_min (int, optional): Idade minima do paciente.
@@ -124,85 +329,254 @@ def filtrar_pacientes(idade_min: int = None, idade_max: int = None, convenios: l
         profissionais (list, optional): Lista de nomes de profissionais.
         conjuntos (list, optional): Lista de nomes de conjuntos.
         termos_busca (list, optional): Lista de termos para buscar na descricao dos eventos.
+        modo_busca (str, optional): "trigrama", "texto" ou "ilike" (ver db.busca_texto).
+            Por padrao usa "trigrama" se os indices de busca existirem, senao "ilike".
+        prefixo (bool, optional): No modo "texto", aceita palavras que comecem com o termo.
+        stemming (bool, optional): No modo "texto", compara pelo radical das palavras.
+        ranquear (bool, optional): Ordena os pacientes pela relevancia dos termos
+            encontrados em vez do ID. Requer a tabela de resumo.
+        limite (int, optional): Quantidade maxima de pacientes retornados (uma pagina).
+        apos_id (optional): Cursor de paginacao; retorna apenas pacientes com ID maior
+            que este. Ignorado quando `ranquear` for True.
         
     Returns:
         list: Uma lista de dicionarios, cada um representando um paciente que
-              corresponde aos filtros, com seu ID, idade e total de eventos.
+              corresponde aos filtros, com seu ID, idade e total de eventos
+              (e a relevancia, quando `ranquear` for True).
     """
-
+    consulta = _montar_consulta_pacientes(
+        idade_min, idade_max, convenios, profissionais, conjuntos, termos_busca,
+        modo_busca, prefixo, stemming, ranquear, apos_id
+    )
     # Se nenhum filtro for fornecido, retorna uma lista vazia para evitar
     # uma consulta desnecessariamente pesada ao banco.
-    if idade_min is None and idade_max is None and not convenios and not profissionais and not conjuntos and not termos_busca:
+    if consulta is None:
         return []
 
-    with engine.connect() as conn:
-        # Dicionario para armazenar os parametros da consulta de forma segura.
-        params = {}
-        
-        # Lista para construir as condicoes da subquery dinamicamente.
-        subquery_conditions = []
-        
-        # Adiciona condicoes para filtros baseados em listas (convenios, profissionais, conjuntos).
-        if convenios:
-            subquery_conditions.append("nome_convenio = ANY(:convenios)")
-            params["convenios"] = convenios
-        if profissionais:
-            subquery_conditions.append("nome_profissional = ANY(:profissionais)")
-            params["profissionais"] = profissionais
-        if conjuntos:
-            subquery_conditions.append("conjunto = ANY(:conjuntos)")
-            params["conjuntos"] = conjuntos
-        
-        # Adiciona condicoes para busca por termos na descricao do evento.
-        if termos_busca:
-            for i, termo in enumerate(termos_busca):
-                param_name = f"termo_{i}"
-                # A condicao busca o termo em qualquer lugar da descricao (case-insensitive ILIKE).
-                subquery_conditions.append(f"""
-                    id_paciente IN (
-                        SELECT id_paciente FROM mpiv02.events WHERE descricao ILIKE :{param_name}
-                    )
-                """)
-                params[param_name] = f"%{termo}%"
-
-        # Monta o trecho SQL da subquery se alguma condicao foi adicionada.
-        mpi_filter_subquery = ""
-        if subquery_conditions:
-            mpi_filter_subquery = f"""
-                AND t.id_paciente IN (
-                    SELECT DISTINCT id_paciente
-                    FROM mpiv02.events
-                    WHERE {' AND '.join(subquery_conditions)}
-                )
-            """
-
-        # Monta a clausula HAVING para filtrar por faixa de idade, se aplicavel.
-        # HAVING e usado porque a idade e calculada apos o agrupamento (GROUP BY).
-        having_clause = ""
-        if idade_min is not None and idade_max is not None:
-            having_clause = "HAVING EXTRACT(YEAR FROM AGE(NOW(), t.data_nascimento)) BETWEEN :idade_min AND :idade_max"
-            params["idade_min"] = idade_min
-            params["idade_max"] = idade_max
-
-        main_query_sql = f"""
-            SELECT
-                t.id_paciente,
-                EXTRACT(YEAR FROM AGE(NOW(), t.data_nascimento)) AS idade_calculada,
-                COUNT(*) AS total_eventos
-            FROM
-                mpiv02.events t
-            WHERE
-                t.data_nascimento IS NOT NULL
-                {mpi_filter_subquery}
-            GROUP BY
-                t.id_paciente, t.data_nascimento
-            {having_clause}
-            ORDER BY
-                t.id_paciente;
+    sql, params, ordenacao = consulta
+    sql = f"{sql} ORDER BY {ordenacao}"
+    if limite:
+        sql += " LIMIT :limite"
+        params["limite"] = int(limite)
+
+    with conectar("analitico") as conn:
+        result = conn.execute(text(sql), params).fetchall()
+        return [dict(row._mapping) for row in result]
+
+
+@coalescido("db")
+def contar_pacientes(**filtros):
+    """
+    Conta os pacientes e eventos que correspondem aos filtros, sem trazer as linhas.
+    Aceita os mesmos criterios de `filtrar_pacientes`.
+
+    Returns:
+        dict: {"total_pacientes": int, "total_eventos": int}
+    """
+    filtros.pop("ranquear", None)
+    filtros.pop("apos_id", None)
+    consulta = _montar_consulta_pacientes(**filtros)
+    if consulta is None:
+        return {"total_pacientes": 0, "total_eventos": 0}
+
+    sql, params, _ = consulta
+    with conectar("analitico") as conn:
+        row = conn.execute(text(f"""
+            SELECT COUNT(*) AS total_pacientes, COALESCE(SUM(total_eventos), 0) AS total_eventos
+            FROM ({sql}) pacientes
+        """), params).one()
+        return {"total_pacientes": int(row.total_pacientes), "total_eventos": int(row.total_eventos)}
+
+
+def iterar_pacientes(tamanho_lote: int = 500, **filtros):
+    """
+    Percorre os pacientes que correspondem aos filtros usando um cursor no servidor,
+    sem carregar o resultado inteiro na memoria. Aceita os mesmos criterios de
+    `filtrar_pacientes`.
+
+    Args:
+        tamanho_lote (int): Quantidade de linhas buscadas do banco por vez.
+
+    Yields:
+        dict: Um paciente por vez, no mesmo formato de `filtrar_pacientes`.
+    """
+    consulta = _montar_consulta_pacientes(**filtros)
+    if consulta is None:
+        return
+
+    sql, params, ordenacao = consulta
+    with conectar("analitico") as conn:
+        result = conn.execution_options(stream_results=True, yield_per=tamanho_lote).execute(
+            text(f"{sql} ORDER BY {ordenacao}"), params
+        )
+        for row in result:
+            yield dict(row._mapping)
+
+
+def _montar_consulta_pacientes(idade_min: int = None, idade_max: int = None, convenios: list = None, profissionais: list = None, conjuntos: list = None, termos_busca: list = None,
+                               modo_busca: str = None, prefixo: bool = True, stemming: bool = False, ranquear: bool = False, apos_id=None):
+    """
+    Monta a consulta de pacientes compartilhada por `filtrar_pacientes`,
+    `contar_pacientes` e `iterar_pacientes`.
+
+    Returns:
+        tuple: (SQL sem ORDER BY, parametros, expressao de ordenacao), ou None
+               se nenhum filtro for informado.
+    """
+    # Importado aqui porque db.busca_texto tambem depende deste modulo.
+    from db.busca_texto import montar_busca_termos, escolher_modo_busca
+
+    if idade_min is None and idade_max is None and not convenios and not profissionais and not conjuntos and not termos_busca:
+        return None
+
+    if termos_busca:
+        # Um modo sem as estruturas no banco (ex.: "texto" sem as configuracoes) daria erro na consulta.
+        modo_busca = escolher_modo_busca(modo_busca)
+
+    if not resumo_pacientes_disponivel():
+        return _montar_consulta_pacientes_eventos(idade_min, idade_max, convenios, profissionais, conjuntos, termos_busca, modo_busca, prefixo, stemming, apos_id)
+
+    params = {}
+    conditions = ["r.data_nascimento IS NOT NULL"]
+
+    # A faixa de idade e convertida em um intervalo de datas de nascimento,
+    # o que permite usar o indice em vez de calcular AGE() para cada paciente.
+    if idade_min is not None and idade_max is not None:
+        conditions.append("r.data_nascimento <= CURRENT_DATE - make_interval(years => :idade_min)")
+        conditions.append("r.data_nascimento > CURRENT_DATE - make_interval(years => :idade_max + 1)")
+        params["idade_min"] = idade_min
+        params["idade_max"] = idade_max
+
+    # Filtros por listas usam sobreposicao de arrays (&&), atendida pelos indices GIN.
+    filtros_lista = [
+        ("convenios", "nome_convenio", convenios),
+        ("profissionais", "nome_profissional", profissionais),
+        ("conjuntos", "conjunto", conjuntos),
+    ]
+    filtros_ativos = [(coluna_resumo, coluna_evento) for coluna_resumo, coluna_evento, valores in filtros_lista if valores]
+    for coluna_resumo, coluna_evento, valores in filtros_lista:
+        if valores:
+            conditions.append(f"r.{coluna_resumo} && CAST(:{coluna_resumo} AS text[])")
+            params[coluna_resumo] = list(valores)
+
+    # Com mais de uma lista, o criterio original exige que um mesmo evento
+    # satisfaca todas elas; o resumo serve apenas como pre-filtro nesse caso.
+    if len(filtros_ativos) > 1:
+        condicoes_evento = " AND ".join(
+            f"e.{coluna_evento} = ANY(:{coluna_resumo})" for coluna_resumo, coluna_evento in filtros_ativos
+        )
+        conditions.append(f"""
+            EXISTS (
+                SELECT 1 FROM mpiv02.events e
+                WHERE e.id_paciente = r.id_paciente AND {condicoes_evento}
+            )
+        """)
+
+    # Todos os termos sao resolvidos em uma unica subconsulta sobre a descricao dos eventos.
+    busca_sql = None
+    if termos_busca:
+        busca_sql, busca_params = montar_busca_termos(termos_busca, modo_busca, prefixo, stemming)
+        params.update(busca_params)
+
+    ranqueado = bool(busca_sql and ranquear)
+    # Paginacao por keyset: a proxima pagina comeca apos o ultimo ID retornado.
+    if apos_id is not None and not ranqueado:
+        conditions.append("r.id_paciente > :apos_id")
+        params["apos_id"] = apos_id
+
+    juncao_busca = f"JOIN ({busca_sql}) b ON b.id_paciente = r.id_paciente" if busca_sql else ""
+    coluna_relevancia = ", b.relevancia" if ranqueado else ""
+    ordenacao = "relevancia DESC, id_paciente" if ranqueado else "id_paciente"
+
+    sql = f"""
+        SELECT
+            r.id_paciente,
+            EXTRACT(YEAR FROM AGE(NOW(), r.data_nascimento)) AS idade_calculada,
+            r.total_eventos
+            {coluna_relevancia}
+        FROM
+            mpiv02.pacientes_resumo r
+            {juncao_busca}
+        WHERE
+            {' AND '.join(conditions)}
+    """
+    return sql, params, ordenacao
+
+
+def _montar_consulta_pacientes_eventos(idade_min: int = None, idade_max: int = None, convenios: list = None, profissionais: list = None, conjuntos: list = None, termos_busca: list = None,
+                                       modo_busca: str = "ilike", prefixo: bool = True, stemming: bool = False, apos_id=None):
+    """
+    Versao de `_montar_consulta_pacientes` que agrega diretamente sobre mpiv02.events.
+    Usada enquanto a tabela de resumo por paciente nao foi criada.
+    """
+    from db.busca_texto import montar_busca_termos
+
+    # Dicionario para armazenar os parametros da consulta de forma segura.
+    params = {}
+    
+    # Lista para construir as condicoes da subquery dinamicamente.
+    subquery_conditions = []
+    
+    # Adiciona condicoes para filtros baseados em listas (convenios, profissionais, conjuntos).
+    if convenios:
+        subquery_conditions.append("nome_convenio = ANY(:convenios)")
+        params["convenios"] = convenios
+    if profissionais:
+        subquery_conditions.append("nome_profissional = ANY(:profissionais)")
+        params["profissionais"] = profissionais
+    if conjuntos:
+        subquery_conditions.append("conjunto = ANY(:conjuntos)")
+        params["conjuntos"] = conjuntos
+    
+    # Adiciona a condicao de busca por termos na descricao do evento (uma unica subconsulta).
+    if termos_busca:
+        busca_sql, busca_params = montar_busca_termos(termos_busca, modo_busca, prefixo, stemming)
+        if busca_sql:
+            subquery_conditions.append(f"id_paciente IN (SELECT id_paciente FROM ({busca_sql}) b)")
+            params.update(busca_params)
+
+    # Monta o trecho SQL da subquery se alguma condicao foi adicionada.
+    mpi_filter_subquery = ""
+    if subquery_conditions:
+        mpi_filter_subquery = f"""
+            AND t.id_paciente IN (
+                SELECT DISTINCT id_paciente
+                FROM mpiv02.events
+                WHERE {' AND '.join(subquery_conditions)}
+            )
         """
 
-        query = text(main_query_sql)
-        result = conn.execute(query, params).fetchall()
-        
-        # Converte o resultado para uma lista de dicionarios e a retorna.
-        return [dict(row._mapping) for row in result]
\ No newline at end of file
+    # Paginacao por keyset: a proxima pagina comeca apos o ultimo ID retornado.
+    if apos_id is not None:
+        mpi_filter_subquery += " AND t.id_paciente > :apos_id"
+        params["apos_id"] = apos_id
+
+    # Monta a clausula HAVING para filtrar por faixa de idade, se aplicavel.
+    # HAVING e usado porque a idade e calculada apos o agrupamento (GROUP BY).
+    having_clause = ""
+    if idade_min is not None and idade_max is not None:
+        having_clause = "HAVING EXTRACT(YEAR FROM AGE(NOW(), t.data_nascimento)) BETWEEN :idade_min AND :idade_max"
+        params["idade_min"] = idade_min
+        params["idade_max"] = idade_max
+
+    sql = f"""
+        SELECT
+            t.id_paciente,
+            EXTRACT(YEAR FROM AGE(NOW(), t.data_nascimento)) AS idade_calculada,
+            COUNT(*) AS total_eventos
+        FROM
+            mpiv02.events t
+        WHERE
+            t.data_nascimento IS NOT NULL
+            {mpi_filter_subquery}
+        GROUP BY
+            t.id_paciente, t.data_nascimento
+        {having_clause}
+    """
+    return sql, params, "id_paciente"
+
+
+if __name__ == '__main__':
+    # Cria os indices basicos de mpiv02.events: python -m db.models
+    criar_indices()
+    print("Indices criados.")
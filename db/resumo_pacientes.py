@@ -0,0 +1,166 @@
+from sqlalchemy import text
+
+from db.conexao import conectar, transacao
+
+
+# Colunas agregadas de cada paciente. A tabela de resumo e criada a partir desta
+# mesma consulta, assim os tipos das colunas seguem os tipos de mpiv02.events.
+SELECT_RESUMO = """
+    SELECT
+        e.id_paciente,
+        MAX(e.data_nascimento) AS data_nascimento,
+        COUNT(e.data_nascimento) AS total_eventos,
+        MIN(e.data) AS primeiro_evento,
+        MAX(e.data) AS ultimo_evento,
+        COALESCE(ARRAY_AGG(DISTINCT e.nome_convenio::text) FILTER (WHERE e.nome_convenio IS NOT NULL), '{}') AS convenios,
+        COALESCE(ARRAY_AGG(DISTINCT e.nome_profissional::text) FILTER (WHERE e.nome_profissional IS NOT NULL), '{}') AS profissionais,
+        COALESCE(ARRAY_AGG(DISTINCT e.conjunto::text) FILTER (WHERE e.conjunto IS NOT NULL), '{}') AS conjuntos
+    FROM
+        mpiv02.events e
+"""
+
+COLUNAS_RESUMO = [
+    "data_nascimento", "total_eventos", "primeiro_evento", "ultimo_evento",
+    "convenios", "profissionais", "conjuntos",
+]
+
+
+def criar_estruturas():
+    """
+    Cria a tabela de resumo por paciente, seus indices e a tabela de controle
+    da marca d'agua usada na atualizacao incremental. Pode ser executada varias vezes.
+    """
+    with transacao() as conn:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS mpiv02.pacientes_resumo AS
+            {SELECT_RESUMO}
+            GROUP BY e.id_paciente
+            WITH NO DATA
+        """))
+        conn.execute(text("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint WHERE conname = 'pacientes_resumo_pkey'
+                ) THEN
+                    ALTER TABLE mpiv02.pacientes_resumo ADD CONSTRAINT pacientes_resumo_pkey PRIMARY KEY (id_paciente);
+                END IF;
+            END $$
+        """))
+        # Faixas de idade viram uma busca por intervalo de data de nascimento.
+        conn.execute(text("CREATE INDEX IF NOT EXISTS pacientes_resumo_nascimento_idx ON mpiv02.pacientes_resumo (data_nascimento)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS pacientes_resumo_ultimo_evento_idx ON mpiv02.pacientes_resumo (ultimo_evento)"))
+        # Filtros por listas usam o operador de sobreposicao de arrays (&&), atendido por indices GIN.
+        for coluna in ("convenios", "profissionais", "conjuntos"):
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS pacientes_resumo_{coluna}_idx ON mpiv02.pacientes_resumo USING GIN ({coluna})"))
+        # Indice usado para encontrar rapidamente os eventos posteriores a marca d'agua.
+        conn.execute(text("CREATE INDEX IF NOT EXISTS events_data_idx ON mpiv02.events (data)"))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS mpiv02.pacientes_resumo_controle (
+                id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                marca_dagua TIMESTAMP,
+                atualizado_em TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """))
+
+
+def atualizar_resumo_pacientes(ids_pacientes: list):
+    """
+    Recalcula a linha de resumo dos pacientes informados a partir de mpiv02.events.
+    Pacientes que nao tem mais eventos saem do resumo.
+
+    Args:
+        ids_pacientes (list): IDs dos pacientes que tiveram eventos alterados.
+
+    Returns:
+        int: Quantidade de pacientes atualizados.
+    """
+    if not ids_pacientes:
+        return 0
+
+    atribuicoes = ", ".join(f"{c} = EXCLUDED.{c}" for c in COLUNAS_RESUMO)
+    with transacao() as conn:
+        result = conn.execute(text(f"""
+            INSERT INTO mpiv02.pacientes_resumo
+            {SELECT_RESUMO}
+            WHERE e.id_paciente = ANY(:ids)
+            GROUP BY e.id_paciente
+            ON CONFLICT (id_paciente) DO UPDATE SET {atribuicoes}
+        """), {"ids": list(ids_pacientes)})
+        conn.execute(text("""
+            DELETE FROM mpiv02.pacientes_resumo r
+            WHERE r.id_paciente = ANY(:ids)
+              AND NOT EXISTS (SELECT 1 FROM mpiv02.events e WHERE e.id_paciente = r.id_paciente)
+        """), {"ids": list(ids_pacientes)})
+        return result.rowcount
+
+
+def reconstruir_resumo():
+    """
+    Reconstroi a tabela de resumo inteira. Usado na primeira carga ou quando a
+    tabela precisa ser refeita do zero.
+
+    Returns:
+        int: Quantidade de pacientes na tabela apos a reconstrucao.
+    """
+    with transacao() as conn:
+        marca = conn.execute(text("SELECT MAX(data) FROM mpiv02.events")).scalar()
+        conn.execute(text("TRUNCATE mpiv02.pacientes_resumo"))
+        result = conn.execute(text(f"""
+            INSERT INTO mpiv02.pacientes_resumo
+            {SELECT_RESUMO}
+            GROUP BY e.id_paciente
+        """))
+        _gravar_marca_dagua(conn, marca)
+        return result.rowcount
+
+
+def atualizar_resumo_incremental():
+    """
+    Atualiza apenas os pacientes que receberam eventos com data posterior a
+    ultima marca d'agua registrada. Se ainda nao houver marca, reconstroi tudo.
+
+    Observacao: a marca d'agua usa a coluna `data` dos eventos, entao eventos
+    inseridos com data anterior a marca nao sao percebidos por esta funcao;
+    nesses casos use `atualizar_resumo_pacientes` com os IDs afetados.
+
+    Returns:
+        int: Quantidade de pacientes atualizados.
+    """
+    with conectar("manutencao") as conn:
+        marca = conn.execute(text("SELECT marca_dagua FROM mpiv02.pacientes_resumo_controle WHERE id = 1")).scalar()
+    if marca is None:
+        return reconstruir_resumo()
+
+    with conectar("manutencao") as conn:
+        result = conn.execute(text("""
+            SELECT id_paciente, MAX(data) AS ultima_data
+            FROM mpiv02.events
+            WHERE data > :marca
+            GROUP BY id_paciente
+        """), {"marca": marca}).fetchall()
+
+    if not result:
+        return 0
+
+    total = atualizar_resumo_pacientes([row[0] for row in result])
+    with transacao() as conn:
+        _gravar_marca_dagua(conn, max(row[1] for row in result))
+    return total
+
+
+def _gravar_marca_dagua(conn, marca):
+    """
+    Registra ate qual data os eventos ja foram incorporados ao resumo.
+    """
+    conn.execute(text("""
+        INSERT INTO mpiv02.pacientes_resumo_controle (id, marca_dagua, atualizado_em)
+        VALUES (1, :marca, NOW())
+        ON CONFLICT (id) DO UPDATE SET marca_dagua = EXCLUDED.marca_dagua, atualizado_em = NOW()
+    """), {"marca": marca})
+
+
+if __name__ == '__main__':
+    # Pode ser agendado (cron) para manter o resumo atualizado: python -m db.resumo_pacientes
+    criar_estruturas()
+    print(f"Pacientes atualizados: {atualizar_resumo_incremental()}")
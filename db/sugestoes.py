@@ -0,0 +1,243 @@
+import os
+import re
+import heapq
+import bisect
+import threading
+from collections import Counter
+
+from db.busca_texto import normalizar_texto
+from db.cache_listas import obter_lista_com_etag, CARREGADORES
+from nucleo.concorrencia import coalescer
+
+
+# Sugestoes retornadas por padrao e no maximo por '/suggest'.
+SUGESTOES_LIMITE = int(os.getenv("SUGESTOES_LIMITE", "10"))
+SUGESTOES_LIMITE_MAX = 50
+# Semelhanca minima (0 a 1, por trigramas) para sugerir um nome com erro de digitacao.
+SUGESTOES_SEMELHANCA_MIN = float(os.getenv("SUGESTOES_SEMELHANCA_MIN", "0.4"))
+# Semelhanca minima para trocar um nome extraido pela IA pelo nome cadastrado mais parecido.
+RESOLVER_SEMELHANCA_MIN = float(os.getenv("RESOLVER_SEMELHANCA_MIN", "0.6"))
+
+# Titulos ignorados na comparacao ("Dr. Carlos" -> "carlos").
+_TITULOS = {"dr", "dra", "doutor", "doutora", "prof", "profa", "professor", "professora", "sr", "sra"}
+_NAO_ALFANUMERICO = re.compile(r"[^a-z0-9]+")
+
+# Nome da lista -> (etag da lista, indice).
+_indices = {}
+_lock = threading.Lock()
+
+
+def chave_nome(texto: str):
+    """
+    Forma usada na comparacao: sem acentos, caixa, pontuacao e titulos.
+    Ex.: "Dr. Carlos Alberto" -> "carlos alberto".
+    """
+    palavras = _NAO_ALFANUMERICO.sub(" ", normalizar_texto(texto)).split()
+    return " ".join(p for p in palavras if p not in _TITULOS)
+
+
+def _trigramas(chave: str):
+    """
+    Trigramas de cada palavra, com espacos nas bordas (como no pg_trgm).
+    """
+    trigramas = set()
+    for palavra in chave.split():
+        palavra = f"  {palavra} "
+        trigramas.update(palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return trigramas
+
+
+class _Indice:
+    """
+    Indice em memoria de uma lista de nomes: chaves e palavras ordenadas (busca
+    por prefixo com bisect) e trigramas (busca aproximada).
+    """
+
+    def __init__(self, valores: list):
+        self.valores = list(valores)
+        self.chaves = [chave_nome(v) for v in self.valores]
+        # Ordem de exibicao: nomes mais curtos primeiro, depois alfabetica.
+        self.ordem = sorted(range(len(self.valores)), key=lambda i: (len(self.chaves[i]), self.chaves[i]))
+        self.posicao = {i: n for n, i in enumerate(self.ordem)}
+        self.por_chave = {}
+        for i, chave in enumerate(self.chaves):
+            self.por_chave.setdefault(chave, []).append(i)
+        # (palavra, indice do nome) de todas as palavras de todos os nomes, ordenadas.
+        self.palavras = sorted({(p, i) for i, chave in enumerate(self.chaves) for p in chave.split()})
+        self.trigramas = {}
+        self.tamanhos = []
+        for i, chave in enumerate(self.chaves):
+            trigramas = _trigramas(chave)
+            self.tamanhos.append(len(trigramas))
+            for t in trigramas:
+                self.trigramas.setdefault(t, []).append(i)
+
+    def por_prefixo(self, chave: str):
+        """
+        Nomes em que cada palavra da consulta e o comeco de alguma palavra do nome
+        ("car sil" -> "Carlos Silva").
+
+        Returns:
+            set: Indices dos nomes encontrados.
+        """
+        encontrados = None
+        for palavra in chave.split():
+            inicio = bisect.bisect_left(self.palavras, (palavra,))
+            fim = bisect.bisect_left(self.palavras, (palavra + "\uffff",))
+            nomes = {i for _, i in self.palavras[inicio:fim]}
+            encontrados = nomes if encontrados is None else encontrados & nomes
+            if not encontrados:
+                break
+        return encontrados or set()
+
+    def por_palavras(self, chave: str):
+        """
+        Nomes que tem todas as palavras da consulta, inteiras ("maria" -> "Ana Maria",
+        mas nao "Mariana").
+
+        Returns:
+            set: Indices dos nomes encontrados.
+        """
+        encontrados = None
+        for palavra in chave.split():
+            inicio = bisect.bisect_left(self.palavras, (palavra,))
+            fim = bisect.bisect_left(self.palavras, (palavra, len(self.valores)))
+            nomes = {i for _, i in self.palavras[inicio:fim]}
+            encontrados = nomes if encontrados is None else encontrados & nomes
+            if not encontrados:
+                break
+        return encontrados or set()
+
+    def aproximados(self, chave: str, minimo: float, inteiro: bool):
+        """
+        Nomes com trigramas em comum com a consulta. Com `inteiro`, compara o nome
+        todo (Jaccard); senao, so quanto da consulta aparece no nome, como em uma
+        busca enquanto o usuario digita.
+
+        Returns:
+            list: (semelhanca, indice) acima de `minimo`, da mais parecida para a menos.
+        """
+        trigramas = _trigramas(chave)
+        if not trigramas:
+            return []
+        comuns = Counter()
+        for t in trigramas:
+            comuns.update(self.trigramas.get(t, ()))
+        resultado = []
+        for i, n in comuns.items():
+            semelhanca = n / (len(trigramas) + self.tamanhos[i] - n) if inteiro else n / len(trigramas)
+            if semelhanca >= minimo:
+                resultado.append((semelhanca, i))
+        resultado.sort(key=lambda item: (-item[0], self.posicao[item[1]]))
+        return resultado
+
+
+def _obter_indice(nome: str):
+    """
+    Retorna o indice da lista, refeito apenas quando o conteudo dela muda (ETag).
+    Requisicoes que chegam durante a construcao aguardam o mesmo indice.
+    """
+    valores, etag = obter_lista_com_etag(nome)
+    with _lock:
+        atual = _indices.get(nome)
+    if atual is not None and atual[0] == etag:
+        return atual[1]
+    indice = coalescer("sugestoes", (nome, etag), _Indice, valores)
+    with _lock:
+        _indices[nome] = (etag, indice)
+    return indice
+
+
+def sugerir(nome: str, consulta: str, limite: int = None):
+    """
+    Sugere nomes de uma lista para o texto digitado, sem diferenciar acentos e
+    caixa: primeiro os que comecam com a consulta, depois os que tem palavras
+    comecando com ela e, se nenhum for encontrado, os mais parecidos (erros de digitacao).
+
+    Args:
+        nome (str): Lista ("convenios", "profissionais" ou "conjuntos").
+        consulta (str): Texto digitado (vazio retorna os primeiros nomes).
+        limite (int, optional): Quantidade maxima de sugestoes (padrao SUGESTOES_LIMITE).
+
+    Returns:
+        list: Nomes cadastrados, do mais ao menos relevante.
+    """
+    if nome not in CARREGADORES:
+        raise KeyError(f"Lista desconhecida: {nome}")
+    limite = SUGESTOES_LIMITE if limite is None else limite
+    indice = _obter_indice(nome)
+    chave = chave_nome(consulta)
+    if not chave:
+        return [indice.valores[i] for i in indice.ordem[:limite]]
+
+    prefixos = indice.por_prefixo(chave)
+    # O nome inteiro comecando com a consulta vem antes de uma palavra do meio.
+    escolhidos = heapq.nsmallest(limite, prefixos, key=lambda i: (not indice.chaves[i].startswith(chave), indice.posicao[i]))
+    if not escolhidos:
+        escolhidos = [i for _, i in indice.aproximados(chave, SUGESTOES_SEMELHANCA_MIN, inteiro=False)[:limite]]
+    return [indice.valores[i] for i in escolhidos]
+
+
+def resolver_nome(nome: str, texto: str, limite: int = None):
+    """
+    Converte um nome escrito livremente (ex.: extraido pela IA, "Dr. Carlos") no
+    nome cadastrado: o nome igual, o unico que tem todas as palavras informadas
+    inteiras ou, sem nenhum desses, o mais parecido. Quando varios nomes servem
+    ("Maria" -> "Ana Maria", "Maria Souza"), nenhum e escolhido: eles voltam como
+    candidatos para quem pediu decidir.
+
+    Args:
+        nome (str): Lista ("convenios", "profissionais" ou "conjuntos").
+        texto (str): Nome a resolver.
+        limite (int, optional): Maximo de candidatos retornados (padrao SUGESTOES_LIMITE).
+
+    Returns:
+        tuple: (nomes resolvidos, candidatos). Os resolvidos tem mais de um nome apenas
+               quando os cadastros diferem so em acentos, caixa ou titulos. Ambas as
+               listas vem vazias se nenhum nome for parecido o bastante.
+    """
+    limite = SUGESTOES_LIMITE if limite is None else limite
+    indice = _obter_indice(nome)
+    chave = chave_nome(texto)
+    if not chave:
+        return [], []
+    if chave in indice.por_chave:
+        return [indice.valores[i] for i in indice.por_chave[chave]], []
+    palavras = indice.por_palavras(chave)
+    if len(palavras) == 1:
+        return [indice.valores[i] for i in palavras], []
+    if palavras:
+        return [], [indice.valores[i] for i in heapq.nsmallest(limite, palavras, key=indice.posicao.get)]
+    aproximados = indice.aproximados(chave, RESOLVER_SEMELHANCA_MIN, inteiro=True)
+    if len(aproximados) > 1 and aproximados[0][0] == aproximados[1][0]:
+        return [], [indice.valores[i] for s, i in aproximados[:limite] if s == aproximados[0][0]]
+    return ([indice.valores[aproximados[0][1]]] if aproximados else []), []
+
+
+def resolver_filtros(filtros: dict):
+    """
+    Troca os nomes de convenios, profissionais e conjuntos dos filtros pelos nomes
+    cadastrados (o filtro de pacientes compara os nomes exatamente). Nomes sem
+    correspondencia sao mantidos como vieram. Nomes ambiguos tambem sao mantidos,
+    e os candidatos vao em filtros["ambiguos"] (lista -> nome -> candidatos) para
+    o usuario escolher, em vez de o filtro ser ampliado para todos eles.
+
+    Returns:
+        dict: Os mesmos filtros, com os nomes resolvidos.
+    """
+    ambiguos = {}
+    for nome in CARREGADORES:
+        if not isinstance(filtros.get(nome), list):
+            continue
+        resolvidos = []
+        for texto in filtros[nome]:
+            valores, candidatos = resolver_nome(nome, str(texto))
+            if candidatos:
+                ambiguos.setdefault(nome, {})[str(texto)] = candidatos
+            for valor in valores or [texto]:
+                if valor not in resolvidos:
+                    resolvidos.append(valor)
+        filtros[nome] = resolvidos
+    if ambiguos:
+        filtros["ambiguos"] = ambiguos
+    return filtros
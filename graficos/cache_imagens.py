@@ -0,0 +1,85 @@
+import os
+import re
+import time
+import hashlib
+
+
+# Diretorio onde os graficos gerados sao guardados, um arquivo por grafico.
+CACHE_GRAFICOS_DIR = os.getenv("CACHE_GRAFICOS_DIR", os.path.join("cache", "graficos"))
+# Tamanho maximo do diretorio; ao ultrapassa-lo, os graficos usados ha mais tempo sao removidos.
+CACHE_GRAFICOS_MAX_MB = int(os.getenv("CACHE_GRAFICOS_MAX_MB", "200"))
+
+# Formatos de imagem aceitos e o Content-Type de cada um.
+FORMATOS_GRAFICO = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "svg": "image/svg+xml",
+}
+DPI_PADRAO = 100
+DPI_MINIMO, DPI_MAXIMO = 50, 300
+
+# Nome de arquivo valido no cache: hash SHA-256 + extensao conhecida.
+_NOME_VALIDO = re.compile(r"^[0-9a-f]{64}\.(?:png|webp|svg)$")
+
+
+def chave_grafico(codigo: str, patient_id: str, versao: str, formato: str, dpi: int):
+    """
+    Calcula o nome do arquivo de um grafico. O mesmo codigo sobre a mesma versao dos
+    dados do paciente, no mesmo formato e DPI, sempre gera a mesma imagem.
+
+    Returns:
+        str: Nome do arquivo (hash SHA-256 + extensao).
+    """
+    conteudo = "\x1f".join([codigo, str(patient_id or ""), str(versao or ""), formato, str(dpi)])
+    return f"{hashlib.sha256(conteudo.encode('utf-8')).hexdigest()}.{formato}"
+
+
+def caminho_grafico(nome: str):
+    """
+    Retorna o caminho do arquivo de um grafico em cache, ou None se o nome for
+    invalido ou o arquivo nao existir. Cada acesso conta como uso recente (LRU).
+    """
+    if not _NOME_VALIDO.match(nome):
+        return None
+    # Caminho absoluto: o send_file do Flask resolve caminhos relativos a partir do app.
+    caminho = os.path.abspath(os.path.join(CACHE_GRAFICOS_DIR, nome))
+    try:
+        os.utime(caminho)
+    except OSError:
+        return None
+    return caminho
+
+
+def guardar_grafico(nome: str, imagem: bytes):
+    """
+    Grava a imagem no cache e aplica o limite de tamanho do diretorio.
+    """
+    os.makedirs(CACHE_GRAFICOS_DIR, exist_ok=True)
+    caminho = os.path.join(CACHE_GRAFICOS_DIR, nome)
+    # Grava em um arquivo temporario e renomeia, para nunca servir uma imagem pela metade.
+    temporario = f"{caminho}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+    with open(temporario, "wb") as f:
+        f.write(imagem)
+    os.replace(temporario, caminho)
+    _aplicar_limites()
+
+
+def _aplicar_limites():
+    """
+    Remove os graficos usados ha mais tempo ate o diretorio ficar dentro do limite.
+    """
+    arquivos = []
+    for entrada in os.scandir(CACHE_GRAFICOS_DIR):
+        if entrada.is_file() and _NOME_VALIDO.match(entrada.name):
+            info = entrada.stat()
+            arquivos.append((info.st_mtime, info.st_size, entrada.path))
+
+    excedente = sum(tamanho for _, tamanho, _ in arquivos) - CACHE_GRAFICOS_MAX_MB * 1024 * 1024
+    for _, tamanho, caminho in sorted(arquivos):
+        if excedente <= 0:
+            break
+        try:
+            os.remove(caminho)
+        except OSError:
+            continue
+        excedente -= tamanho
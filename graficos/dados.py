@@ -0,0 +1,58 @@
+import os
+import threading
+from collections import OrderedDict
+
+from db.models import buscar_jornada_por_id, versao_paciente
+
+
+# Colunas da jornada disponiveis no DataFrame `df` dos graficos.
+COLUNAS_GRAFICO = ["data", "descricao", "conjunto", "nome_profissional", "nome_convenio", "fonte"]
+# Quantidade de jornadas mantidas em memoria para os graficos.
+CACHE_GRAFICOS_PACIENTES = int(os.getenv("CACHE_GRAFICOS_PACIENTES", "32"))
+
+# (paciente, versao dos dados) -> jornada no formato colunar (LRU).
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def dados_paciente(patient_id: str, versao: str = None):
+    """
+    Retorna a jornada do paciente usada para montar o DataFrame `df` dos graficos.
+
+    Varios graficos seguidos do mesmo paciente reaproveitam a mesma consulta; uma
+    nova versao dos dados (eventos novos) faz a jornada ser buscada de novo.
+
+    Args:
+        patient_id (str): ID do paciente.
+        versao (str, optional): Versao dos dados, se ja tiver sido consultada.
+
+    Returns:
+        dict: Coluna -> lista de valores, ordenada por data.
+    """
+    if versao is None:
+        versao = versao_paciente(patient_id)
+    chave = (str(patient_id), versao)
+    with _lock:
+        if chave in _cache:
+            _cache.move_to_end(chave)
+            return _cache[chave]
+
+    dados = buscar_jornada_por_id(patient_id, colunas=COLUNAS_GRAFICO, formato="colunar")
+
+    with _lock:
+        _cache[chave] = dados
+        _cache.move_to_end(chave)
+        while len(_cache) > CACHE_GRAFICOS_PACIENTES:
+            _cache.popitem(last=False)
+    return dados
+
+
+def descartar_pacientes(ids):
+    """
+    Remove da memoria as jornadas dos pacientes informados (ex.: ao receber um
+    aviso de alteracao), sem esperar que saiam pelo LRU.
+    """
+    ids = {str(pid) for pid in ids}
+    with _lock:
+        for chave in [chave for chave in _cache if chave[0] in ids]:
+            del _cache[chave]
@@ -0,0 +1,222 @@
+import os
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+
+from graficos.sandbox import CodigoInvalido
+
+
+# Quantidade de processos de graficos mantidos abertos.
+GRAFICOS_PROCESSOS = int(os.getenv("GRAFICOS_PROCESSOS", str(os.cpu_count() or 2)))
+# Quantidade maxima de graficos aguardando um processo livre; alem disso a requisicao e recusada.
+GRAFICOS_FILA_MAX = int(os.getenv("GRAFICOS_FILA_MAX", str(2 * GRAFICOS_PROCESSOS)))
+# Tempo maximo (em segundos) de CPU e de relogio para cada grafico.
+GRAFICOS_TEMPO_LIMITE = float(os.getenv("GRAFICOS_TEMPO_LIMITE", "10"))
+# Memoria maxima (em MB) de cada processo de graficos. 0 desativa o limite.
+GRAFICOS_MEMORIA_MB = int(os.getenv("GRAFICOS_MEMORIA_MB", "1024"))
+# Tempo extra que o processo principal espera antes de encerrar um processo travado.
+MARGEM_ENCERRAMENTO = 2.0
+# Tempo maximo para um processo novo carregar matplotlib e pandas.
+TEMPO_INICIALIZACAO = 60.0
+
+
+class FilaCheia(Exception):
+    """Todos os processos estao ocupados e a fila de espera esta cheia."""
+
+
+class TempoEsgotado(Exception):
+    """O grafico ultrapassou o tempo limite."""
+
+
+class ErroGrafico(Exception):
+    """O codigo do grafico falhou dentro do processo de graficos."""
+
+
+def _interromper(signum, frame):
+    raise TempoEsgotado("O grafico excedeu o tempo limite de execucao.")
+
+
+def _laco_trabalhador(conn, tempo_limite: float, memoria_mb: int):
+    """
+    Laco principal de um processo de graficos: carrega matplotlib e pandas uma unica
+    vez e executa um grafico por vez, com limites de tempo, CPU e memoria.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # noqa: F401 - deixa o pyplot carregado para os proximos graficos
+    import pandas  # noqa: F401
+    from graficos.sandbox import executar_grafico
+
+    try:
+        import resource
+    except ImportError:
+        # Windows: sem limites por processo; resta o tempo limite aplicado pelo processo principal.
+        resource = None
+
+    if resource is not None and memoria_mb > 0:
+        limite = memoria_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _interromper)
+    if hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, _interromper)
+    # Avisa que terminou de carregar; o tempo limite dos graficos so conta a partir daqui.
+    conn.send(("pronto", None))
+
+    while True:
+        try:
+            tarefa = conn.recv()
+        except EOFError:
+            return
+        if tarefa is None:
+            return
+        codigo, dados, formato, dpi = tarefa
+
+        try:
+            if hasattr(signal, "setitimer"):
+                signal.setitimer(signal.ITIMER_REAL, tempo_limite)
+            if resource is not None:
+                # O RLIMIT_CPU conta o tempo total do processo; o limite e renovado a cada grafico.
+                uso = resource.getrusage(resource.RUSAGE_SELF)
+                _, rigido = resource.getrlimit(resource.RLIMIT_CPU)
+                suave = int(uso.ru_utime + uso.ru_stime + tempo_limite) + 1
+                if rigido != resource.RLIM_INFINITY:
+                    suave = min(suave, rigido)
+                resource.setrlimit(resource.RLIMIT_CPU, (suave, rigido))
+            tempos = {}
+            imagem = executar_grafico(codigo, dados, formato, dpi, tempos)
+            resultado = ("ok", (imagem, tempos))
+        except TempoEsgotado as e:
+            resultado = ("tempo", str(e))
+        except CodigoInvalido as e:
+            resultado = ("invalido", str(e))
+        except MemoryError:
+            resultado = ("erro", "O grafico excedeu o limite de memoria.")
+        except Exception as e:
+            resultado = ("erro", f"{type(e).__name__}: {e}")
+        finally:
+            if hasattr(signal, "setitimer"):
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+        conn.send(resultado)
+
+
+class _Trabalhador:
+    """
+    Um processo de graficos e a ponta do Pipe usada para falar com ele.
+    """
+
+    def __init__(self, contexto):
+        self.conn, conn_filho = contexto.Pipe()
+        self.processo = contexto.Process(
+            target=_laco_trabalhador,
+            args=(conn_filho, GRAFICOS_TEMPO_LIMITE, GRAFICOS_MEMORIA_MB),
+            name="graficos",
+            daemon=True,
+        )
+        self.processo.start()
+        conn_filho.close()
+        self.pronto = False
+
+    def aguardar_pronto(self):
+        """Espera o processo terminar de carregar as bibliotecas (apenas na primeira vez)."""
+        if not self.pronto:
+            if not self.conn.poll(TEMPO_INICIALIZACAO):
+                raise ErroGrafico("O processo de graficos nao iniciou a tempo.")
+            self.conn.recv()
+            self.pronto = True
+
+    def encerrar(self):
+        """Fecha o Pipe e mata o processo, usado quando ele trava ou morre."""
+        try:
+            self.conn.close()
+        finally:
+            if self.processo.is_alive():
+                self.processo.kill()
+            self.processo.join(timeout=1)
+
+
+_lock = threading.Lock()
+_contexto = None
+_ociosos = queue.Queue()
+# Limita quantos graficos podem estar em execucao ou aguardando ao mesmo tempo.
+_vagas = threading.BoundedSemaphore(GRAFICOS_PROCESSOS + GRAFICOS_FILA_MAX)
+
+
+def iniciar_pool():
+    """
+    Inicia os processos de graficos (se ainda nao estiverem rodando). Chamada no
+    primeiro grafico, ou antes, na inicializacao da aplicacao, para evitar a espera.
+    """
+    global _contexto
+    with _lock:
+        if _contexto is not None:
+            return
+        # "spawn" funciona em todas as plataformas e nao herda conexoes ou threads do Flask.
+        _contexto = multiprocessing.get_context("spawn")
+        for _ in range(GRAFICOS_PROCESSOS):
+            _ociosos.put(_Trabalhador(_contexto))
+
+
+def renderizar_grafico(codigo: str, dados: dict = None, formato: str = "png", dpi: int = 100, tempos: dict = None):
+    """
+    Executa o codigo do grafico em um processo livre do pool.
+
+    Args:
+        codigo (str): Codigo ja preparado por graficos.sandbox.preparar_codigo.
+        dados (dict, optional): Jornada do paciente, exposta ao codigo como `df`.
+        formato (str, optional): "png", "webp" ou "svg".
+        dpi (int, optional): Resolucao da imagem.
+        tempos (dict, optional): Recebe a duracao (em segundos) da espera por um processo
+            livre ("fila"), da execucao do codigo ("executar") e da geracao da imagem ("codificar").
+
+    Returns:
+        bytes: A imagem gerada.
+
+    Raises:
+        FilaCheia: Se todos os processos estiverem ocupados e a fila estiver cheia.
+        TempoEsgotado: Se o grafico ultrapassar o tempo limite.
+        CodigoInvalido: Se o codigo tentar usar algo nao permitido durante a execucao.
+        ErroGrafico: Se o codigo falhar.
+    """
+    if not _vagas.acquire(blocking=False):
+        raise FilaCheia("Muitos graficos sendo gerados no momento. Tente novamente em instantes.")
+    try:
+        iniciar_pool()
+        inicio = time.perf_counter()
+        trabalhador = _ociosos.get()
+        substituir = False
+        try:
+            trabalhador.aguardar_pronto()
+            if tempos is not None:
+                tempos["fila"] = time.perf_counter() - inicio
+            trabalhador.conn.send((codigo, dados, formato, dpi))
+            if not trabalhador.conn.poll(GRAFICOS_TEMPO_LIMITE + MARGEM_ENCERRAMENTO):
+                # O processo nao respondeu nem ao proprio alarme (ex.: preso em codigo C).
+                substituir = True
+                raise TempoEsgotado("O grafico excedeu o tempo limite de execucao.")
+            status, valor = trabalhador.conn.recv()
+        except (EOFError, OSError, ErroGrafico):
+            # O processo morreu (ex.: estourou o limite de CPU ou memoria).
+            substituir = True
+            raise ErroGrafico("O processo de graficos foi encerrado durante a execucao.")
+        finally:
+            if substituir:
+                trabalhador.encerrar()
+                trabalhador = _Trabalhador(_contexto)
+            _ociosos.put(trabalhador)
+    finally:
+        _vagas.release()
+
+    if status == "tempo":
+        raise TempoEsgotado(valor)
+    if status == "invalido":
+        raise CodigoInvalido(valor)
+    if status == "erro":
+        raise ErroGrafico(valor)
+    imagem, tempos_processo = valor
+    if tempos is not None:
+        tempos.update(tempos_processo)
+    return imagem
@@ -0,0 +1,344 @@
+import re
+import io
+import ast
+import time
+import types
+import string
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+
+# Opcoes de compressao de cada formato de imagem (repassadas ao Pillow).
+OPCOES_FORMATO = {
+    "png": {"pil_kwargs": {"optimize": True}},
+    "webp": {"pil_kwargs": {"quality": 80, "method": 4}},
+    "svg": {},
+}
+
+# Metodos que nunca sao executados: o sistema exibe e salva a imagem sozinho.
+CHAMADAS_REMOVIDAS = {"show", "savefig"}
+# Quantidade de codigos compilados mantidos em cada processo de graficos.
+CACHE_COMPILACAO_MAX_ITENS = 256
+
+# Funcoes que leem ou gravam arquivos (pandas, NumPy, matplotlib) ou avaliam texto como codigo.
+ATRIBUTOS_PROIBIDOS = {
+    "load", "loads", "save", "savez", "savez_compressed", "savetxt", "loadtxt", "genfromtxt",
+    "fromfile", "tofile", "dump", "dumps", "memmap", "imread", "imsave", "rc_file",
+    "eval", "query", "format_map", "ExcelWriter", "ExcelFile", "HDFStore",
+}
+# Conversoes "to_*" que ficam na memoria; as demais (to_csv, to_pickle, ...) gravam arquivos.
+CONVERSOES_PERMITIDAS = {
+    "to_numpy", "to_list", "to_dict", "to_frame", "to_period", "to_timestamp",
+    "to_datetime", "to_timedelta", "to_numeric", "to_pydatetime", "to_flat_index",
+}
+# Built-ins que dariam acesso a arquivos, ao interpretador ou a atributos por nome.
+NOMES_PROIBIDOS = {
+    "open", "eval", "exec", "compile", "getattr", "setattr", "delattr", "globals", "locals",
+    "vars", "breakpoint", "input", "type", "memoryview",
+}
+# Funcao que o sanitizador coloca em cada leitura de atributo (ver `_atributo_seguro`).
+NOME_GUARDA = "_atributo_seguro"
+
+
+class CodigoInvalido(ValueError):
+    """O codigo do grafico nao e Python valido ou usa algo nao permitido."""
+
+
+def _atributo_proibido(nome: str):
+    """
+    Atributos rejeitados em qualquer objeto: privados ("_x", "__class__"), que acessam
+    arquivos (read_*, to_csv, tofile...) ou que avaliam texto como codigo.
+    """
+    if nome.startswith("_") or nome in ATRIBUTOS_PROIBIDOS or nome in CHAMADAS_REMOVIDAS:
+        return True
+    return nome.startswith("read_") or (nome.startswith("to_") and nome not in CONVERSOES_PERMITIDAS)
+
+
+class _Sanitizador(ast.NodeTransformer):
+    """
+    Percorre a arvore do codigo uma unica vez: remove imports e chamadas a
+    show()/savefig(), rejeita nomes com "__" e atributos proibidos (ver
+    `_atributo_proibido`) e troca cada leitura de atributo `x.a` por
+    `_atributo_seguro(x, "a")`, que confere o atributo ao executar (ver
+    `_atributo_seguro`): a lista de nomes nao basta, pois um atributo comum pode
+    apontar para um modulo (ex.: plt.sys, pd.io.common.os).
+    """
+
+    def visit_Import(self, node):
+        return None
+
+    def visit_ImportFrom(self, node):
+        return None
+
+    def visit_Expr(self, node):
+        chamada = node.value
+        if (isinstance(chamada, ast.Call) and isinstance(chamada.func, ast.Attribute)
+                and chamada.func.attr in CHAMADAS_REMOVIDAS):
+            return None
+        return self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        if _atributo_proibido(node.attr):
+            raise CodigoInvalido(f"Acesso ao atributo '{node.attr}' nao e permitido.")
+        node = self.generic_visit(node)
+        if not isinstance(node.ctx, ast.Load):
+            return node
+        return ast.copy_location(
+            ast.Call(func=ast.Name(id=NOME_GUARDA, ctx=ast.Load()), args=[node.value, ast.Constant(node.attr)], keywords=[]),
+            node,
+        )
+
+    def visit_Name(self, node):
+        self._validar_nome(node.id)
+        return node
+
+    def visit_arg(self, node):
+        self._validar_nome(node.arg)
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        self._validar_nome(node.name)
+        return self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self._validar_nome(node.name)
+        return self.generic_visit(node)
+
+    def visit_Global(self, node):
+        for nome in node.names:
+            self._validar_nome(nome)
+        return node
+
+    visit_Nonlocal = visit_Global
+
+    @staticmethod
+    def _validar_nome(nome: str):
+        # O codigo nao pode redefinir a guarda dos atributos nem usar built-ins perigosos.
+        if nome.startswith("__") or nome == NOME_GUARDA or nome in NOMES_PROIBIDOS:
+            raise CodigoInvalido(f"Uso do nome '{nome}' nao e permitido.")
+
+
+def _analisar(code: str):
+    """
+    Converte o codigo em AST. Se houver erro de sintaxe, tenta antes separar comandos
+    que a IA as vezes escreve grudados na mesma linha (ex.: "plt.xlabel('x') plt.ylabel('y')").
+    """
+    try:
+        return ast.parse(code)
+    except SyntaxError:
+        pass
+    linhas = []
+    for linha in code.splitlines():
+        recuo = linha[:len(linha) - len(linha.lstrip())]
+        linhas.append(re.sub(r"([)\]}])[ \t]*(?=plt\.)", lambda m: m.group(1) + "\n" + recuo, linha))
+    corrigido = "\n".join(linhas)
+    try:
+        return ast.parse(corrigido)
+    except SyntaxError as e:
+        raise CodigoInvalido(f"Codigo invalido na linha {e.lineno}: {e.msg}")
+
+
+def preparar_codigo(raw: str):
+    """
+    Extrai o codigo de um bloco markdown, valida e reescreve o codigo em uma unica
+    passada pela AST (ver `_Sanitizador`).
+
+    Args:
+        raw (str): Texto enviado pelo navegador, com ou sem crases triplas.
+
+    Returns:
+        str: O codigo normalizado, pronto para ser executado no sandbox. Codigos
+             equivalentes (so com formatacao diferente) geram o mesmo texto.
+
+    Raises:
+        CodigoInvalido: Se o codigo nao puder ser interpretado ou usar algo proibido.
+    """
+    # Extrai o codigo de dentro de um bloco de markdown (```python ... ```).
+    m = re.search(r"```(?:python)?\s*(.+?)```", raw, flags=re.S|re.I)
+    code = m.group(1).strip() if m else raw
+
+    arvore = _Sanitizador().visit(_analisar(code))
+    if not arvore.body:
+        raise CodigoInvalido("O codigo nao contem nenhum comando para gerar o grafico.")
+    # Blocos que so tinham comandos removidos (ex.: um for com plt.show()) ficam com "pass".
+    for no in ast.walk(arvore):
+        if isinstance(getattr(no, "body", None), list) and not no.body:
+            no.body.append(ast.Pass())
+    return ast.unparse(ast.fix_missing_locations(arvore))
+
+
+@lru_cache(maxsize=CACHE_COMPILACAO_MAX_ITENS)
+def _compilar(safe_code: str):
+    """
+    Compila o codigo uma unica vez por processo; o mesmo grafico pedido de novo
+    (ex.: em outro formato ou DPI) reaproveita o bytecode.
+    """
+    return compile(safe_code, "<grafico>", "exec")
+
+
+# Funcoes built-in disponiveis para o codigo gerado (sem __import__, open, getattr...).
+SAFE_BUILTINS = {
+    "print": print, "len": len, "range": range, "min": min, "max": max,
+    "sum": sum, "abs": abs, "round": round, "sorted": sorted, "list": list,
+    "dict": dict, "set": set, "tuple": tuple, "str": str, "int": int,
+    "float": float, "bool": bool, "enumerate": enumerate, "zip": zip,
+}
+
+
+@lru_cache(maxsize=1)
+def _atributos_permitidos():
+    """
+    Nomes de atributos que o codigo pode ler: os publicos do pyplot, dos artistas do
+    matplotlib (Figure, Axes, Text...), dos principais tipos do pandas e do NumPy e dos
+    tipos basicos, sem os proibidos. Calculado uma vez por processo de graficos.
+    """
+    import numpy as np
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    from matplotlib.artist import Artist
+    from matplotlib.axis import Axis, Tick
+
+    def subclasses(classe):
+        vistas, pendentes = set(), [classe]
+        while pendentes:
+            atual = pendentes.pop()
+            if atual not in vistas:
+                vistas.add(atual)
+                pendentes.extend(atual.__subclasses__())
+        return vistas
+
+    serie_datas = pd.Series(pd.to_datetime(["2000-01-01"]))
+    quadro = pd.DataFrame({"a": [1], "b": ["x"]})
+    objetos = [
+        plt, Axis, Tick, *subclasses(Artist),
+        pd.DataFrame, pd.Series, pd.Index, pd.DatetimeIndex, pd.Timestamp, pd.Timedelta, pd.Period,
+        pd.Categorical, type(serie_datas.dt), type(quadro["b"].str), type(quadro.groupby("a")),
+        type(quadro.groupby("a")["b"]), type(quadro["a"].rolling(1)), type(quadro["a"].expanding()),
+        type(serie_datas.to_frame("d").resample("D", on="d")), pd.options,
+        np.ndarray, np.generic, datetime, type(datetime.now().date()), type(datetime.now() - datetime.now()),
+        Counter, str, list, dict, set, tuple, int, float, bool,
+    ]
+    permitidos = set()
+    for objeto in objetos:
+        for nome in dir(objeto):
+            if _atributo_proibido(nome):
+                continue
+            # Nomes que no pyplot apontam para modulos (ex.: plt.sys, plt.np) ficam de fora.
+            if isinstance(objeto, types.ModuleType) and isinstance(getattr(objeto, nome, None), types.ModuleType):
+                continue
+            permitidos.add(nome)
+    return frozenset(permitidos)
+
+
+def _formatar(texto: str):
+    """
+    str.format sem acesso a atributos ou indices nos campos ("{0.__class__}"),
+    que contornariam a guarda dos atributos.
+    """
+    def validar(modelo: str):
+        for _, campo, especificacao, _ in string.Formatter().parse(modelo):
+            if campo and ("." in campo or "[" in campo):
+                raise CodigoInvalido("Campos com atributos ou indices nao sao permitidos em format().")
+            if especificacao:
+                # A especificacao pode ter campos aninhados ("{0:{1}}").
+                validar(especificacao)
+
+    def formatar(*args, **kwargs):
+        validar(texto)
+        return texto.format(*args, **kwargs)
+    return formatar
+
+
+def _atributo_seguro(objeto, nome: str):
+    """
+    Le `objeto.nome` para o codigo do grafico: apenas atributos permitidos (ver
+    `_atributos_permitidos`) e nunca um modulo (ex.: plt.sys, pd.io).
+    """
+    import pandas as pd
+
+    # Colunas do DataFrame tambem podem ser lidas como atributo (ex.: df.data).
+    coluna = isinstance(objeto, pd.DataFrame) and nome in objeto.columns
+    if _atributo_proibido(nome) or not (coluna or nome in _atributos_permitidos()):
+        raise CodigoInvalido(f"Acesso ao atributo '{nome}' nao e permitido.")
+    if nome == "format" and (objeto is str or isinstance(objeto, str)):
+        if objeto is str:
+            raise CodigoInvalido("Use texto.format(...) em vez de str.format.")
+        return _formatar(objeto)
+    valor = getattr(objeto, nome)
+    if isinstance(valor, types.ModuleType):
+        raise CodigoInvalido(f"Acesso ao modulo '{nome}' nao e permitido.")
+    return valor
+
+
+def executar_grafico(safe_code: str, dados: dict = None, formato: str = "png", dpi: int = 100, tempos: dict = None):
+    """
+    Executa o codigo em uma Figure nova e retorna a imagem no formato pedido.
+
+    Deve ser chamada dentro de um processo de graficos (ver graficos.pool): o pyplot
+    guarda estado global, entao cada processo executa um grafico por vez e a Figure
+    e sempre fechada no final.
+
+    Args:
+        safe_code (str): Codigo ja validado por `preparar_codigo`.
+        dados (dict, optional): Jornada do paciente ou agregado de uma coorte
+            (coluna -> valores). Quando informado, fica disponivel para o codigo
+            como o DataFrame `df`.
+        formato (str, optional): "png", "webp" ou "svg".
+        dpi (int, optional): Resolucao da imagem (ignorada no SVG, exceto para imagens embutidas).
+        tempos (dict, optional): Recebe a duracao (em segundos) da execucao do codigo
+            ("executar") e da geracao da imagem ("codificar").
+
+    Returns:
+        bytes: O conteudo da imagem.
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
+    # Define as variaveis globais que o codigo podera acessar.
+    safe_globals = {
+        "__builtins__": SAFE_BUILTINS,
+        NOME_GUARDA: _atributo_seguro,
+        "plt": plt,
+        "pd": pd,
+        "Counter": Counter,
+        "datetime": datetime,
+    }
+    if dados is not None:
+        # O DataFrame e recriado a cada grafico, entao alteracoes feitas pelo codigo
+        # gerado nunca chegam aos dados em cache.
+        df = pd.DataFrame(dados)
+        for coluna in ("data", "periodo"):
+            if coluna in df:
+                df[coluna] = pd.to_datetime(df[coluna], errors="coerce")
+        safe_globals["df"] = df
+
+    # O processo de graficos e reaproveitado: o backend e as configuracoes globais
+    # (rcParams) que um grafico anterior tenha alterado voltam ao padrao, e as deste
+    # grafico sao desfeitas ao sair do rc_context. Sem isso, o mesmo codigo geraria
+    # imagens diferentes (e o cache guardaria a errada).
+    if matplotlib.get_backend().lower() != "agg":
+        plt.switch_backend("Agg")
+    tempos = {} if tempos is None else tempos
+    with matplotlib.rc_context():
+        plt.rcdefaults()
+        # Cada grafico e desenhado em uma Figure propria, que vira a figura atual do pyplot.
+        plt.figure()
+        try:
+            inicio = time.perf_counter()
+            exec(_compilar(safe_code), safe_globals)
+            tempos["executar"] = time.perf_counter() - inicio
+            # O codigo pode ter criado outra figura (ex.: plt.subplots); salva a atual.
+            inicio = time.perf_counter()
+            atual = plt.gcf()
+            buf = io.BytesIO()
+            atual.savefig(buf, format=formato, dpi=dpi, bbox_inches='tight', **OPCOES_FORMATO[formato])
+            tempos["codificar"] = time.perf_counter() - inicio
+            return buf.getvalue()
+        finally:
+            plt.close('all')
@@ -0,0 +1,138 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from db.busca_texto import normalizar_texto
+
+
+# Arquivo SQLite onde as respostas da IA sao guardadas.
+CACHE_RESPOSTAS_DB = os.getenv("CACHE_RESPOSTAS_DB", os.path.join("cache", "respostas.sqlite3"))
+# Limites do cache; ao ultrapassa-los, as respostas usadas ha mais tempo sao removidas (LRU).
+CACHE_RESPOSTAS_MAX_ITENS = int(os.getenv("CACHE_RESPOSTAS_MAX_ITENS", "5000"))
+CACHE_RESPOSTAS_MAX_MB = int(os.getenv("CACHE_RESPOSTAS_MAX_MB", "100"))
+CACHE_RESPOSTAS_ATIVO = os.getenv("CACHE_RESPOSTAS_ATIVO", "1") == "1"
+
+_lock_criacao = threading.Lock()
+_criado = False
+
+
+def _conectar():
+    """
+    Abre uma conexao com o banco SQLite do cache, criando a tabela na primeira vez.
+    """
+    global _criado
+    if not _criado:
+        os.makedirs(os.path.dirname(CACHE_RESPOSTAS_DB) or ".", exist_ok=True)
+    conn = sqlite3.connect(CACHE_RESPOSTAS_DB, timeout=10)
+    if not _criado:
+        with _lock_criacao:
+            if not _criado:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS respostas (
+                        chave TEXT PRIMARY KEY,
+                        id_paciente TEXT NOT NULL,
+                        versao TEXT NOT NULL,
+                        resposta TEXT NOT NULL,
+                        tamanho INTEGER NOT NULL,
+                        criado_em REAL NOT NULL,
+                        ultimo_acesso REAL NOT NULL
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS respostas_acesso_idx ON respostas (ultimo_acesso)")
+                conn.execute("CREATE INDEX IF NOT EXISTS respostas_paciente_idx ON respostas (id_paciente)")
+                conn.commit()
+                _criado = True
+    return conn
+
+
+def chave_resposta(prompt: str, patient_id: str, versao: str, modelo: str, temperatura: float):
+    """
+    Calcula a chave de uma resposta. Perguntas que so diferem em acentos, caixa ou
+    espacos compartilham a mesma chave; uma nova versao dos dados do paciente gera
+    uma chave diferente.
+
+    Returns:
+        str: Hash SHA-256 da combinacao (prompt normalizado, paciente, versao, modelo, temperatura).
+    """
+    conteudo = "\x1f".join([normalizar_texto(prompt), str(patient_id), str(versao), modelo, f"{temperatura:.3f}"])
+    return hashlib.sha256(conteudo.encode("utf-8")).hexdigest()
+
+
+def obter_resposta(chave: str):
+    """
+    Busca uma resposta no cache e atualiza o seu horario de ultimo acesso.
+
+    Returns:
+        str | None: A resposta guardada, ou None se nao existir.
+    """
+    if not CACHE_RESPOSTAS_ATIVO:
+        return None
+    conn = _conectar()
+    try:
+        row = conn.execute("SELECT resposta FROM respostas WHERE chave = ?", (chave,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE respostas SET ultimo_acesso = ? WHERE chave = ?", (time.time(), chave))
+        conn.commit()
+        return row[0]
+    finally:
+        conn.close()
+
+
+def guardar_resposta(chave: str, patient_id: str, versao: str, resposta: str):
+    """
+    Guarda uma resposta no cache e aplica os limites de tamanho.
+
+    Respostas de outras versoes do mesmo paciente nao sao apagadas aqui: uma requisicao
+    lenta, feita sobre dados antigos, apagaria as respostas da versao atual. As antigas
+    saem por `invalidar_paciente` quando os eventos mudam ou pelo LRU.
+    """
+    if not CACHE_RESPOSTAS_ATIVO:
+        return
+    agora = time.time()
+    conn = _conectar()
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO respostas (chave, id_paciente, versao, resposta, tamanho, criado_em, ultimo_acesso)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (chave, str(patient_id), str(versao), resposta, len(resposta.encode("utf-8")), agora, agora))
+        _aplicar_limites(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def invalidar_paciente(patient_id: str):
+    """
+    Remove todas as respostas guardadas de um paciente.
+    """
+    conn = _conectar()
+    try:
+        conn.execute("DELETE FROM respostas WHERE id_paciente = ?", (str(patient_id),))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _aplicar_limites(conn):
+    """
+    Remove as respostas usadas ha mais tempo ate que a quantidade e o tamanho
+    total fiquem dentro dos limites configurados.
+    """
+    total, tamanho = conn.execute("SELECT COUNT(*), COALESCE(SUM(tamanho), 0) FROM respostas").fetchone()
+    max_bytes = CACHE_RESPOSTAS_MAX_MB * 1024 * 1024
+    if total <= CACHE_RESPOSTAS_MAX_ITENS and tamanho <= max_bytes:
+        return
+
+    excedente_itens = max(0, total - CACHE_RESPOSTAS_MAX_ITENS)
+    excedente_bytes = max(0, tamanho - max_bytes)
+    removidos, liberados = [], 0
+    for chave, tamanho_item in conn.execute("SELECT chave, tamanho FROM respostas ORDER BY ultimo_acesso"):
+        if len(removidos) >= excedente_itens and liberados >= excedente_bytes:
+            break
+        removidos.append((chave,))
+        liberados += tamanho_item
+    conn.executemany("DELETE FROM respostas WHERE chave = ?", removidos)
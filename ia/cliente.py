@@ -0,0 +1,30 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+_cliente = None
+_lock = threading.Lock()
+
+
+def obter_cliente():
+    """
+    Retorna o cliente da OpenAI, criado na primeira chamada a IA. A biblioteca
+    openai leva cerca de meio segundo para ser importada, entao processos que nao
+    chamam a IA (ou ainda nao chamaram) nao pagam esse custo.
+
+    Returns:
+        OpenAI: Cliente compartilhado pelas threads do processo.
+    """
+    global _cliente
+    if _cliente is None:
+        with _lock:
+            if _cliente is None:
+                from openai import OpenAI
+                _cliente = OpenAI(api_key=OPENAI_API_KEY)
+    return _cliente
@@ -0,0 +1,237 @@
+import os
+from collections import Counter
+from datetime import date, datetime
+from functools import lru_cache
+
+
+# Colunas da jornada usadas pelo contexto e quantidade maxima de eventos buscados
+# (os mais recentes). Eventos alem do orcamento de tokens sao resumidos.
+COLUNAS_CONTEXTO = ["data", "descricao", "cpf", "data_nascimento", "fonte", "nome_convenio", "nome_profissional", "conjunto"]
+LIMITE_EVENTOS_CONTEXTO = int(os.getenv("LIMITE_EVENTOS_CONTEXTO", "5000"))
+
+# Orcamento padrao de tokens para os dados do paciente enviados a IA.
+ORCAMENTO_TOKENS_CONTEXTO = int(os.getenv("ORCAMENTO_TOKENS_CONTEXTO", "12000"))
+# Modelo cujo tokenizador e usado para medir o contexto.
+MODELO_TOKENIZADOR = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+# Fracao do orcamento reservada para o resumo dos eventos mais antigos que nao couberem.
+FRACAO_RESUMO_HISTORICO = 0.15
+
+# Atributos de cada evento, na ordem em que aparecem. Os que forem iguais em todos os
+# eventos vao para o cabecalho; os demais so sao repetidos quando mudam.
+ATRIBUTOS_EVENTO = [
+    ("cpf", "CPF"),
+    ("data_nascimento", "Data de Nascimento"),
+    ("fonte", "Fonte"),
+    ("nome_convenio", "Convenio"),
+    ("nome_profissional", "Profissional"),
+    ("conjunto", "Conjunto"),
+]
+
+
+@lru_cache(maxsize=None)
+def _codificador(modelo: str):
+    """
+    Carrega o tokenizador do modelo. Retorna None se o tiktoken nao estiver
+    disponivel (nesse caso a contagem de tokens e estimada).
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(modelo)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception:
+            return None
+
+
+def contar_tokens(texto: str, modelo: str = MODELO_TOKENIZADOR):
+    """
+    Conta os tokens de um texto com o tokenizador do modelo.
+
+    Returns:
+        int: Quantidade de tokens (estimada em ~4 caracteres por token sem tiktoken).
+    """
+    codificador = _codificador(modelo)
+    if codificador is None:
+        return len(texto) // 4 + 1
+    return len(codificador.encode(texto, disallowed_special=()))
+
+
+def _contar_tokens_lote(textos: list, modelo: str):
+    """
+    Conta os tokens de varios textos de uma vez.
+    """
+    codificador = _codificador(modelo)
+    if codificador is None:
+        return [len(t) // 4 + 1 for t in textos]
+    return [len(tokens) for tokens in codificador.encode_batch(textos, disallowed_special=())]
+
+
+def _formatar_data(valor):
+    """
+    Formata datas de forma compacta, omitindo o horario quando ele e meia-noite.
+    """
+    if isinstance(valor, datetime):
+        if valor.hour == 0 and valor.minute == 0:
+            return valor.strftime("%Y-%m-%d")
+        return valor.strftime("%Y-%m-%d %H:%M")
+    if isinstance(valor, date):
+        return valor.strftime("%Y-%m-%d")
+    return "" if valor is None else str(valor)
+
+
+def _chave_ordenacao(registro):
+    """
+    Ordena eventos por data; eventos sem data ficam no inicio.
+    """
+    valor = registro.get("data")
+    if valor is None:
+        return (0, "")
+    return (1, _formatar_data(valor) if isinstance(valor, (date, datetime)) else str(valor))
+
+
+def _renderizar_eventos(registros: list, atributos_variaveis: list):
+    """
+    Gera uma linha por evento. Atributos variaveis so aparecem quando mudam em
+    relacao ao evento anterior, e eventos consecutivos identicos sao agrupados (xN).
+
+    Returns:
+        list: Pares (linha, quantidade de eventos representados pela linha).
+    """
+    linhas = []
+    anteriores = {}
+    ultima_chave = None
+
+    for r in registros:
+        mudancas = []
+        for campo, rotulo in atributos_variaveis:
+            valor = r.get(campo)
+            if campo not in anteriores or anteriores[campo] != valor:
+                mudancas.append(f"{rotulo}: {_formatar_data(valor)}")
+                anteriores[campo] = valor
+
+        descricao = " ".join(str(r.get("descricao") or "").split())
+        chave = (r.get("data"), descricao)
+        if chave == ultima_chave and not mudancas:
+            linha, n = linhas[-1]
+            linhas[-1] = (linha, n + 1)
+            continue
+
+        ultima_chave = chave
+        linha = f"[{_formatar_data(r.get('data'))}] {descricao}"
+        if mudancas:
+            linha += f" {{{'; '.join(mudancas)}}}"
+        linhas.append((linha, 1))
+
+    return [(f"{linha} (x{n})" if n > 1 else linha, n) for linha, n in linhas]
+
+
+def _resumir_historico(registros: list, orcamento_tokens: int, modelo: str):
+    """
+    Resume os eventos mais antigos que nao couberam no orcamento: periodo,
+    quantidade e os valores mais frequentes de cada atributo e descricao.
+    """
+    if not registros:
+        return ""
+
+    inicio = _formatar_data(registros[0].get("data"))
+    fim = _formatar_data(registros[-1].get("data"))
+    partes = [f"HISTORICO ANTERIOR RESUMIDO ({len(registros)} eventos de {inicio} a {fim}):"]
+
+    for campo, rotulo in (("conjunto", "Conjuntos"), ("nome_profissional", "Profissionais"), ("nome_convenio", "Convenios")):
+        contagem = Counter(r.get(campo) for r in registros if r.get(campo))
+        if contagem:
+            itens = ", ".join(f"{valor} ({n})" for valor, n in contagem.most_common(10))
+            partes.append(f"- {rotulo}: {itens}")
+
+    descricoes = Counter(" ".join(str(r.get("descricao")).split()) for r in registros if r.get("descricao"))
+    resumo = "\n".join(partes)
+    # Acrescenta as descricoes mais frequentes enquanto couberem no orcamento do resumo.
+    for descricao, n in descricoes.most_common():
+        linha = f"\n- ({n}x) {descricao}"
+        if contar_tokens(resumo + linha, modelo) > orcamento_tokens:
+            break
+        resumo += linha
+    return resumo
+
+
+def montar_contexto(registros: list, orcamento_tokens: int = None, modelo: str = MODELO_TOKENIZADOR,
+                    total_eventos: int = None, resumo: str = None):
+    """
+    Monta o texto com os dados do paciente que sera enviado a IA.
+
+    Os eventos sao ordenados por data; atributos constantes (CPF, data de nascimento,
+    fonte...) aparecem uma unica vez no cabecalho e os demais so sao repetidos quando
+    mudam. Os eventos mais recentes entram por completo ate o orcamento de tokens;
+    os mais antigos sao resumidos em vez de simplesmente descartados.
+
+    Args:
+        registros (list): Eventos do paciente (dicionarios com as colunas de mpiv02.events).
+        orcamento_tokens (int, optional): Limite de tokens do contexto.
+        modelo (str, optional): Modelo cujo tokenizador sera usado na contagem.
+        total_eventos (int, optional): Quantidade de eventos antes da selecao por
+            relevancia (ver ia.recuperacao); se for maior, o cabecalho avisa a IA.
+        resumo (str, optional): Resumo clinico ja gerado (ver ia.resumos), enviado
+            antes dos eventos e descontado do orcamento.
+
+    Returns:
+        str: O contexto formatado, que cabe no orcamento de tokens.
+    """
+    if orcamento_tokens is None:
+        orcamento_tokens = ORCAMENTO_TOKENS_CONTEXTO
+
+    registros = sorted((r for r in registros if r.get("descricao")), key=_chave_ordenacao)
+    if not registros:
+        return ""
+
+    # Atributos com um unico valor em toda a jornada vao para o cabecalho.
+    cabecalho, atributos_variaveis = [], []
+    for campo, rotulo in ATRIBUTOS_EVENTO:
+        if not any(campo in r for r in registros):
+            continue
+        valores = {r.get(campo) for r in registros}
+        if len(valores) == 1:
+            cabecalho.append(f"{rotulo}: {_formatar_data(valores.pop())}")
+        else:
+            atributos_variaveis.append((campo, rotulo))
+    if total_eventos and total_eventos > len(registros):
+        cabecalho.append(f"Eventos selecionados: {len(registros)} de {total_eventos} (os mais recentes e os relacionados a pergunta)")
+    texto_cabecalho = "\n".join(cabecalho)
+    if resumo:
+        texto_cabecalho += f"\n\nRESUMO CLINICO ANTERIOR (os eventos abaixo prevalecem em caso de divergencia):\n{resumo}"
+
+    linhas = _renderizar_eventos(registros, atributos_variaveis)
+    disponivel = orcamento_tokens - contar_tokens(texto_cabecalho, modelo)
+    tokens_linhas = _contar_tokens_lote([linha for linha, _ in linhas], modelo)
+
+    if sum(tokens_linhas) + len(linhas) <= disponivel:
+        return f"{texto_cabecalho}\n\nEVENTOS ({len(registros)}):\n" + "\n".join(linha for linha, _ in linhas)
+
+    # Nao cabe tudo: reserva parte do orcamento para o resumo e mantem os eventos mais recentes.
+    orcamento_resumo = int(orcamento_tokens * FRACAO_RESUMO_HISTORICO)
+    restante = disponivel - orcamento_resumo
+    usados, quantidade_recentes = 0, 0
+    for (_, n), custo in zip(reversed(linhas), reversed(tokens_linhas)):
+        if usados + custo + 1 > restante:
+            break
+        usados += custo + 1
+        quantidade_recentes += n
+
+    # Ao recortar, o primeiro evento mantido passa a repetir todos os atributos
+    # variaveis; se isso estourar o orcamento, descarta mais eventos antigos.
+    recentes = registros[len(registros) - quantidade_recentes:] if quantidade_recentes else []
+    linhas_recentes = [linha for linha, _ in _renderizar_eventos(recentes, atributos_variaveis)]
+    while linhas_recentes and contar_tokens("\n".join(linhas_recentes), modelo) > restante:
+        recentes = recentes[1:]
+        linhas_recentes = [linha for linha, _ in _renderizar_eventos(recentes, atributos_variaveis)]
+    antigos = registros[:len(registros) - len(recentes)]
+
+    partes = [texto_cabecalho]
+    resumo = _resumir_historico(antigos, orcamento_resumo, modelo)
+    if resumo:
+        partes.append(resumo)
+    partes.append(f"EVENTOS MAIS RECENTES ({len(recentes)} de {len(registros)}):\n" + "\n".join(linhas_recentes))
+    return "\n\n".join(p for p in partes if p)
@@ -0,0 +1,421 @@
+import os
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from db.models import buscar_jornadas_por_ids, versoes_pacientes
+from ia.contexto import montar_contexto, COLUNAS_CONTEXTO, LIMITE_EVENTOS_CONTEXTO
+from ia.cache_respostas import chave_resposta, obter_resposta, guardar_resposta
+from nucleo.concorrencia import limitar, LimiteExcedido
+
+
+# Quantidade maxima de pacientes em um lote.
+LOTE_MAX_PACIENTES = int(os.getenv("LOTE_MAX_PACIENTES", "500"))
+# Chamadas simultaneas a IA dentro de um lote.
+LOTE_CONCORRENCIA = int(os.getenv("LOTE_CONCORRENCIA", "4"))
+# Tentativas por paciente quando a IA responde com limite de taxa ou erro temporario.
+LOTE_TENTATIVAS = int(os.getenv("LOTE_TENTATIVAS", "5"))
+# Pacientes cujas jornadas sao buscadas juntas em uma consulta.
+LOTE_TAMANHO_BLOCO = 50
+# Diretorio dos lotes, compartilhado pelos workers da aplicacao: um lote criado em um
+# worker pode ser retomado em outro, ou depois de um reinicio.
+LOTES_DIR = os.getenv("LOTES_DIR", os.path.join("cache", "lotes"))
+# Tempo maximo (em segundos) que um lote sem atividade fica disponivel para ser retomado.
+LOTE_RETENCAO = 6 * 3600
+
+# Cada lote ocupa ate tres arquivos em LOTES_DIR, todos comecando com o ID dele:
+#   <id>.json        prompt, pacientes e horario de criacao;
+#   <id>.resultados  um resultado (JSON) por linha, na ordem em que ficaram prontos;
+#   <id>.executando  existe enquanto o lote esta em execucao em algum worker.
+_ID_TRABALHO = re.compile(r"[0-9a-f]{32}")
+# Uma execucao que nao registra resultados ha este tempo (em segundos) e considerada
+# abandonada (ex.: o worker foi reiniciado no meio) e o lote pode ser retomado.
+_EXECUCAO_ABANDONADA = 600
+_lock = threading.Lock()
+# Quando a IA pede para esperar (HTTP 429), todas as chamadas do processo aguardam juntas.
+_pausa_ate = 0.0
+
+
+class LoteEmExecucao(Exception):
+    """
+    O lote ja esta sendo executado (por outra requisicao ou por chamadas que ainda
+    terminam em segundo plano depois de uma desconexao).
+    """
+
+
+def _caminho(id_trabalho: str, extensao: str):
+    return os.path.join(LOTES_DIR, f"{id_trabalho}.{extensao}")
+
+
+def _ultima_atividade(id_trabalho: str):
+    """
+    Horario da ultima gravacao em qualquer arquivo do lote (0 se ele nao existir).
+    """
+    ultima = 0
+    for extensao in ("json", "resultados", "executando"):
+        try:
+            ultima = max(ultima, os.path.getmtime(_caminho(id_trabalho, extensao)))
+        except FileNotFoundError:
+            pass
+    return ultima
+
+
+def _limpar_expirados():
+    """
+    Apaga os lotes sem atividade ha mais de LOTE_RETENCAO segundos. Os arquivos de um
+    lote comecam com o ID dele.
+    """
+    limite = time.time() - LOTE_RETENCAO
+    try:
+        nomes = os.listdir(LOTES_DIR)
+    except FileNotFoundError:
+        return
+    por_trabalho = {}
+    for nome in nomes:
+        caminho = os.path.join(LOTES_DIR, nome)
+        try:
+            modificado = os.path.getmtime(caminho)
+        except FileNotFoundError:
+            continue
+        arquivos, ultimo = por_trabalho.get(nome.split(".")[0], ([], 0))
+        por_trabalho[nome.split(".")[0]] = (arquivos + [caminho], max(ultimo, modificado))
+    for arquivos, ultimo in por_trabalho.values():
+        if ultimo < limite:
+            for caminho in arquivos:
+                try:
+                    os.remove(caminho)
+                except FileNotFoundError:
+                    pass
+
+
+def _ler_resultados(id_trabalho: str):
+    """
+    Le os resultados gravados de um lote. Uma nova tentativa de um paciente substitui
+    o resultado anterior dele.
+    """
+    resultados = {}
+    try:
+        with open(_caminho(id_trabalho, "resultados"), encoding="utf-8") as arquivo:
+            for linha in arquivo:
+                try:
+                    resultado = json.loads(linha)
+                except ValueError:
+                    # Linha gravada pela metade por um worker que parou no meio.
+                    continue
+                resultados[resultado["patient_id"]] = resultado
+    except FileNotFoundError:
+        pass
+    return resultados
+
+
+def criar_lote(prompt: str, ids: list):
+    """
+    Registra um lote de perguntas (o mesmo prompt para varios pacientes).
+
+    Args:
+        prompt (str): Pergunta feita para cada paciente.
+        ids (list): IDs dos pacientes, sem repeticoes.
+
+    Returns:
+        str: O ID do lote, usado para retomar o lote em `executar_lote`.
+    """
+    os.makedirs(LOTES_DIR, exist_ok=True)
+    _limpar_expirados()
+    id_trabalho = uuid.uuid4().hex
+    caminho = _caminho(id_trabalho, "json")
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporario, "w", encoding="utf-8") as arquivo:
+        json.dump({
+            "prompt": prompt,
+            "ids": [str(pid) for pid in dict.fromkeys(ids)],
+            "criado_em": time.time(),
+        }, arquivo, ensure_ascii=False)
+    os.replace(temporario, caminho)
+    return id_trabalho
+
+
+def obter_lote(id_trabalho: str):
+    """
+    Retorna o lote com o ID informado, criado por qualquer worker, ou None se ele nao
+    existir (ou tiver expirado).
+
+    Returns:
+        dict | None: {"prompt", "ids", "criado_em", "resultados"}.
+    """
+    if not _ID_TRABALHO.fullmatch(id_trabalho or ""):
+        return None
+    if _ultima_atividade(id_trabalho) < time.time() - LOTE_RETENCAO:
+        _limpar_expirados()
+        return None
+    try:
+        with open(_caminho(id_trabalho, "json"), encoding="utf-8") as arquivo:
+            trabalho = json.load(arquivo)
+    except FileNotFoundError:
+        return None
+    trabalho["resultados"] = _ler_resultados(id_trabalho)
+    return trabalho
+
+
+def lote_em_execucao(id_trabalho: str):
+    """
+    Indica se o lote esta sendo executado agora, em qualquer worker (e nao pode ser
+    retomado ainda).
+    """
+    try:
+        return os.path.getmtime(_caminho(id_trabalho, "executando")) >= time.time() - _EXECUCAO_ABANDONADA
+    except FileNotFoundError:
+        return False
+
+
+def _ocupar(id_trabalho: str):
+    """
+    Marca o lote como em execucao, assumindo execucoes abandonadas.
+
+    Returns:
+        bool: False se o lote ja estiver em execucao.
+    """
+    caminho = _caminho(id_trabalho, "executando")
+    for _ in range(2):
+        try:
+            descritor = os.open(caminho, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if lote_em_execucao(id_trabalho):
+                return False
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(descritor, "w") as arquivo:
+            arquivo.write(str(os.getpid()))
+        return True
+    return False
+
+
+def _liberar(id_trabalho: str):
+    try:
+        os.remove(_caminho(id_trabalho, "executando"))
+    except FileNotFoundError:
+        pass
+
+
+def _tempo_espera(erro, tentativa: int):
+    """
+    Quanto esperar antes da proxima tentativa: o tempo pedido pela API (Retry-After),
+    se houver, ou um recuo exponencial com variacao aleatoria.
+    """
+    resposta = getattr(erro, "response", None)
+    cabecalhos = getattr(resposta, "headers", None) or {}
+    try:
+        if cabecalhos.get("retry-after-ms"):
+            return float(cabecalhos["retry-after-ms"]) / 1000
+        if cabecalhos.get("retry-after"):
+            return float(cabecalhos["retry-after"])
+    except ValueError:
+        pass
+    return min(30.0, 2 ** tentativa) + random.uniform(0, 1)
+
+
+def chamar_ia(cliente, **parametros):
+    """
+    Chama a IA com novas tentativas para erros temporarios. Um limite de taxa
+    atingido por uma thread pausa as demais ate o tempo pedido pela API. A chamada
+    ocupa uma vaga do limitador "ia", dividido com as rotas da aplicacao.
+    """
+    global _pausa_ate
+    # Importado aqui porque o cliente ja carregou a biblioteca (ver ia.cliente).
+    import openai
+
+    # Erros que valem uma nova tentativa (da OpenAI ou sem vaga no limitador).
+    erros_temporarios = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                         openai.InternalServerError, LimiteExcedido)
+    for tentativa in range(LOTE_TENTATIVAS):
+        espera = _pausa_ate - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+        try:
+            with limitar("ia"):
+                return cliente.chat.completions.create(**parametros)
+        except erros_temporarios as e:
+            if tentativa == LOTE_TENTATIVAS - 1:
+                raise
+            espera = _tempo_espera(e, tentativa)
+            if isinstance(e, openai.RateLimitError):
+                with _lock:
+                    _pausa_ate = max(_pausa_ate, time.monotonic() + espera)
+            else:
+                time.sleep(espera)
+
+
+def _responder(patient_id: str, prompt: str, registros: list, chave: str, versao: str,
+               cliente, modelo: str, temperatura: float, montar_mensagens):
+    """
+    Responde a pergunta para um paciente e guarda a resposta no cache.
+    """
+    if not registros:
+        return {"patient_id": patient_id, "resposta": "Nenhum dado encontrado para o paciente informado."}
+    # O indice de recuperacao usa NumPy, carregado so quando a primeira pergunta chega.
+    from ia.recuperacao import selecionar_eventos
+
+    selecionados = selecionar_eventos(patient_id, prompt, registros)
+    contexto = montar_contexto(selecionados, total_eventos=len(registros))
+    response = chamar_ia(
+        cliente,
+        model=modelo,
+        messages=montar_mensagens(patient_id, prompt, contexto),
+        temperature=temperatura,
+    )
+    resposta = response.choices[0].message.content.strip()
+    guardar_resposta(chave, patient_id, versao, resposta)
+    return {"patient_id": patient_id, "resposta": resposta}
+
+
+def _registrar(id_trabalho: str, resultado: dict):
+    """
+    Grava o resultado de um paciente no lote e marca a execucao como ativa.
+    """
+    linha = json.dumps(resultado, ensure_ascii=False) + "\n"
+    with _lock:
+        with open(_caminho(id_trabalho, "resultados"), "a", encoding="utf-8") as arquivo:
+            arquivo.write(linha)
+        try:
+            os.utime(_caminho(id_trabalho, "executando"))
+        except FileNotFoundError:
+            pass
+
+
+def executar_lote(id_trabalho: str, cliente, modelo: str, temperatura: float, montar_mensagens):
+    """
+    Executa (ou retoma) um lote, devolvendo uma resposta por paciente assim que ela
+    fica pronta.
+
+    Resultados ja obtidos em uma execucao anterior do mesmo lote sao devolvidos
+    primeiro, sem nova chamada. As jornadas sao buscadas em blocos, em uma consulta
+    por bloco, e as chamadas a IA rodam em paralelo (ate LOTE_CONCORRENCIA). Se a
+    conexao cair, as chamadas em andamento terminam e sao guardadas no lote.
+
+    Um lote tem uma unica execucao por vez, em todos os workers: ate ela e as chamadas
+    que terminam em segundo plano acabarem, outra tentativa de retoma-lo e recusada.
+
+    Args:
+        id_trabalho (str): ID retornado por `criar_lote`.
+        cliente: Cliente da OpenAI.
+        modelo (str): Modelo usado nas chamadas.
+        temperatura (float): Temperatura das respostas.
+        montar_mensagens: Funcao (patient_id, prompt, contexto) -> mensagens da IA.
+
+    Yields:
+        dict: {"patient_id", "resposta", "cache"} ou {"patient_id", "error"}.
+
+    Raises:
+        LoteEmExecucao: Se o lote ja estiver em execucao.
+    """
+    trabalho = obter_lote(id_trabalho)
+    prompt = trabalho["prompt"]
+    # As novas tentativas sao feitas aqui (com a pausa compartilhada), nao pelo cliente.
+    if hasattr(cliente, "with_options"):
+        cliente = cliente.with_options(max_retries=0)
+
+    if not _ocupar(id_trabalho):
+        raise LoteEmExecucao("Este lote ja esta em execucao; tente retoma-lo quando ela terminar.")
+    # Lidos de novo ja com o lote ocupado, para incluir o que a execucao anterior gravou.
+    anteriores = _ler_resultados(id_trabalho)
+
+    executor = None
+    em_andamento = {}
+
+    def concluir(futuro, pid):
+        try:
+            resultado = futuro.result()
+            resultado["cache"] = False
+        except Exception as e:
+            print(f"Erro no lote {id_trabalho} para o paciente {pid}: {e}")
+            resultado = {"patient_id": pid, "error": f"Erro interno: {str(e)}"}
+        _registrar(id_trabalho, resultado)
+        return resultado
+
+    def coletar():
+        # Espera ao menos uma chamada terminar.
+        feitos, _ = wait(list(em_andamento), return_when=FIRST_COMPLETED)
+        for futuro in feitos:
+            yield concluir(futuro, em_andamento.pop(futuro))
+
+    def liberar_quando_terminar(futuro, pid, restantes):
+        concluir(futuro, pid)
+        with _lock:
+            restantes[0] -= 1
+            ultima = restantes[0] == 0
+        if ultima:
+            _liberar(id_trabalho)
+
+    try:
+        for pid in trabalho["ids"]:
+            if pid in anteriores and "error" not in anteriores[pid]:
+                yield anteriores[pid]
+        pendentes = [pid for pid in trabalho["ids"] if pid not in anteriores or "error" in anteriores[pid]]
+        executor = ThreadPoolExecutor(max_workers=LOTE_CONCORRENCIA, thread_name_prefix=f"lote-{id_trabalho[:8]}")
+
+        for inicio in range(0, len(pendentes), LOTE_TAMANHO_BLOCO):
+            bloco = pendentes[inicio:inicio + LOTE_TAMANHO_BLOCO]
+
+            # Respostas ja em cache nao precisam da jornada nem da IA.
+            versoes = versoes_pacientes(bloco)
+            faltando = []
+            for pid in bloco:
+                chave = chave_resposta(prompt, pid, versoes[pid], modelo, temperatura)
+                resposta_cache = obter_resposta(chave)
+                if resposta_cache is not None:
+                    resultado = {"patient_id": pid, "resposta": resposta_cache, "cache": True}
+                    _registrar(id_trabalho, resultado)
+                    yield resultado
+                else:
+                    faltando.append((pid, chave))
+
+            jornadas = buscar_jornadas_por_ids(
+                [pid for pid, _ in faltando], colunas=COLUNAS_CONTEXTO, limite_por_paciente=LIMITE_EVENTOS_CONTEXTO
+            )
+            for pid, chave in faltando:
+                while len(em_andamento) >= LOTE_CONCORRENCIA:
+                    yield from coletar()
+                futuro = executor.submit(
+                    _responder, pid, prompt, jornadas.pop(pid), chave, versoes[pid],
+                    cliente, modelo, temperatura, montar_mensagens,
+                )
+                em_andamento[futuro] = pid
+
+        while em_andamento:
+            yield from coletar()
+    finally:
+        # Conexao encerrada no meio: as chamadas em andamento terminam em segundo plano
+        # e seus resultados ficam no lote para quando ele for retomado. O lote so fica
+        # livre para ser retomado quando a ultima delas terminar.
+        if not em_andamento:
+            _liberar(id_trabalho)
+        restantes = [len(em_andamento)]
+        for futuro, pid in list(em_andamento.items()):
+            futuro.add_done_callback(lambda f, pid=pid: liberar_quando_terminar(f, pid, restantes))
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def resumo_lote(id_trabalho: str):
+    """
+    Conta os pacientes respondidos, com erro e pendentes de um lote.
+
+    Returns:
+        dict: {"total", "concluidos", "erros", "pendentes"}.
+    """
+    trabalho = obter_lote(id_trabalho)
+    resultados = list(trabalho["resultados"].values())
+    erros = sum(1 for r in resultados if "error" in r)
+    concluidos = len(resultados) - erros
+    return {
+        "total": len(trabalho["ids"]),
+        "concluidos": concluidos,
+        "erros": erros,
+        "pendentes": len(trabalho["ids"]) - len(resultados),
+    }
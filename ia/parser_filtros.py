@@ -0,0 +1,306 @@
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from db.busca_texto import normalizar_texto
+from db.cache_listas import obter_lista, versao_listas
+from db.sugestoes import resolver_filtros
+from nucleo.metricas import medir, registrar_tokens
+from nucleo.concorrencia import coalescer, limitar
+
+
+# Quantidade maxima de consultas interpretadas mantidas em memoria.
+CACHE_PARSER_MAX_ITENS = int(os.getenv("CACHE_PARSER_MAX_ITENS", "1024"))
+# Listas com mais nomes que isso nao vao no prompt da IA; os nomes que ela extrair sao
+# trocados pelos cadastrados mais parecidos (ver db.sugestoes).
+PARSER_NOMES_MAX = int(os.getenv("PARSER_NOMES_MAX", "50"))
+# Idade usada como limite quando a consulta informa apenas um dos lados da faixa.
+IDADE_MAXIMA = 130
+
+CHAVES_FILTRO = ("idade_min", "idade_max", "convenios", "profissionais", "conjuntos", "termos_busca")
+
+# Consulta normalizada + versao das listas -> filtros interpretados (LRU).
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+# Expressoes de idade reconhecidas localmente, sobre o texto ja normalizado (sem acentos).
+_PADROES_IDADE = [
+    (re.compile(r"\b(?:entre|de)\s+(\d{1,3})\s+(?:e|a)\s+(\d{1,3})\s+anos?\b"), lambda a, b: (int(a), int(b))),
+    (re.compile(r"\b(?:ate|no maximo)\s+(\d{1,3})\s+anos?\b"), lambda a: (0, int(a))),
+    (re.compile(r"\b(?:menos de|abaixo de|menores de)\s+(\d{1,3})\s+anos?\b"), lambda a: (0, int(a) - 1)),
+    (re.compile(r"\b(?:a partir de|pelo menos|no minimo)\s+(\d{1,3})\s+anos?\b"), lambda a: (int(a), IDADE_MAXIMA)),
+    (re.compile(r"\b(?:mais de|acima de|maiores de)\s+(\d{1,3})\s+anos?\b"), lambda a: (int(a) + 1, IDADE_MAXIMA)),
+]
+
+# Trechos que nao carregam criterio de busca e podem ser descartados.
+_PREFIXO = re.compile(
+    r"^(?:(?:liste|listar|mostre|mostrar|busque|buscar|encontre|encontrar|quais sao|quero|me de)\s+)?"
+    r"(?:(?:todos\s+)?(?:os|as)\s+)?(?:pacientes?|pessoas?)?\s*"
+)
+# Conectores removidos apenas do inicio e do fim de cada termo ("com diabetes" -> "diabetes"),
+# para nao alterar termos como "dor de cabeca".
+_CONECTORES = (
+    r"(?:com diagnostico de|diagnostico de|diagnosticados com|que tem|que tiveram|que possuem|"
+    r"atendidos por|atendidas por|atendido por|atendida por|com|do|da|dos|das|pelo|pela|de|no|na|e)"
+)
+_CONECTOR_INICIO = re.compile(rf"^{_CONECTORES}\s+")
+_CONECTOR_FIM = re.compile(rf"\s+{_CONECTORES}$")
+# Palavras que indicam uma consulta mais complexa (negacao, comparacao, tempo, nomes
+# incompletos de profissionais ou convenios), deixada para a IA.
+_PALAVRAS_COMPLEXAS = {
+    "nao", "sem", "exceto", "menos", "mais", "ou", "antes", "depois", "ultimo", "ultimos",
+    "ultima", "ultimas", "desde", "entre", "ano", "anos", "mes", "meses", "dia", "dias",
+    "dr", "dra", "doutor", "doutora", "medico", "medica", "medicos", "profissional",
+    "convenio", "convenios", "plano", "conjunto", "conjuntos", "idade", "por", "filtro", "busca",
+}
+# Conectores que, no meio de um termo, ligam criterios diferentes ("idosos com hipertensao",
+# "diabeticos que usam insulina"). Preposicoes como "de" e "nas" ficam de fora, pois fazem
+# parte de termos clinicos ("dor de cabeca", "dor nas costas").
+_CONECTORES_INTERNOS = {
+    "com", "que", "para", "pelo", "pela", "pelos", "pelas", "cujo", "cuja", "cujos", "cujas",
+    "quem", "onde", "quando", "como", "tem", "tiveram", "possuem", "apresentam", "usam",
+}
+# Qualificadores de populacao que nao sao termos clinicos (no singular; o plural e testado
+# sem o "s" final).
+_QUALIFICADORES = {
+    "idoso", "idosa", "crianca", "adulto", "adulta", "jovem", "jovens", "adolescente", "bebe",
+    "homem", "homens", "mulher", "mulheres", "masculino", "feminino", "sexo", "gestante",
+    "internado", "internada", "ativo", "ativa", "novo", "nova", "recente",
+}
+
+
+def _completar_faixa_idade(filtros: dict):
+    """
+    O filtro de pacientes exige os dois limites de idade; completa o que faltar.
+    """
+    if filtros.get("idade_min") is not None or filtros.get("idade_max") is not None:
+        filtros.setdefault("idade_min", 0)
+        filtros.setdefault("idade_max", IDADE_MAXIMA)
+        if filtros["idade_min"] is None:
+            filtros["idade_min"] = 0
+        if filtros["idade_max"] is None:
+            filtros["idade_max"] = IDADE_MAXIMA
+    return filtros
+
+
+# Qualificadores que podem anteceder um nome conhecido e sao removidos junto com ele,
+# ex.: "atendidos por Dra. Ana", "do convenio Agros".
+_QUALIFICADOR_NOME = (
+    r"(?:(?:atendid[oa]s? por|com|do|da|dos|das|pelo|pela|no|na)\s+)?"
+    r"(?:(?:o|a)\s+)?(?:(?:convenio|plano|conjunto|profissional|medic[oa]|dr\.?|dra\.?|doutora?)\s+)?"
+)
+
+
+def _encontrar_nomes(texto: str, nomes: list):
+    """
+    Procura nomes conhecidos (sem acento/caixa) no texto, preferindo os mais longos.
+
+    Returns:
+        tuple: Os nomes canonicos encontrados e o texto sem esses trechos.
+    """
+    encontrados = []
+    for nome in sorted(nomes, key=len, reverse=True):
+        normalizado = normalizar_texto(nome)
+        # O teste de substring evita compilar uma expressao para cada nome da lista.
+        if not normalizado or normalizado not in texto:
+            continue
+        padrao = re.compile(rf"(?<!\w){_QUALIFICADOR_NOME}{re.escape(normalizado)}(?!\w)")
+        if padrao.search(texto):
+            encontrados.append(nome)
+            texto = padrao.sub(" ", texto)
+    return encontrados, texto
+
+
+def _palavra_complexa(palavra: str):
+    """
+    Indica se a palavra impede que o trecho seja tratado como um termo clinico.
+    """
+    return (palavra in _PALAVRAS_COMPLEXAS or palavra in _CONECTORES_INTERNOS or palavra.isdigit()
+            or palavra in _QUALIFICADORES or palavra.rstrip("s") in _QUALIFICADORES)
+
+
+def pre_interpretar(consulta: str, convenios: list, profissionais: list, conjuntos: list):
+    """
+    Interpreta localmente, sem chamar a IA, as consultas mais comuns: faixas de idade
+    ("ate 60 anos", "entre 10 e 45 anos"), nomes exatos de convenios, profissionais e
+    conjuntos, e termos clinicos separados por virgula ou "e".
+
+    Args:
+        consulta (str): Texto digitado pelo usuario.
+        convenios (list): Nomes validos de convenios.
+        profissionais (list): Nomes validos de profissionais.
+        conjuntos (list): Nomes validos de conjuntos.
+
+    Returns:
+        dict | None: Os filtros no mesmo formato retornado pela IA, ou None se a
+                     consulta tiver algo que o interpretador local nao entende.
+    """
+    texto = normalizar_texto(consulta)
+    filtros = {}
+    # Grafia original de cada palavra: a interpretacao usa o texto sem acentos, mas os
+    # termos de busca voltam como o usuario escreveu (o modo "ilike" compara o texto
+    # como esta, e "hipertensao" nao encontraria "hipertensão").
+    originais = {}
+    for palavra in re.findall(r"[\w\-/]+", consulta or ""):
+        originais.setdefault(normalizar_texto(palavra), palavra)
+
+    for padrao, converter in _PADROES_IDADE:
+        m = padrao.search(texto)
+        if m:
+            filtros["idade_min"], filtros["idade_max"] = converter(*m.groups())
+            texto = texto[:m.start()] + " " + texto[m.end():]
+            break
+
+    for chave, nomes in (("convenios", convenios), ("profissionais", profissionais), ("conjuntos", conjuntos)):
+        encontrados, texto = _encontrar_nomes(texto, nomes)
+        if encontrados:
+            filtros[chave] = encontrados
+
+    # O que sobra deve ser apenas uma lista de termos clinicos.
+    texto = _PREFIXO.sub("", texto.strip(" .?!"))
+    termos = []
+    for parte in re.split(r",|;|\s+e\s+", texto):
+        termo = " ".join(parte.split()).strip(" .?!")
+        anterior = None
+        while termo != anterior:
+            anterior = termo
+            termo = _CONECTOR_FIM.sub("", _CONECTOR_INICIO.sub("", termo))
+        if not termo or termo in ("com", "e"):
+            continue
+        palavras = re.findall(r"\w+", termo)
+        if re.search(r"[^\w\s\-/]", termo) or len(palavras) > 4 or any(_palavra_complexa(p) for p in palavras):
+            return None
+        termos.append(" ".join(originais.get(p, p) for p in termo.split()))
+    if termos:
+        filtros["termos_busca"] = termos
+
+    return filtros or None
+
+
+@lru_cache(maxsize=4)
+def _prompt_sistema(versao: str):
+    """
+    Monta o prompt de sistema com os nomes validos. E refeito apenas quando as
+    listas de convenios, profissionais ou conjuntos mudam de versao.
+    """
+    # Busca listas de entidades validas para ajudar a IA a identificar os filtros corretos.
+    # Listas longas ficam de fora: a IA copia o nome como escrito e ele e resolvido depois.
+    def listar(nome):
+        valores = obter_lista(nome)
+        if len(valores) > PARSER_NOMES_MAX:
+            return "(lista longa omitida; copie o nome como o usuario escreveu)"
+        return ", ".join(valores)
+
+    lista_convenios = listar("convenios")
+    lista_profissionais = listar("profissionais")
+    lista_conjuntos = listar("conjuntos")
+
+    return f"""
+        Voce e um assistente especialista em extrair criterios de busca de um texto em linguagem natural.
+        Sua unica tarefa e converter o texto do usuario em um objeto JSON.
+        O JSON de saida deve conter apenas as seguintes chaves: "idade_min", "idade_max", "convenios", "profissionais", "conjuntos", e "termos_busca".
+
+        REGRAS IMPORTANTES:
+        - Retorne APENAS o objeto JSON, sem nenhum texto adicional.
+        - A chave "termos_busca" deve ser uma LISTA de strings contendo os termos clinicos. Se apenas um termo for encontrado, coloque-o dentro de uma lista.
+        - As chaves "convenios", "profissionais" e "conjuntos" tambem devem ser listas de strings.
+        - Se uma informacao nao for mencionada, omita a chave do JSON.
+        - As idades sao inclusivas: "mais de N anos" e idade_min N+1, "menos de N anos" e idade_max N-1, "ate N anos" e idade_max N e "a partir de N anos" e idade_min N.
+        - Para te ajudar, aqui estao nomes validos que podem aparecer:
+        - Convenios: {lista_convenios}
+        - Profissionais: {lista_profissionais}
+        - Conjuntos: {lista_conjuntos}
+
+        Exemplo 1:
+        Texto: "liste os pacientes com diabetes e hipertensao"
+        JSON: {{"termos_busca": ["diabetes", "hipertensao"]}}
+
+        Exemplo 2:
+        Texto: "pacientes do Dr. Carlos com mais de 50 anos e diagnóstico de pneumonia"
+        JSON: {{"profissionais": ["Dr. Carlos"], "idade_min": 51, "termos_busca": ["pneumonia"]}}
+        """
+
+
+def interpretar_com_ia(cliente, modelo: str, consulta: str, versao: str):
+    """
+    Pede a IA para converter a consulta em um JSON de filtros.
+
+    Returns:
+        dict: Os filtros extraidos pela IA.
+    """
+    # Envia a requisicao para a IA com o modo de resposta JSON ativado.
+    with limitar("ia"), medir("ia"):
+        response = cliente.chat.completions.create(
+            model=modelo,
+            messages=[
+                {"role": "system", "content": _prompt_sistema(versao)},
+                {"role": "user", "content": consulta}
+            ],
+            temperature=0, # Temperatura 0 para a maxima consistencia.
+            response_format={"type": "json_object"}
+        )
+    registrar_tokens(getattr(response, "usage", None), modelo)
+    return json.loads(response.choices[0].message.content)
+
+
+def interpretar_filtro(consulta: str, cliente, modelo: str):
+    """
+    Converte uma busca em linguagem natural em filtros para `filtrar_pacientes`.
+
+    A consulta (em minusculas, com espacos colapsados) e a versao das listas de entidades formam a chave do cache.
+    Em caso de falha no cache, tenta primeiro o interpretador local e so chama a IA
+    quando ele nao consegue entender a consulta. Consultas identicas que chegam
+    enquanto a primeira ainda esta sendo interpretada aguardam o resultado dela.
+
+    Args:
+        consulta (str): Texto digitado pelo usuario.
+        cliente: Cliente da OpenAI.
+        modelo (str): Modelo usado na chamada a IA.
+
+    Returns:
+        tuple: Os filtros (dict) e a origem da interpretacao ("cache", "local" ou "ia").
+    """
+    versao = versao_listas()
+    # A chave mantem os acentos, pois os termos de busca sao devolvidos com a grafia da consulta.
+    chave = (" ".join((consulta or "").lower().split()), versao)
+
+    with _lock:
+        if chave in _cache:
+            _cache.move_to_end(chave)
+            return json.loads(_cache[chave]), "cache"
+
+    filtros_json, origem = coalescer("parser_filtros", chave, _interpretar, consulta, cliente, modelo, versao, chave)
+    return json.loads(filtros_json), origem
+
+
+def _interpretar(consulta: str, cliente, modelo: str, versao: str, chave: tuple):
+    """
+    Interpreta a consulta (localmente ou pela IA) e guarda o resultado no cache.
+
+    Returns:
+        tuple: Os filtros em JSON e a origem da interpretacao ("local" ou "ia").
+    """
+    filtros = pre_interpretar(
+        consulta, obter_lista("convenios"), obter_lista("profissionais"), obter_lista("conjuntos")
+    )
+    origem = "local"
+    if filtros is None:
+        filtros = interpretar_com_ia(cliente, modelo, consulta, versao)
+        origem = "ia"
+
+    filtros = _completar_faixa_idade({k: v for k, v in filtros.items() if k in CHAVES_FILTRO})
+    if origem == "ia":
+        # A IA pode devolver nomes aproximados ("Dr. Carlos"); o filtro exige os cadastrados.
+        filtros = resolver_filtros(filtros)
+
+    with _lock:
+        # Guardado como JSON para que quem recebe o resultado nao altere o valor em cache.
+        _cache[chave] = filtros_json = json.dumps(filtros, ensure_ascii=False)
+        _cache.move_to_end(chave)
+        while len(_cache) > CACHE_PARSER_MAX_ITENS:
+            _cache.popitem(last=False)
+
+    return filtros_json, origem
@@ -0,0 +1,276 @@
+import os
+import re
+import math
+import time
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from db.busca_texto import normalizar_texto
+
+
+# Eventos mais relacionados a pergunta enviados a IA, alem dos mais recentes.
+RECUPERACAO_TOP_K = int(os.getenv("RECUPERACAO_TOP_K", "150"))
+# Eventos mais recentes sempre enviados, qualquer que seja a pergunta.
+RECUPERACAO_RECENTES = int(os.getenv("RECUPERACAO_RECENTES", "100"))
+RECUPERACAO_ATIVA = os.getenv("RECUPERACAO_ATIVA", "1") == "1"
+# Diretorio dos indices salvos, um arquivo por paciente.
+RECUPERACAO_DIR = os.getenv("RECUPERACAO_DIR", os.path.join("cache", "recuperacao"))
+# Indices de pacientes mantidos em memoria.
+RECUPERACAO_CACHE_PACIENTES = int(os.getenv("RECUPERACAO_CACHE_PACIENTES", "32"))
+# Tamanho maximo do diretorio; ao ultrapassa-lo, os indices usados ha mais tempo sao removidos.
+RECUPERACAO_MAX_MB = int(os.getenv("RECUPERACAO_MAX_MB", "200"))
+
+# Quantidade de posicoes do vetor de hashing (2^20): colisoes entre termos ficam raras.
+DIMENSAO = 1 << 20
+# Tamanho do prefixo usado como radical (ex.: "hipertensao" e "hipertenso" -> "hipert").
+TAMANHO_RADICAL = 6
+
+# Palavras sem valor para a busca, comuns nas perguntas e nas descricoes.
+_PALAVRAS_VAZIAS = {
+    "a", "o", "as", "os", "um", "uma", "de", "da", "do", "das", "dos", "e", "em", "no", "na", "nos", "nas",
+    "por", "para", "com", "sem", "que", "se", "ao", "aos", "ou", "como", "qual", "quais", "quando", "onde",
+    "ele", "ela", "seu", "sua", "seus", "suas", "foi", "ser", "ha", "tem", "teve", "sobre", "entre",
+    "paciente", "faca", "mostre", "liste", "informe", "me", "diga", "existe", "existem", "algum", "alguma",
+}
+_PALAVRA = re.compile(r"[a-z][a-z0-9]+")
+
+# ID do paciente -> indice carregado (LRU).
+_indices = OrderedDict()
+_lock = threading.Lock()
+# Locks por paciente (divididos em faixas): a atualizacao e a gravacao do indice de um
+# paciente nao bloqueiam as dos outros.
+_locks_pacientes = [threading.Lock() for _ in range(64)]
+_NOME_VALIDO = re.compile(r"^[0-9a-f]{64}\.npz$")
+
+
+def _hash_texto(texto: str):
+    """
+    Hash estavel (entre processos) de uma descricao, usado para reconhecer textos ja indexados.
+    """
+    return int.from_bytes(hashlib.blake2b(texto.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+def _termos(texto: str):
+    """
+    Converte um texto em posicoes do vetor de hashing: cada palavra e seu radical.
+
+    Returns:
+        dict: Posicao -> quantidade de ocorrencias.
+    """
+    termos = {}
+    for palavra in _PALAVRA.findall(normalizar_texto(texto)):
+        if palavra in _PALAVRAS_VAZIAS:
+            continue
+        chaves = ["p:" + palavra]
+        if len(palavra) > TAMANHO_RADICAL:
+            chaves.append("r:" + palavra[:TAMANHO_RADICAL])
+        for chave in chaves:
+            posicao = zlib.crc32(chave.encode("utf-8")) % DIMENSAO
+            termos[posicao] = termos.get(posicao, 0) + 1
+    return termos
+
+
+class _Indice:
+    """
+    Vetores esparsos (formato CSR em arrays NumPy) das descricoes distintas de um
+    paciente. Cada descricao e vetorizada uma unica vez; descricoes novas sao
+    acrescentadas sem refazer as anteriores. Um indice nao muda depois de criado,
+    entao pode ser usado por varias requisicoes ao mesmo tempo.
+    """
+
+    def __init__(self, hashes=None, posicoes=None, pesos=None, inicios=None):
+        self.hashes = hashes if hashes is not None else np.zeros(0, dtype=np.int64)
+        self.posicoes = posicoes if posicoes is not None else np.zeros(0, dtype=np.int32)
+        self.pesos = pesos if pesos is not None else np.zeros(0, dtype=np.float32)
+        self.inicios = inicios if inicios is not None else np.zeros(1, dtype=np.int64)
+        self.linhas = {int(h): i for i, h in enumerate(self.hashes)}
+
+    def acrescentar(self, textos: dict):
+        """
+        Vetoriza as descricoes ainda nao indexadas e retorna um novo indice com elas.
+        Se a maior parte das descricoes guardadas nao estiver mais em `textos` (eventos
+        editados ou removidos), o novo indice e refeito so com as de `textos`.
+
+        Args:
+            textos (dict): Hash -> descricao.
+
+        Returns:
+            _Indice | None: O novo indice, ou None se todas ja estiverem indexadas.
+        """
+        novos = [(h, t) for h, t in textos.items() if h not in self.linhas]
+        if not novos:
+            return None
+        base = self
+        if len(self.linhas) - (len(textos) - len(novos)) > len(textos):
+            base, novos = _Indice(), list(textos.items())
+        posicoes, pesos, tamanhos = [], [], []
+        for _, texto in novos:
+            termos = _termos(texto)
+            posicoes.extend(termos.keys())
+            # Frequencia sublinear: repetir uma palavra pesa pouco.
+            pesos.extend(1.0 + math.log(n) for n in termos.values())
+            tamanhos.append(len(termos))
+        return _Indice(
+            np.concatenate([base.hashes, np.array([h for h, _ in novos], dtype=np.int64)]),
+            np.concatenate([base.posicoes, np.array(posicoes, dtype=np.int32)]),
+            np.concatenate([base.pesos, np.array(pesos, dtype=np.float32)]),
+            np.concatenate([base.inicios, base.inicios[-1] + np.cumsum(tamanhos, dtype=np.int64)]),
+        )
+
+    def pontuar(self, linhas: np.ndarray, pergunta: str):
+        """
+        Similaridade do cosseno (TF-IDF) entre a pergunta e as descricoes `linhas`.
+        O IDF e calculado sobre os eventos informados, entao termos presentes em
+        quase todos os eventos do paciente pesam pouco.
+
+        Returns:
+            np.ndarray: Uma pontuacao por elemento de `linhas` (0 sem termos em comum).
+        """
+        termos_pergunta = _termos(pergunta)
+        if not termos_pergunta or not len(linhas):
+            return np.zeros(len(linhas), dtype=np.float32)
+
+        unicas, por_evento = np.unique(linhas, return_inverse=True)
+        ocorrencias = np.bincount(por_evento, minlength=len(unicas))
+        inicios = self.inicios[unicas]
+        tamanhos = self.inicios[unicas + 1] - inicios
+        # Termos das descricoes usadas, em sequencia, e a linha (descricao) de cada um.
+        deslocamentos = np.repeat(inicios - (np.cumsum(tamanhos) - tamanhos), tamanhos)
+        selecao = np.arange(tamanhos.sum()) + deslocamentos
+        linha_termo = np.repeat(np.arange(len(unicas)), tamanhos)
+        termos, termo = np.unique(self.posicoes[selecao], return_inverse=True)
+
+        # Em quantos eventos cada termo aparece (descricoes repetidas contam varias vezes).
+        df = np.bincount(termo, weights=ocorrencias[linha_termo], minlength=len(termos))
+        idf = np.log((1 + len(linhas)) / (1 + df)) + 1.0
+        pesos = self.pesos[selecao] * idf[termo]
+        normas = np.sqrt(np.bincount(linha_termo, weights=pesos ** 2, minlength=len(unicas)))
+
+        vetor_pergunta = np.zeros(len(termos))
+        for posicao, n in termos_pergunta.items():
+            i = np.searchsorted(termos, posicao)
+            if i < len(termos) and termos[i] == posicao:
+                vetor_pergunta[i] = (1.0 + np.log(n)) * idf[i]
+        if not vetor_pergunta.any():
+            return np.zeros(len(linhas), dtype=np.float32)
+
+        produto = np.bincount(linha_termo, weights=pesos * vetor_pergunta[termo], minlength=len(unicas))
+        pontuacoes = np.divide(produto, normas, out=np.zeros_like(produto), where=normas > 0)
+        return pontuacoes[por_evento].astype(np.float32)
+
+    def salvar(self, caminho: str):
+        os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+        temporario = f"{caminho}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+        with open(temporario, "wb") as f:
+            np.savez(f, hashes=self.hashes, posicoes=self.posicoes, pesos=self.pesos, inicios=self.inicios)
+        os.replace(temporario, caminho)
+
+    @classmethod
+    def carregar(cls, caminho: str):
+        try:
+            with np.load(caminho) as arquivo:
+                indice = cls(arquivo["hashes"], arquivo["posicoes"], arquivo["pesos"], arquivo["inicios"])
+            # Cada carga conta como uso recente (LRU do diretorio).
+            os.utime(caminho)
+            return indice
+        except (OSError, KeyError, ValueError):
+            return cls()
+
+
+def _caminho_indice(patient_id: str):
+    nome = hashlib.sha256(str(patient_id).encode("utf-8")).hexdigest()
+    return os.path.join(RECUPERACAO_DIR, f"{nome}.npz")
+
+
+def _aplicar_limites():
+    """
+    Remove os indices usados ha mais tempo ate o diretorio ficar dentro do limite.
+    """
+    arquivos = []
+    for entrada in os.scandir(RECUPERACAO_DIR):
+        if entrada.is_file() and _NOME_VALIDO.match(entrada.name):
+            info = entrada.stat()
+            arquivos.append((info.st_mtime, info.st_size, entrada.path))
+
+    excedente = sum(tamanho for _, tamanho, _ in arquivos) - RECUPERACAO_MAX_MB * 1024 * 1024
+    for _, tamanho, caminho in sorted(arquivos):
+        if excedente <= 0:
+            break
+        try:
+            os.remove(caminho)
+        except OSError:
+            continue
+        excedente -= tamanho
+
+
+def _obter_indice(patient_id: str, textos: dict):
+    """
+    Retorna o indice do paciente (da memoria, do disco ou novo), ja com todas as
+    descricoes de `textos`. O arquivo so e regravado quando surgem descricoes novas;
+    a vetorizacao e a gravacao usam apenas o lock do paciente.
+    """
+    pid = str(patient_id)
+    caminho = _caminho_indice(pid)
+    with _locks_pacientes[zlib.crc32(pid.encode("utf-8")) % len(_locks_pacientes)]:
+        with _lock:
+            indice = _indices.get(pid)
+            if indice is not None:
+                _indices.move_to_end(pid)
+        if indice is None:
+            indice = _Indice.carregar(caminho)
+        novo = indice.acrescentar(textos)
+        if novo is not None:
+            novo.salvar(caminho)
+            indice = novo
+
+        with _lock:
+            _indices[pid] = indice
+            _indices.move_to_end(pid)
+            while len(_indices) > RECUPERACAO_CACHE_PACIENTES:
+                _indices.popitem(last=False)
+    if novo is not None:
+        _aplicar_limites()
+    return indice
+
+
+def selecionar_eventos(patient_id: str, pergunta: str, registros: list, top_k: int = None, recentes: int = None):
+    """
+    Escolhe os eventos enviados a IA: os `recentes` mais recentes e os `top_k` cujas
+    descricoes mais se parecem com a pergunta. Quando a pergunta nao tem termos em
+    comum com os eventos (ex.: "Faca um resumo"), ou ha poucos eventos, todos sao mantidos.
+
+    Args:
+        patient_id (str): ID do paciente (o indice das descricoes e salvo por paciente).
+        pergunta (str): Pergunta do usuario.
+        registros (list): Eventos do paciente (dicionarios com "data" e "descricao").
+        top_k (int, optional): Eventos escolhidos pela semelhanca (padrao RECUPERACAO_TOP_K).
+        recentes (int, optional): Eventos mais recentes sempre mantidos (padrao RECUPERACAO_RECENTES).
+
+    Returns:
+        list: Os eventos escolhidos, na ordem original.
+    """
+    top_k = RECUPERACAO_TOP_K if top_k is None else top_k
+    recentes = RECUPERACAO_RECENTES if recentes is None else recentes
+    if not RECUPERACAO_ATIVA or len(registros) <= top_k + recentes:
+        return registros
+
+    descricoes = [" ".join(str(r.get("descricao") or "").split()) for r in registros]
+    hashes = [_hash_texto(d) for d in descricoes]
+    indice = _obter_indice(patient_id, dict(zip(hashes, descricoes)))
+    linhas = np.fromiter((indice.linhas[h] for h in hashes), dtype=np.int64, count=len(hashes))
+    pontuacoes = indice.pontuar(linhas, pergunta)
+    if not pontuacoes.any():
+        return registros
+
+    # Os mais recentes pela data (os registros podem nao estar ordenados).
+    datas = np.array([str(r.get("data") or "") for r in registros])
+    escolhidos = set(np.argsort(datas, kind="stable")[-recentes:].tolist()) if recentes else set()
+    candidatos = np.flatnonzero(pontuacoes > 0)
+    melhores = candidatos[np.argsort(-pontuacoes[candidatos], kind="stable")[:top_k]]
+    escolhidos.update(melhores.tolist())
+    return [registros[i] for i in sorted(escolhidos)]
+
@@ -0,0 +1,332 @@
+import os
+import re
+import time
+import threading
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from sqlalchemy import text
+
+from db.conexao import conectar, transacao
+from db.busca_texto import normalizar_texto
+from ia.contexto import montar_contexto, COLUNAS_CONTEXTO, LIMITE_EVENTOS_CONTEXTO
+from ia.lote import chamar_ia
+
+
+# Chamadas simultaneas a IA feitas pelo job de resumos.
+RESUMOS_CONCORRENCIA = int(os.getenv("RESUMOS_CONCORRENCIA", "2"))
+# Resumos gerados por execucao do job.
+RESUMOS_LOTE = int(os.getenv("RESUMOS_LOTE", "200"))
+# Pacientes com eventos ou acessos nos ultimos dias entram na fila do job.
+RESUMOS_JANELA_DIAS = int(os.getenv("RESUMOS_JANELA_DIAS", "30"))
+# Intervalo (em segundos) para gravar no banco os pacientes acessados pela aplicacao.
+RESUMOS_DEMANDA_INTERVALO_S = int(os.getenv("RESUMOS_DEMANDA_INTERVALO_S", "60"))
+RESUMOS_ATIVOS = os.getenv("RESUMOS_ATIVOS", "1") == "1"
+
+# Pergunta usada para gerar os resumos; a mesma resposta atende "Faca um resumo".
+PERGUNTA_RESUMO = "Faca um resumo da ficha medica desse paciente"
+# Palavras aceitas em um pedido de resumo alem de "resumo" (ex.: "Faca um resumo da ficha medica desse paciente").
+_PALAVRAS_PEDIDO_RESUMO = {
+    "faca", "fazer", "faz", "gere", "gerar", "escreva", "mostre", "me", "de", "quero", "um", "uma", "o", "a",
+    "breve", "geral", "completo", "clinico", "da", "do", "dessa", "desse", "deste", "desta", "ficha", "medica",
+    "historico", "prontuario", "paciente", "jornada", "por", "favor",
+}
+_PALAVRAS_RESUMO = {"resumo", "resuma", "resumir", "sumario"}
+
+_disponivel = False
+_verificado_em = None
+# ID do paciente -> acessos ainda nao gravados no banco.
+_demanda = Counter()
+_demanda_gravada_em = time.monotonic()
+_lock = threading.Lock()
+
+
+def criar_estruturas():
+    """
+    Cria a tabela dos resumos (um por paciente, com a versao dos dados usada) e a
+    tabela de acessos usada para priorizar o job. Pode ser executada varias vezes.
+    """
+    with transacao() as conn:
+        # As tabelas sao criadas a partir de mpiv02.events, assim id_paciente tem o mesmo tipo.
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS mpiv02.resumos_ia AS
+            SELECT id_paciente, ''::TEXT AS versao, ''::TEXT AS resumo, ''::TEXT AS modelo, NOW() AS gerado_em
+            FROM mpiv02.events
+            WITH NO DATA
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS mpiv02.resumos_ia_demanda AS
+            SELECT id_paciente, 0::BIGINT AS acessos, NOW() AS ultimo_acesso
+            FROM mpiv02.events
+            WITH NO DATA
+        """))
+        conn.execute(text("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'resumos_ia_pkey') THEN
+                    ALTER TABLE mpiv02.resumos_ia ADD CONSTRAINT resumos_ia_pkey PRIMARY KEY (id_paciente);
+                END IF;
+                IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'resumos_ia_demanda_pkey') THEN
+                    ALTER TABLE mpiv02.resumos_ia_demanda ADD CONSTRAINT resumos_ia_demanda_pkey PRIMARY KEY (id_paciente);
+                END IF;
+            END $$
+        """))
+
+
+def resumos_disponiveis():
+    """
+    Verifica se a tabela de resumos existe (ver `criar_estruturas`). O resultado
+    positivo fica guardado; o negativo e verificado de novo a cada minuto.
+    """
+    global _disponivel, _verificado_em
+    if _disponivel:
+        return True
+    if not RESUMOS_ATIVOS:
+        return False
+    agora = time.monotonic()
+    if _verificado_em is not None and agora - _verificado_em < 60:
+        return False
+    with conectar() as conn:
+        existe = conn.execute(text("SELECT to_regclass('mpiv02.resumos_ia_demanda') IS NOT NULL")).scalar()
+    _disponivel = bool(existe)
+    _verificado_em = agora
+    return _disponivel
+
+
+def e_pedido_resumo(prompt: str):
+    """
+    Indica se a pergunta e apenas um pedido de resumo geral do paciente
+    (ex.: "Faca um resumo", "Resumo da ficha medica desse paciente").
+    """
+    palavras = re.findall(r"\w+", normalizar_texto(prompt))
+    return (any(p in _PALAVRAS_RESUMO for p in palavras)
+            and all(p in _PALAVRAS_RESUMO or p in _PALAVRAS_PEDIDO_RESUMO for p in palavras))
+
+
+def obter_resumo(patient_id: str):
+    """
+    Busca o resumo guardado de um paciente.
+
+    Returns:
+        dict: {"resumo", "versao", "gerado_em"}, ou None se nao houver resumo.
+    """
+    if not resumos_disponiveis():
+        return None
+    with conectar() as conn:
+        row = conn.execute(text("""
+            SELECT resumo, versao, gerado_em FROM mpiv02.resumos_ia WHERE id_paciente = :pid
+        """), {"pid": str(patient_id)}).first()
+    return dict(row._mapping) if row else None
+
+
+def guardar_resumo(patient_id: str, versao: str, resumo: str, modelo: str):
+    """
+    Guarda (ou substitui) o resumo de um paciente e a versao dos dados usada.
+    Chamada apenas pelo job em segundo plano (`gerar_resumo`): respostas das rotas
+    interativas nao substituem o resumo guardado.
+    """
+    if not resumos_disponiveis():
+        return
+    with conectar() as conn:
+        conn.execute(text("""
+            INSERT INTO mpiv02.resumos_ia (id_paciente, versao, resumo, modelo, gerado_em)
+            VALUES (:pid, :versao, :resumo, :modelo, NOW())
+            ON CONFLICT (id_paciente) DO UPDATE
+            SET versao = EXCLUDED.versao, resumo = EXCLUDED.resumo,
+                modelo = EXCLUDED.modelo, gerado_em = EXCLUDED.gerado_em
+        """), {"pid": str(patient_id), "versao": versao, "resumo": resumo, "modelo": modelo})
+        conn.commit()
+
+
+def resumo_para_pergunta(patient_id: str, prompt: str, versao: str):
+    """
+    Consulta o resumo guardado de um paciente para responder uma pergunta.
+
+    Returns:
+        tuple: (resposta, contexto). `resposta` e o resumo quando a pergunta e um
+               pedido de resumo e ele foi gerado com a versao atual dos dados.
+               Para as demais perguntas, `contexto` e o resumo (mesmo de uma versao
+               anterior, com a data em que foi gerado) para acompanhar os eventos.
+    """
+    guardado = obter_resumo(patient_id)
+    if guardado is None:
+        return None, None
+    if e_pedido_resumo(prompt):
+        return (guardado["resumo"] if guardado["versao"] == versao else None), None
+    return None, f"(gerado em {guardado['gerado_em']:%Y-%m-%d})\n{guardado['resumo']}"
+
+
+def registrar_demanda(ids):
+    """
+    Conta um acesso para cada paciente (perguntas e resultados de filtros). Os
+    acessos sao somados em memoria e gravados em segundo plano a cada
+    RESUMOS_DEMANDA_INTERVALO_S, sem atrasar a requisicao.
+    """
+    global _demanda_gravada_em
+    if not RESUMOS_ATIVOS:
+        return
+    with _lock:
+        _demanda.update(str(pid) for pid in ids)
+        if time.monotonic() - _demanda_gravada_em < RESUMOS_DEMANDA_INTERVALO_S:
+            return
+        _demanda_gravada_em = time.monotonic()
+    threading.Thread(target=gravar_demanda, name="resumos-demanda", daemon=True).start()
+
+
+def gravar_demanda():
+    """
+    Grava no banco os acessos acumulados por `registrar_demanda`.
+    """
+    with _lock:
+        itens = list(_demanda.items())
+        _demanda.clear()
+    if not itens:
+        return
+    try:
+        if not resumos_disponiveis():
+            return
+        with conectar() as conn:
+            conn.execute(text("""
+                INSERT INTO mpiv02.resumos_ia_demanda (id_paciente, acessos, ultimo_acesso)
+                SELECT id_paciente, acessos, NOW()
+                FROM UNNEST(CAST(:ids AS TEXT[]), CAST(:acessos AS BIGINT[])) AS d (id_paciente, acessos)
+                ON CONFLICT (id_paciente) DO UPDATE
+                SET acessos = mpiv02.resumos_ia_demanda.acessos + EXCLUDED.acessos,
+                    ultimo_acesso = EXCLUDED.ultimo_acesso
+            """), {"ids": [pid for pid, _ in itens], "acessos": [n for _, n in itens]})
+            conn.commit()
+    except Exception:
+        print("Erro ao gravar os acessos dos pacientes:", traceback.format_exc())
+
+
+def pacientes_pendentes(limite: int = None, dias: int = None):
+    """
+    Lista os pacientes cujo resumo falta ou foi gerado com uma versao antiga dos
+    dados, priorizando os mais acessados e depois os com eventos mais recentes.
+
+    Args:
+        limite (int, optional): Maximo de pacientes (padrao RESUMOS_LOTE).
+        dias (int, optional): Janela de atividade considerada (padrao RESUMOS_JANELA_DIAS).
+
+    Returns:
+        list: Pares (ID do paciente, versao atual dos dados), em ordem de prioridade.
+    """
+    from db.models import versoes_pacientes, resumo_pacientes_disponivel
+
+    limite = RESUMOS_LOTE if limite is None else limite
+    dias = RESUMOS_JANELA_DIAS if dias is None else dias
+    # Com o resumo por paciente, a atividade recente vem dele; senao, apenas os acessos contam.
+    recentes = """
+        SELECT id_paciente, ultimo_evento FROM mpiv02.pacientes_resumo
+        WHERE ultimo_evento >= NOW() - make_interval(days => :dias)
+    """ if resumo_pacientes_disponivel() else "SELECT NULL::TEXT AS id_paciente, NULL::TIMESTAMP AS ultimo_evento WHERE FALSE"
+
+    pendentes = []
+    with conectar("analitico") as conn:
+        result = conn.execution_options(stream_results=True).execute(text(f"""
+            SELECT COALESCE(d.id_paciente::TEXT, r.id_paciente::TEXT) AS id_paciente, s.versao
+            FROM (
+                SELECT id_paciente, acessos FROM mpiv02.resumos_ia_demanda
+                WHERE ultimo_acesso >= NOW() - make_interval(days => :dias)
+            ) d
+            FULL JOIN ({recentes}) r ON r.id_paciente::TEXT = d.id_paciente::TEXT
+            LEFT JOIN mpiv02.resumos_ia s ON s.id_paciente::TEXT = COALESCE(d.id_paciente::TEXT, r.id_paciente::TEXT)
+            ORDER BY COALESCE(d.acessos, 0) DESC, r.ultimo_evento DESC NULLS LAST
+        """), {"dias": dias})
+        # Compara as versoes em blocos ate juntar `limite` pacientes desatualizados.
+        while len(pendentes) < limite:
+            bloco = result.fetchmany(500)
+            if not bloco:
+                break
+            atuais = versoes_pacientes([row.id_paciente for row in bloco])
+            for row in bloco:
+                versao = atuais[row.id_paciente]
+                if versao != row.versao and versao != "None|0":
+                    pendentes.append((row.id_paciente, versao))
+        result.close()
+    return pendentes[:limite]
+
+
+def mensagens_resumo(patient_id: str, contexto: str):
+    """
+    Monta as mensagens enviadas a IA para resumir a ficha do paciente.
+    """
+    prompt = f"""
+        Voce e um assistente de saude analisando dados clinicos. Com base nas observacoes abaixo do paciente de ID {patient_id}, {PERGUNTA_RESUMO.lower()}. NAO ESCREVA O NOME DO PACIENTE NUNCA. Escreva o texto com formatacao markdown.
+        Organize o resumo em: condicoes e diagnosticos, medicamentos, exames e valores relevantes (com datas), acompanhamento (profissionais, convenios, frequencia) e pontos de atencao.
+
+        DADOS DO PACIENTE:
+        {contexto}
+        """
+    return [
+        {"role": "system", "content": "Voce e um assistente medico que analisa prontuarios clinicos e responde perguntas com base em observacaes do paciente."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def gerar_resumo(cliente, modelo: str, patient_id: str, versao: str, temperatura: float = 0.2):
+    """
+    Gera e guarda o resumo de um paciente.
+
+    Returns:
+        str: O resumo gerado, ou None se o paciente nao tiver eventos.
+    """
+    from db.models import buscar_jornada_por_id
+
+    registros = buscar_jornada_por_id(patient_id, colunas=COLUNAS_CONTEXTO, limite=LIMITE_EVENTOS_CONTEXTO)
+    if not registros:
+        return None
+    response = chamar_ia(
+        cliente,
+        model=modelo,
+        messages=mensagens_resumo(patient_id, montar_contexto(registros)),
+        temperature=temperatura,
+    )
+    resumo = response.choices[0].message.content.strip()
+    guardar_resumo(patient_id, versao, resumo, modelo)
+    return resumo
+
+
+def gerar_resumos(cliente, modelo: str, pendentes: list, concorrencia: int = None):
+    """
+    Gera os resumos dos pacientes pendentes com no maximo `concorrencia` chamadas
+    simultaneas a IA.
+
+    Yields:
+        tuple: (ID do paciente, None em caso de sucesso ou a mensagem de erro).
+    """
+    with ThreadPoolExecutor(max_workers=concorrencia or RESUMOS_CONCORRENCIA) as executor:
+        futuros = {executor.submit(gerar_resumo, cliente, modelo, pid, versao): pid for pid, versao in pendentes}
+        for futuro in as_completed(futuros):
+            try:
+                futuro.result()
+                yield futuros[futuro], None
+            except Exception as e:
+                print("Erro ao gerar resumo:", traceback.format_exc())
+                yield futuros[futuro], str(e)
+
+
+def main():
+    # Gera os resumos que faltam ou ficaram desatualizados (ex.: agendado a cada hora):
+    #     python -m ia.resumos --limite 200
+    import argparse
+    from ia.cliente import obter_cliente
+
+    parser = argparse.ArgumentParser(description="Gera os resumos dos pacientes em segundo plano.")
+    parser.add_argument("--limite", type=int, default=RESUMOS_LOTE, help="Resumos gerados nesta execucao.")
+    parser.add_argument("--dias", type=int, default=RESUMOS_JANELA_DIAS, help="Janela de atividade recente.")
+    parser.add_argument("--concorrencia", type=int, default=RESUMOS_CONCORRENCIA)
+    args = parser.parse_args()
+
+    criar_estruturas()
+    pendentes = pacientes_pendentes(args.limite, args.dias)
+    print(f"Resumos pendentes: {len(pendentes)}")
+    cliente = obter_cliente()
+    modelo = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+    erros = sum(1 for _, erro in gerar_resumos(cliente, modelo, pendentes, args.concorrencia) if erro)
+    print(f"Resumos gerados: {len(pendentes) - erros}; erros: {erros}")
+
+
+if __name__ == '__main__':
+    main()
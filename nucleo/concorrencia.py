@@ -0,0 +1,213 @@
+import os
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+from nucleo.metricas import observar, incrementar
+
+
+# Chamadas simultaneas a IA no processo (todas as rotas, lotes e jobs somados).
+IA_CONCORRENCIA_MAX = int(os.getenv("IA_CONCORRENCIA_MAX", "8"))
+# Tempo maximo (em segundos) esperando uma vaga antes de desistir com LimiteExcedido.
+IA_FILA_ESPERA_S = float(os.getenv("IA_FILA_ESPERA_S", "30"))
+# Tempo maximo (em segundos) aguardando uma chamada identica em andamento (inclui a
+# chamada inteira, ex.: a resposta da IA) antes de desistir com LimiteExcedido.
+VOO_ESPERA_S = float(os.getenv("VOO_ESPERA_S", "120"))
+
+
+class LimiteExcedido(Exception):
+    """
+    Nenhuma vaga do limitador foi liberada dentro do tempo de espera.
+    """
+
+
+class _Voo:
+    """
+    Uma execucao em andamento; chamadas identicas aguardam o mesmo resultado.
+    """
+
+    def __init__(self, grupo: str):
+        self.grupo = grupo
+        self.pronto = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+    def concluir(self, resultado=None, erro: BaseException = None):
+        self.resultado, self.erro = resultado, erro
+        self.pronto.set()
+
+    def aguardar(self, timeout: float = None):
+        """
+        Aguarda o resultado da execucao (no maximo `timeout` segundos, padrao VOO_ESPERA_S).
+
+        Raises:
+            LimiteExcedido: Se a execucao nao terminar dentro do tempo de espera.
+        """
+        if not self.pronto.wait(VOO_ESPERA_S if timeout is None else timeout):
+            incrementar("voo_espera_excedida_total", grupo=self.grupo)
+            raise LimiteExcedido(f"Uma chamada identica ainda esta em andamento ({self.grupo}); tente novamente em instantes.")
+        if self.erro is not None:
+            raise self.erro
+        return self.resultado
+
+
+class _Limitador:
+    """
+    Semaforo com limite de chamadas simultaneas que mede o tempo de espera na fila.
+    """
+
+    def __init__(self, nome: str, maximo: int, espera_s: float):
+        self.nome = nome
+        self.maximo = maximo
+        self.espera_s = espera_s
+        self.semaforo = threading.BoundedSemaphore(maximo)
+        self.em_uso = 0
+        self.aguardando = 0
+
+
+# (grupo, chave) -> execucao em andamento.
+_voos = {}
+_lock = threading.Lock()
+LIMITADORES = {
+    "ia": _Limitador("ia", IA_CONCORRENCIA_MAX, IA_FILA_ESPERA_S),
+}
+
+
+def entrar_voo(grupo: str, chave):
+    """
+    Registra uma execucao para a chave, ou encontra a que ja esta em andamento.
+    Usado quando o trabalho nao cabe em uma funcao (ex.: respostas em streaming);
+    nos demais casos, prefira `coalescer`.
+
+    Returns:
+        tuple: (voo, lider). Se `lider` for True, quem chamou deve fazer o trabalho e
+               chamar `sair_voo`; senao, deve apenas chamar `voo.aguardar()`.
+    """
+    with _lock:
+        voo = _voos.get((grupo, chave))
+        lider = voo is None
+        if lider:
+            voo = _voos[(grupo, chave)] = _Voo(grupo)
+    if not lider:
+        incrementar("coalescidas_total", grupo=grupo)
+    return voo, lider
+
+
+def sair_voo(grupo: str, chave, voo: _Voo, resultado=None, erro: BaseException = None):
+    """
+    Encerra a execucao do lider e entrega o resultado (ou o erro) a quem aguarda.
+    """
+    with _lock:
+        if _voos.get((grupo, chave)) is voo:
+            del _voos[(grupo, chave)]
+    voo.concluir(resultado, erro)
+
+
+def coalescer(grupo: str, chave, funcao, *args, **kwargs):
+    """
+    Executa `funcao(*args, **kwargs)` uma unica vez para chamadas simultaneas com a
+    mesma chave: a primeira executa e as demais aguardam e recebem o mesmo resultado
+    (ou a mesma excecao). Chamadas feitas depois do termino executam de novo.
+
+    O resultado e compartilhado entre as chamadas e nao deve ser alterado.
+
+    Args:
+        grupo (str): Nome do grupo (rotulo das metricas), ex.: "prompt".
+        chave: Identifica chamadas equivalentes (precisa ser hashable).
+        funcao: Funcao que faz o trabalho.
+
+    Returns:
+        O resultado de `funcao`.
+    """
+    voo, lider = entrar_voo(grupo, chave)
+    if not lider:
+        return voo.aguardar()
+    try:
+        resultado = funcao(*args, **kwargs)
+    except BaseException as e:
+        sair_voo(grupo, chave, voo, erro=e)
+        raise
+    sair_voo(grupo, chave, voo, resultado=resultado)
+    return resultado
+
+
+def _copiar(valor):
+    """
+    Copia listas, dicionarios e conjuntos (recursivamente); os demais valores, como
+    textos, numeros, datas e tuplas de escalares, sao imutaveis e ficam como estao.
+    """
+    if isinstance(valor, list):
+        return [_copiar(v) for v in valor]
+    if isinstance(valor, dict):
+        return {k: _copiar(v) for k, v in valor.items()}
+    if isinstance(valor, set):
+        return set(valor)
+    return valor
+
+
+def coalescido(grupo: str):
+    """
+    Decorador que aplica `coalescer` a uma funcao de leitura, usando a propria
+    funcao e seus argumentos como chave. Cada chamada recebe sua propria copia do
+    resultado, que pode ser alterada sem afetar as demais.
+    """
+    def decorador(funcao):
+        @wraps(funcao)
+        def envolvida(*args, **kwargs):
+            chave = (funcao.__qualname__, repr(args), repr(sorted(kwargs.items())))
+            return _copiar(coalescer(grupo, chave, funcao, *args, **kwargs))
+        return envolvida
+    return decorador
+
+
+@contextmanager
+def limitar(nome: str):
+    """
+    Ocupa uma vaga do limitador `nome` durante o bloco (usar com `with`). O tempo
+    na fila vai para o histograma "fila_duracao_segundos".
+
+    Raises:
+        LimiteExcedido: Se nenhuma vaga for liberada dentro do tempo de espera.
+    """
+    limitador = LIMITADORES[nome]
+    inicio = time.perf_counter()
+    with _lock:
+        limitador.aguardando += 1
+    try:
+        obteve = limitador.semaforo.acquire(timeout=limitador.espera_s)
+    finally:
+        with _lock:
+            limitador.aguardando -= 1
+    observar("fila_duracao_segundos", time.perf_counter() - inicio, limitador=nome)
+    if not obteve:
+        incrementar("limite_excedido_total", limitador=nome)
+        raise LimiteExcedido(f"Muitas chamadas simultaneas ({nome}); tente novamente em instantes.")
+
+    with _lock:
+        limitador.em_uso += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            limitador.em_uso -= 1
+        limitador.semaforo.release()
+
+
+def medidores_concorrencia():
+    """
+    Ocupacao atual dos limitadores e execucoes em andamento, no formato de
+    `exportar_prometheus(medidores=...)`.
+    """
+    with _lock:
+        limitadores = [(l.nome, l.maximo, l.em_uso, l.aguardando) for l in LIMITADORES.values()]
+        voos = {}
+        for grupo, _ in _voos:
+            voos[grupo] = voos.get(grupo, 0) + 1
+    return {
+        "limitador_maximo": ("Vagas de cada limitador.", [({"limitador": n}, m) for n, m, _, _ in limitadores]),
+        "limitador_em_uso": ("Vagas ocupadas de cada limitador.", [({"limitador": n}, u) for n, _, u, _ in limitadores]),
+        "limitador_aguardando": ("Chamadas na fila de cada limitador.", [({"limitador": n}, a) for n, _, _, a in limitadores]),
+        "voos_em_andamento": ("Execucoes em andamento que podem ser compartilhadas, por grupo.",
+                              [({"grupo": g}, n) for g, n in sorted(voos.items())]),
+    }
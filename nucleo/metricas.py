@@ -0,0 +1,204 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+
+
+# Prefixo dos nomes das metricas no formato do Prometheus.
+PREFIXO = "promptmedles"
+# Limites (em segundos) dos baldes dos histogramas de latencia.
+BALDES_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Limites dos baldes dos histogramas de quantidade de linhas (e de tokens).
+BALDES_QUANTIDADE = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Descricao e baldes de cada histograma registrado.
+HISTOGRAMAS = {
+    "requisicao_duracao_segundos": ("Duracao das requisicoes ate o envio dos cabecalhos.", BALDES_LATENCIA),
+    "etapa_duracao_segundos": ("Duracao de cada etapa (banco, contexto, IA, grafico) por rota.", BALDES_LATENCIA),
+    "linhas": ("Linhas lidas do banco por etapa.", BALDES_QUANTIDADE),
+    "tokens": ("Tokens de entrada (prompt) e saida (completion) por chamada a IA.", BALDES_QUANTIDADE),
+    "fila_duracao_segundos": ("Espera por uma vaga de cada limitador de concorrencia (ex.: chamadas a IA).", BALDES_LATENCIA),
+}
+CONTADORES = {
+    "cache_total": "Consultas aos caches, por cache e resultado (acerto ou falha).",
+    "tokens_total": "Total de tokens enviados e recebidos da IA.",
+    "coalescidas_total": "Chamadas que aguardaram uma execucao identica em andamento em vez de repeti-la, por grupo.",
+    "limite_excedido_total": "Chamadas recusadas por esperar demais por uma vaga do limitador.",
+    "voo_espera_excedida_total": "Chamadas que desistiram de aguardar uma execucao identica em andamento, por grupo.",
+}
+
+# Os valores ficam na memoria do processo: com varios workers, cada um expoe os seus.
+# (nome, rotulos ordenados) -> [contagem por balde..., soma, total]
+_histogramas = {}
+# (nome, rotulos ordenados) -> valor
+_contadores = {}
+_lock = threading.Lock()
+
+
+def _rotulos(rotulos: dict):
+    return tuple(sorted((k, str(v)) for k, v in rotulos.items()))
+
+
+def rota_atual():
+    """
+    Retorna o padrao da rota da requisicao atual (ex.: "/plot/img/<nome>"), ou
+    "-" fora de uma requisicao. O padrao, e nao a URL, evita rotulos sem limite.
+    """
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return "-"
+
+
+def observar(nome: str, valor: float, **rotulos):
+    """
+    Registra um valor em um histograma de HISTOGRAMAS.
+    """
+    baldes = HISTOGRAMAS[nome][1]
+    chave = (nome, _rotulos(rotulos))
+    with _lock:
+        serie = _histogramas.get(chave)
+        if serie is None:
+            serie = _histogramas[chave] = [0] * (len(baldes) + 2)
+        for i, limite in enumerate(baldes):
+            if valor <= limite:
+                serie[i] += 1
+        serie[-2] += valor
+        serie[-1] += 1
+
+
+def incrementar(nome: str, valor: float = 1, **rotulos):
+    """
+    Soma um valor a um contador de CONTADORES.
+    """
+    chave = (nome, _rotulos(rotulos))
+    with _lock:
+        _contadores[chave] = _contadores.get(chave, 0) + valor
+
+
+def registrar_etapa(etapa: str, segundos: float):
+    """
+    Registra a duracao de uma etapa na rota atual. Dentro de uma requisicao, a etapa
+    tambem entra no cabecalho Server-Timing da resposta.
+    """
+    observar("etapa_duracao_segundos", segundos, rota=rota_atual(), etapa=etapa)
+    if has_request_context():
+        g.setdefault("tempos_etapas", []).append((etapa, segundos))
+
+
+@contextmanager
+def medir(etapa: str):
+    """
+    Mede a duracao do bloco como uma etapa da rota atual (usar com `with`).
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar_etapa(etapa, time.perf_counter() - inicio)
+
+
+def registrar_linhas(etapa: str, quantidade: int):
+    """
+    Registra quantas linhas uma etapa leu do banco.
+    """
+    observar("linhas", quantidade, rota=rota_atual(), etapa=etapa)
+
+
+def registrar_cache(cache: str, acerto: bool):
+    """
+    Registra uma consulta a um cache, para calcular a taxa de acertos.
+    """
+    incrementar("cache_total", cache=cache, resultado="acerto" if acerto else "falha")
+
+
+def registrar_tokens(uso, modelo: str):
+    """
+    Registra os tokens de uma chamada a IA a partir do campo `usage` da resposta.
+    """
+    if uso is None:
+        return
+    rota = rota_atual()
+    for tipo, quantidade in (("prompt", uso.prompt_tokens), ("completion", uso.completion_tokens)):
+        observar("tokens", quantidade, rota=rota, tipo=tipo)
+        incrementar("tokens_total", quantidade, rota=rota, modelo=modelo, tipo=tipo)
+
+
+def iniciar_requisicao():
+    """
+    Marca o inicio da requisicao (chamada em `before_request`).
+    """
+    g.inicio_requisicao = time.perf_counter()
+
+
+def finalizar_requisicao(response):
+    """
+    Registra a duracao da requisicao e adiciona o cabecalho Server-Timing com as
+    etapas medidas (chamada em `after_request`). Em respostas em streaming, as etapas
+    executadas depois do envio dos cabecalhos so aparecem nos histogramas.
+    """
+    inicio = g.get("inicio_requisicao")
+    if inicio is None:
+        return response
+    total = time.perf_counter() - inicio
+    observar("requisicao_duracao_segundos", total, rota=rota_atual(), metodo=request.method, status=response.status_code)
+
+    partes = [f"{etapa};dur={segundos * 1000:.1f}" for etapa, segundos in g.get("tempos_etapas", [])]
+    partes.append(f"total;dur={total * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(partes)
+    return response
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formatar_rotulos(rotulos, extra=()):
+    itens = list(rotulos) + list(extra)
+    if not itens:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in itens) + "}"
+
+
+def exportar_prometheus(medidores: dict = None):
+    """
+    Gera o texto de todas as metricas no formato de exposicao do Prometheus.
+
+    Args:
+        medidores (dict, optional): Valores instantaneos extras (gauges), no formato
+            nome -> (descricao, [(rotulos, valor), ...]).
+
+    Returns:
+        str: O texto servido em '/metrics'.
+    """
+    with _lock:
+        histogramas = {chave: list(serie) for chave, serie in _histogramas.items()}
+        contadores = dict(_contadores)
+
+    linhas = []
+    for nome, (descricao, baldes) in HISTOGRAMAS.items():
+        completo = f"{PREFIXO}_{nome}"
+        linhas += [f"# HELP {completo} {descricao}", f"# TYPE {completo} histogram"]
+        for (nome_serie, rotulos), serie in sorted(histogramas.items()):
+            if nome_serie != nome:
+                continue
+            for limite, contagem in zip(baldes, serie):
+                linhas.append(f"{completo}_bucket{_formatar_rotulos(rotulos, [('le', limite)])} {contagem}")
+            linhas.append(f"{completo}_bucket{_formatar_rotulos(rotulos, [('le', '+Inf')])} {serie[-1]}")
+            linhas.append(f"{completo}_sum{_formatar_rotulos(rotulos)} {serie[-2]}")
+            linhas.append(f"{completo}_count{_formatar_rotulos(rotulos)} {serie[-1]}")
+
+    for nome, descricao in CONTADORES.items():
+        completo = f"{PREFIXO}_{nome}"
+        linhas += [f"# HELP {completo} {descricao}", f"# TYPE {completo} counter"]
+        for (nome_serie, rotulos), valor in sorted(contadores.items()):
+            if nome_serie == nome:
+                linhas.append(f"{completo}{_formatar_rotulos(rotulos)} {valor}")
+
+    for nome, (descricao, valores) in (medidores or {}).items():
+        completo = f"{PREFIXO}_{nome}"
+        linhas += [f"# HELP {completo} {descricao}", f"# TYPE {completo} gauge"]
+        for rotulos, valor in valores:
+            linhas.append(f"{completo}{_formatar_rotulos(_rotulos(rotulos))} {valor}")
+
+    return "\n".join(linhas) + "\n"
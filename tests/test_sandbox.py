@@ -0,0 +1,61 @@
+import pytest
+
+from graficos.sandbox import preparar_codigo, executar_grafico, CodigoInvalido
+
+
+DADOS = {"data": ["2024-01-05", "2024-02-10", "2024-02-20"], "descricao": ["a", "b", "c"]}
+
+
+def executar(codigo: str):
+    return executar_grafico(preparar_codigo(codigo), DADOS)
+
+
+@pytest.mark.parametrize("codigo", [
+    # Modulos alcancados por atributos comuns.
+    'plt.title(plt.sys.modules["os"].getcwd())',
+    "plt.title(pd.io.common.os.getcwd())",
+    "modulo = plt.matplotlib\nplt.title(str(modulo))",
+    # Funcoes de arquivo do pandas, do NumPy e do matplotlib.
+    'plt.title(str(pd.read_csv("/etc/hostname")))',
+    'df.to_csv("/tmp/sandbox.csv")',
+    'df.to_pickle("/tmp/sandbox.pkl")',
+    'df["descricao"].values.tofile("/tmp/sandbox.bin")',
+    'plt.imread("/etc/hostname")',
+    'leitor = pd.read_json\nleitor("/etc/hostname")',
+    # Built-ins e introspecao.
+    'plt.title(open("/etc/hostname").read())',
+    'plt.title(str(getattr(plt, "sys")))',
+    "g = (x for x in [1])\nplt.title(str(g.gi_frame.f_back.f_globals))",
+    "plt.title(str(().__class__.__base__))",
+    'plt.title("{0.__class__}".format(df))',
+    'plt.title("{0:{1.__class__}}".format(1, df))',
+    'plt.title(str.format("{0.sys}", plt))',
+    # Redefinir a guarda dos atributos.
+    "_atributo_seguro = lambda o, n: o\nplt.title(str(plt.sys))",
+    "def f(_atributo_seguro):\n    return 1",
+    'df.query("data > 0")',
+])
+def test_escapes_sao_rejeitados(codigo):
+    with pytest.raises(CodigoInvalido):
+        executar(codigo)
+
+
+def test_grafico_comum_continua_funcionando():
+    codigo = """
+contagem = df.groupby(df.data.dt.to_period("M")).size()
+fig, ax = plt.subplots(figsize=(6, 3))
+ax.bar(contagem.index.astype(str), contagem.values, color="tab:blue")
+ax.set_title("Consultas por mes: {}".format(len(df)))
+plt.xticks(rotation=45)
+plt.tight_layout()
+plt.show()
+"""
+    imagem = executar(codigo)
+    assert imagem.startswith(b"\x89PNG")
+
+
+def test_configuracoes_globais_nao_passam_para_o_proximo_grafico():
+    codigo = 'plt.plot([1, 2, 3], [1, 4, 9])\nplt.title("Evolucao")'
+    antes = executar(codigo)
+    executar('plt.rcParams["axes.facecolor"] = "red"\nplt.rcParams["figure.figsize"] = [20, 10]\nplt.switch_backend("svg")\nplt.plot([1])')
+    assert executar(codigo) == antes